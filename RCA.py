@@ -14,12 +14,21 @@ import shutil
 import numpy as np
 from scipy import io as scio
 import nibabel as nib
-from RCAfunctions import registration, getMetrics
+from RCAfunctions import registration, getMetrics, parameterMaps, recomputeMetrics, writeJournal, Cascade, WorkerPool
+from RCAqueue import WorkQueue
+from RCAindex import ReferenceIndex, updateIndex
+from RCAcache import RegistrationCache
+from RCAtiming import TimingLog
+from RCAstore import ResultStore, resultsDict
+from RCAstopping import EarlyStopping, ORDERS
+from RCAio import AsyncWriter, warmFiles, CODECS, OUTPUTS
 
 import SimpleITK as sitk
 import time
 import argparse
 import scipy.io
+import glob
+import re
 
 
 G  = '\033[32m'
@@ -35,8 +44,35 @@ prog_help = "Script must be given (--refs, --subject, --config, --output\n"\
            "--subjects              = .txt file containing one subject-folder path per line\n"\
            "--config                = .cfg filename e.g. 'config.cfg'\n"\
            "--GT                    = the filename of the GT segmentation (optional)\n"\
-           "--seg                   = the filename of the test segmentation (optional)\n"\
-           "--output                = root folder to output the files (option - default to pwd)\n"
+           "--seg                   = the filename of the test segmentation, or several filenames/glob patterns of candidate segmentations (optional)\n"\
+           "--output                = root folder to output the files (option - default to pwd)\n"\
+           "--workers               = number of references registered in parallel (optional - default 1)\n"\
+           "--lease-timeout         = seconds without a heartbeat before a claimed subject is reclaimed (optional - default 600)\n"\
+           "--status                = print the pending/running/done/failed counts of the subjects and exit\n"\
+           "--bank                  = reference bank compiled from --refs with RCAbank.py (optional - read the references from it)\n"\
+           "--top-k                 = only register the K references most similar to each subject (optional - default all)\n"\
+           "--index                 = reference pre-selection index used by --top-k (optional - default output/RCAindex.npz)\n"\
+           "--write-transforms      = also write the Elastix transform parameters of every reference (optional - for auditing)\n"\
+           "--cache                 = registration cache folder, reused by later runs on the same images (optional)\n"\
+           "--cache-size            = size in GB the cache is trimmed to, least recently used first (optional - default unbounded)\n"\
+           "--cache-invalidate      = remove the cache entries made with other Elastix parameter maps before starting (optional)\n"\
+           "--prometheus            = Prometheus textfile updated with the stage timings after every subject (optional)\n"\
+           "--profile               = prefix of the cProfile files of the registration loop, one per process (optional)\n"\
+           "--store                 = cohort results store the results of every subject are appended to (optional - default output/store)\n"\
+           "--no-mat                = do not write the per-subject .mat files (optional - they can be exported from the store)\n"\
+           "--recompute-metrics     = only recompute the metrics from the warped reference segmentations of an earlier run (no registration)\n"\
+           "--roi                   = register only the region within this margin (mm) of the labels of the subject and of each reference (optional)\n"\
+           "--stop-dsc              = stop registering references once one reaches this DSC (optional)\n"\
+           "--stop-tolerance        = stop once the max DSC is within this of its lower bootstrap bound (optional)\n"\
+           "--stop-confidence       = confidence of the bootstrap bound of --stop-tolerance (optional - default 0.95)\n"\
+           "--stop-min              = references registered before --stop-tolerance applies (optional - default 5)\n"\
+           "--order                 = order the references are registered in: given or random (optional - default given)\n"\
+           "--prefetch              = references read ahead in the background while the current one registers (optional - default 2, 0 = off)\n"\
+           "--prefetch-mb           = memory cap of the prefetched and queued images in MB (optional - default 1024)\n"\
+           "--write-queue           = output writes queued in the background per process (optional - default 4, 0 = synchronous)\n"\
+           "--outputs               = warped images written per reference: all, labels or none (optional - default all)\n"\
+           "--codec                 = compression of the warped images: gzip, fast or none (optional - default gzip)\n"\
+           "--cascade               = register every reference rigidly, then refine only this many best references with the B-spline stage (optional)\n"
 
 parser = argparse.ArgumentParser(description='Perform RCA on [subject] using a set of [reference images]')
 parser.add_argument('--refs', type=str, default='/vol/biomedic/users/rdr16/RCA2017/registeredCropped')
@@ -46,8 +82,35 @@ group.add_argument('--subjects', type=str)
 parser.add_argument('--config', type=str, default='5kBIOBANK')
 parser.add_argument('--output', type=str)  
 parser.add_argument('--GT', type=str, default=False)
-parser.add_argument('--seg', type=str, default=False)
+parser.add_argument('--seg', type=str, nargs='+', default=False)
 parser.add_argument('--prep', type=str, default=False)
+parser.add_argument('--workers', type=int, default=1)
+parser.add_argument('--lease-timeout', type=int, default=600)
+parser.add_argument('--status', action='store_true')
+parser.add_argument('--bank', type=str, default=None)
+parser.add_argument('--top-k', type=int, default=None)
+parser.add_argument('--index', type=str, default=None)
+parser.add_argument('--write-transforms', action='store_true')
+parser.add_argument('--cache', type=str, default=None)
+parser.add_argument('--cache-size', type=float, default=None)
+parser.add_argument('--cache-invalidate', action='store_true')
+parser.add_argument('--prometheus', type=str, default=None)
+parser.add_argument('--profile', type=str, default=None)
+parser.add_argument('--store', type=str, default=None)
+parser.add_argument('--no-mat', action='store_true')
+parser.add_argument('--recompute-metrics', action='store_true')
+parser.add_argument('--roi', type=float, default=None)
+parser.add_argument('--stop-dsc', type=float, default=None)
+parser.add_argument('--stop-tolerance', type=float, default=None)
+parser.add_argument('--stop-confidence', type=float, default=0.95)
+parser.add_argument('--stop-min', type=int, default=5)
+parser.add_argument('--order', type=str, default='given', choices=ORDERS)
+parser.add_argument('--prefetch', type=int, default=2)
+parser.add_argument('--prefetch-mb', type=float, default=1024)
+parser.add_argument('--write-queue', type=int, default=4)
+parser.add_argument('--outputs', type=str, default='all', choices=OUTPUTS)
+parser.add_argument('--codec', type=str, default='gzip', choices=CODECS)
+parser.add_argument('--cascade', type=int, default=None)
 args = parser.parse_args()
 
 #####   OUTPUT FOLDERS #####
@@ -75,9 +138,151 @@ else:
     print G+'[*] output_folder: \t{}'.format(output_FOLDER)+W
     outputList = [output_FOLDER]
 
+#####   WORK QUEUE #####
+# Every RCA.py process pointed at the same output root shares one queue of subjects.
+# A subject is only worked on by the process holding its lease, so many processes can run on one subject list.
+queue = WorkQueue(os.path.join(output_root, 'queue'), [os.path.basename(os.path.abspath(line)) for line in subjectList], timeout=args.lease_timeout)
+if args.status:
+    counts = queue.status()
+    sys.stdout.write('Pending: {pending}\tRunning: {running}\tDone: {done}\tFailed: {failed}\t(expired leases: {expired})\n'.format(**counts))
+    sys.exit(0)
+
+#####   REFERENCE PRE-SELECTION #####
+# With --top-k, each subject is only registered to its K most similar references according to the index.
+# The index is brought up to date once here (only new or modified references are read).
+referenceIndex = None
+if args.top_k and os.path.isdir(args.refs):
+    index_FILE = os.path.abspath(args.index if args.index else os.path.join(output_root, 'RCAindex.npz'))
+    described = updateIndex(args.refs, index_FILE)
+    referenceIndex = ReferenceIndex(index_FILE)
+    print G+'[*] ref_index: \t{} ({} references updated)'.format(index_FILE, len(described))+W
+
+#####   REGISTRATION CACHE #####
+# Entries are keyed by the parameter maps, so changing them never reuses old transforms - this only frees the space
+# The rigid-only entries of the first tier of a --cascade are kept as well
+if args.cache and args.cache_invalidate:
+    parameterMap_1, parameterMapVector = parameterMaps(sitk.ElastixImageFilter())
+    RegistrationCache(args.cache, parameterMapVector, live=[parameterMap_1]).invalidate()
+cache_BYTES = int(args.cache_size * 2**30) if args.cache_size else None
+
+#####   TIMINGS #####
+# Stage timings of every reference go to output/<subject>/RCA/timings.jsonl, the batch totals to the --prometheus textfile
+timings = TimingLog(os.path.abspath(args.prometheus) if args.prometheus else None)
+
+#####   RESULTS STORE #####
+# Every worker appends its subjects to the same store, one partition per subject (see RCAstore.py)
+store = ResultStore(args.store if args.store else os.path.join(output_root, 'store'))
+
+#####   EARLY STOPPING #####
+# With --stop-dsc and/or --stop-tolerance, the references of a subject are registered in --order until a rule is met (see RCAstopping.py)
+stopping = None
+if args.stop_dsc is not None or args.stop_tolerance is not None or args.order != 'given':
+    stopping = EarlyStopping(ceiling=args.stop_dsc, tolerance=args.stop_tolerance, confidence=args.stop_confidence, minReferences=args.stop_min, order=args.order)
+
+#####   CASCADE #####
+# With --cascade N, every reference is registered with the rigid stage only and the N best are refined with the B-spline stage
+cascade = Cascade(args.cascade) if args.cascade else None
+
+#####   CANDIDATE SEGMENTATIONS #####
+# With several --seg filenames or glob patterns (relative to the subject folder), every candidate segmentation of the image is
+# scored against the same registrations: the references are registered and warped once per subject, and each candidate gets
+# its own journal, .mat and results named <subject>_<candidate>. A single --seg filename keeps the results named <subject>.
+seg_CANDIDATES = None
+if args.seg and (len(args.seg) > 1 or any(glob.has_magic(pattern) for pattern in args.seg)):
+    seg_CANDIDATES = args.seg
+elif args.seg:
+    args.seg = args.seg[0]
+
+def candidateFiles(subject_FOLDER):
+    # Returns - the (candidate name, file) of every segmentation matching --seg in a subject folder, in the order of --seg
+    # The name is the path relative to the subject folder, without the extension and with '_' for the separators
+    candidates = []
+    for pattern in seg_CANDIDATES:
+        for f in sorted(glob.glob(os.path.join(subject_FOLDER, pattern))):
+            name = re.sub(r'\.nii(\.gz)?$', '', os.path.relpath(f, subject_FOLDER)).replace(os.sep, '_')
+            if os.path.isfile(f) and name not in [c[0] for c in candidates]:
+                candidates.append((name, os.path.abspath(f)))
+    return candidates
+
+def resultFiles(subject_NAME, output_FOLDER, candidate_NAME=None):
+    # Returns - the name, journal and .mat of the results of a subject, or of one of its candidate segmentations
+    if candidate_NAME is None:
+        return subject_NAME, os.path.join(output_FOLDER, 'RCA', 'journal.jsonl'), os.path.join(output_FOLDER, 'data', '{}.mat'.format(subject_NAME))
+    result_NAME = '{}_{}'.format(subject_NAME, candidate_NAME)
+    return result_NAME, os.path.join(output_FOLDER, 'RCA', 'journal_{}.jsonl'.format(candidate_NAME)), os.path.join(output_FOLDER, 'data', '{}.mat'.format(result_NAME))
+
+def saveResults(subject_NAME, datafile, Data, realMetrics=None, stopped=None, cascaded=None):
+    # The results of a subject go to the store and (unless --no-mat) to its .mat
+    store.append(subject_NAME, class_list, Data, realMetrics, stopped, cascaded)
+    if not args.no_mat:
+        scipy.io.savemat(datafile, resultsDict(subject_NAME, class_list, Data, realMetrics, stopped, cascaded))
+
+#####   RECOMPUTE METRICS ONLY #####
+# The warped reference segmentations of an earlier run (output/<subject>/RCA/test) are scored again without any registration,
+# e.g. after a change of the class mappings: class_list (subject) and ref_class_list (references, default class_list) in the config.
+# The references of all subjects are shared between the --workers processes; the journal, .mat and store of every subject are rewritten.
+# The early stopping and cascade records of the earlier run are carried over from the store (the rigid tier is not scored again).
+if args.recompute_metrics:
+    cfgfile = args.config if args.config[-4:] == '.cfg' else args.config + '.cfg'
+    if not os.path.exists(os.path.abspath(cfgfile)):
+        msg = R+"[*] Config file doesn't exist: {}\n\n".format(cfgfile)+W
+        sys.exit(msg + prog_help)
+    image_FILE      = []
+    seg_FILE        = []
+    class_list      = []
+    ref_class_list  = None
+    execfile(os.path.abspath(cfgfile))
+    if args.seg and not seg_CANDIDATES:
+        seg_FILE = args.seg
+
+    # Every candidate segmentation of a subject is scored against the same warped segmentations
+    recompute = []
+    outputs   = []
+    for subject, output_FOLDER in zip(subjectList, outputList):
+        subject_NAME = os.path.basename(os.path.abspath(subject))
+        if not os.path.isdir(os.path.join(output_FOLDER, 'RCA', 'test')):
+            print R+'[*] No warped segmentations for subject: {}'.format(subject_NAME)+W
+            continue
+        candidates = candidateFiles(os.path.abspath(subject)) if seg_CANDIDATES else [(None, os.path.abspath(os.path.join(subject, seg_FILE)))]
+        for candidate_NAME, candidate_FILE in candidates:
+            recompute.append((subject_NAME, candidate_FILE, output_FOLDER))
+            outputs.append((os.path.abspath(subject), output_FOLDER, candidate_FILE) + resultFiles(subject_NAME, output_FOLDER, candidate_NAME))
+
+    records = store.records([output[3] for output in outputs])
+    t0 = time.time()
+    for index, (subject_NAME, Data) in enumerate(recomputeMetrics(recompute, subject_classes=class_list, ref_classes=ref_class_list or class_list, workers=args.workers)):
+        subject_FOLDER, output_FOLDER, candidate_FILE, result_NAME, journal_FILE, datafile = outputs[index]
+        if not Data:
+            print R+'[*] No metrics recomputed for subject: {}'.format(result_NAME)+W
+            continue
+        writeJournal(journal_FILE, Data)
+
+        realMetrics = None
+        if args.GT and os.path.isfile(os.path.join(subject_FOLDER, args.GT)):
+            subject_GT = sitk.ReadImage(os.path.join(subject_FOLDER, args.GT))
+            realMetrics = getMetrics(sitk.GetArrayFromImage(subject_GT), sitk.GetArrayFromImage(sitk.ReadImage(candidate_FILE)), ref_classes=[0,1,2,4], sampling=subject_GT.GetSpacing()[::-1])
+
+        if not os.path.exists(os.path.join(output_FOLDER, 'data')):
+            os.makedirs(os.path.join(output_FOLDER, 'data'))
+        stopped, cascaded = records[result_NAME]
+        saveResults(result_NAME, datafile, Data, realMetrics, stopped, cascaded)
+        sys.stdout.write('{}\t{} references\tPredicted DSC: {}\n'.format(result_NAME, len(Data), np.max(np.array([data[1] for data in Data])[:,-1])))
+        sys.stdout.flush()
+
+    sys.stdout.write('Recomputed {} subjects in {:.1f} s\n'.format(len(recompute), time.time() - t0))
+    sys.exit(0)
+
+#####   WORKERS #####
+# The --workers processes are shared by all subjects. They are forked here, before any thread is started (the background I/O
+# below, the lease heartbeats, the prefetch of the next subject): a thread holding a lock at the fork would leave it held in the workers.
+worker_POOL = WorkerPool(args.workers) if args.workers > 1 else None
+
+#####   BACKGROUND I/O #####
+# Copies of the subject files are written in the background while the subject is registered (see RCAio.py)
+copier = AsyncWriter(args.write_queue)
 
 ##### BEGIN FOR LOOP OVER ALL SUBJECTS (OR SINGLE SUBJECT) #####
-for subject, output_FOLDER in zip(subjectList, outputList): 
+for position, (subject, output_FOLDER) in enumerate(zip(subjectList, outputList)):
     t0 = time.time()
 
 #####   CHECK: DOES THE SUBJECT EXIST?   #####
@@ -92,23 +297,38 @@ for subject, output_FOLDER in zip(subjectList, outputList):
         print G+'[*] subject_folder: \t{}'.format(subject_FOLDER)+W
 
 
+#####   CHECK: WHICH CANDIDATE SEGMENTATIONS?  #####
+# A single --seg (or the config) is one candidate, whose results are named after the subject
+    candidates = [(None, None)]
+    if seg_CANDIDATES:
+        candidates = candidateFiles(subject_FOLDER)
+        if not candidates:
+            msg = R+"[*] No subject seg file matches: {}\n\n".format(' '.join(seg_CANDIDATES))+W
+            sys.stdout.write(msg + prog_help)
+            continue
+    results = [resultFiles(subject_NAME, output_FOLDER, candidate_NAME) for candidate_NAME, candidate_FILE in candidates]
+
 #####   CHECK: HAS RCA ALREADY BEEN PERFORMED?  #####
-# If there's already a data-file or an exception folder - skip this subject
-# Otherwise, check if any new files are being created (i.e. RCA in process)
-    datafile = os.path.join(output_FOLDER, 'data', '{}.mat'.format(subject_NAME))
-    if os.path.exists(datafile) or os.path.exists(os.path.join(output_FOLDER, 'exception')):
+# If there's already a data-file (for every candidate) or an exception folder - skip this subject
+# Otherwise, claim the subject - if another worker holds a live lease on it, move on
+    if all(os.path.exists(datafile) for result_NAME, journal, datafile in results) or os.path.exists(os.path.join(output_FOLDER, 'exception')):
         continue 
-    elif os.path.exists(os.path.join(output_FOLDER, 'RCA', 'test')):
-        if not os.path.exists(datafile) and os.listdir(os.path.join(output_FOLDER, 'RCA', 'test')):
-            f1 = os.path.getmtime(os.path.join(output_FOLDER, 'RCA', 'test', os.listdir(os.path.join(output_FOLDER, 'RCA', 'test'))[-1]))
-            time.sleep(10)
-            f2 = os.path.getmtime(os.path.join(output_FOLDER, 'RCA', 'test', os.listdir(os.path.join(output_FOLDER, 'RCA', 'test'))[-1]))
-            if f1==f2:
-                shutil.rmtree(output_FOLDER)
-                sys.stdout.write('Removing incomplete directory: {}\n'.format(output_FOLDER))
-            else:
-                continue
-    os.makedirs(os.path.join(output_FOLDER, 'data'))
+# A subject done before, but not for every requested candidate (e.g. a new model's segmentation), is run again
+    saved_RESULTS = queue.doneResults(subject_NAME)
+    if saved_RESULTS is not None and not set(result_NAME for result_NAME, journal, datafile in results) <= set(saved_RESULTS):
+        queue.reopen(subject_NAME)
+    lease = queue.claim(subject_NAME)
+    if lease is None:
+        continue
+# Holding the lease means any existing output was left behind by a worker that died (or by an earlier run of a reopened subject).
+# It is kept: the references already in its journal (RCA/journal.jsonl, one per candidate) are not registered again.
+    journal_FILE = [journal for result_NAME, journal, datafile in results] if seg_CANDIDATES else results[0][1]
+    if any(os.path.exists(journal) for result_NAME, journal, datafile in results):
+        sys.stdout.write('Resuming incomplete directory: {}\n'.format(output_FOLDER))
+    for folder in [os.path.join(output_FOLDER, 'data'), os.path.join(output_FOLDER, 'RCA')]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    timings.beginSubject(subject_NAME, os.path.join(output_FOLDER, 'RCA', 'timings.jsonl'))
 
 
 #####   CHECK: ARE WE DEALING WITH A GROUND-TRUTH SITUATION?    #####
@@ -128,6 +348,12 @@ for subject, output_FOLDER in zip(subjectList, outputList):
     else:
         ref_img_FOLDER = os.path.abspath(args.refs)
         print G+'[*] ref_folder: \t{}'.format(ref_img_FOLDER)+W   
+    if args.bank:
+        if not os.path.isfile(os.path.join(os.path.abspath(args.bank), 'manifest.json')):
+            msg = R+"[*] Reference bank doesn't exist: {}\n\n".format(args.bank)+W
+            sys.exit(msg + prog_help)
+        else:
+            print G+'[*] ref_bank: \t{}'.format(os.path.abspath(args.bank))+W
 
 
 #####   ASSIGN: VARIABLES BASED ON THE CONFIG FILE  #####
@@ -146,7 +372,11 @@ for subject, output_FOLDER in zip(subjectList, outputList):
 
 
 ##### CHECK: DOES THE TEST-SEGMENTATION EXIST?  #####
-    if args.seg:
+    if seg_CANDIDATES:
+        seg_FILE = [candidate_FILE for candidate_NAME, candidate_FILE in candidates]
+        for candidate_NAME, candidate_FILE in candidates:
+            print G+'[*] subject_seg: \t{} ({})'.format(candidate_FILE, candidate_NAME)+W
+    elif args.seg:
         if not os.path.isfile(os.path.abspath(os.path.join(subject, args.seg))):
             msg = R+"[*] Subject seg file doesn't exist: {}\n\n".format(os.path.abspath(os.path.join(subject, args.seg)))+W
             sys.exit(msg + prog_help)
@@ -157,11 +387,22 @@ for subject, output_FOLDER in zip(subjectList, outputList):
 #####   ASSIGN: ALL FILES SHOULD NOW BE ACCESSIBLE  #####
 # Copy the primary image and segmentation to the RCA folder
     subject_image_FILE     = os.path.abspath(os.path.join(subject_FOLDER, image_FILE        ))
-    subject_seg_FILE       = os.path.abspath(os.path.join(subject_FOLDER, seg_FILE          ))
+    subject_seg_FILE       = os.path.abspath(os.path.join(subject_FOLDER, seg_FILE[0] if seg_CANDIDATES else seg_FILE))
+    if not seg_CANDIDATES:
+        candidates = [(None, subject_seg_FILE)]
+
+    if not os.path.exists(os.path.join(output_FOLDER, 'main_image', 'cropped')):
+        os.makedirs(os.path.join(output_FOLDER, 'main_image', 'cropped'))
+    with timings.stage('copy'):
+        for f in [subject_image_FILE] + [candidate_FILE for candidate_NAME, candidate_FILE in candidates]:
+            copier.copy(f, os.path.join(output_FOLDER, 'main_image', 'cropped'))
 
-    os.makedirs(os.path.join(output_FOLDER, 'main_image', 'cropped'))
-    for f in [subject_image_FILE, subject_seg_FILE]:
-        shutil.copy(f, os.path.join(output_FOLDER, 'main_image', 'cropped'))
+#####   PREFETCH: THE NEXT SUBJECT  #####
+# Its image and segmentation are read into the page cache in the background while this subject is registered
+    if args.prefetch and position + 1 < len(subjectList):
+        next_FOLDER = os.path.abspath(subjectList[position + 1])
+        next_SEGS   = [f for name, f in candidateFiles(next_FOLDER)] if seg_CANDIDATES else [os.path.join(next_FOLDER, args.seg if args.seg else seg_FILE)]
+        warmFiles([os.path.join(next_FOLDER, image_FILE)] + next_SEGS)
 
 
 #########################################################################################################################
@@ -176,17 +417,33 @@ for subject, output_FOLDER in zip(subjectList, outputList):
         sys.stdout.write('\n')
 
 ##### Sometimes the segmentation is not the same depth as the image - getMetrics throws IndexError exception
-# Best to catch the error and move on to a different subject rather than quit the loop
+# Best to catch the error and move on to a different subject rather than quit the loop (the same goes for a subject the index cannot describe)
     try:
-        Data = registration(subject_folder = subject_FOLDER, output_folder=output_FOLDER, imgFilename=image_FILE, segFilename=seg_FILE, refdir=args.refs, classes=class_list, doBoth=1)
-    except Exception as e:
-        print(e)
+        references = None
+        if referenceIndex:
+            with timings.stage('select'):
+                references = referenceIndex.select(sitk.ReadImage(subject_image_FILE), sitk.ReadImage(subject_seg_FILE), args.top_k, classes=class_list)
+            print G+'[*] top-{} references: \t{}'.format(args.top_k, ', '.join(references))+W
+
+        Data = registration(subject_folder = subject_FOLDER, output_folder=output_FOLDER, imgFilename=image_FILE, segFilename=seg_FILE, refdir=args.refs, classes=class_list, doBoth=1, workers=args.workers, bank=args.bank, references=references, writeTransforms=args.write_transforms, journal=journal_FILE, cache=args.cache, cacheBytes=cache_BYTES, timings=timings, profile=args.profile, roi=args.roi, stopping=stopping, prefetch=args.prefetch, prefetchBytes=int(args.prefetch_mb * 2**20), writeQueue=args.write_queue, outputs=args.outputs, codec=args.codec, cascade=cascade, pool=worker_POOL)
     except (KeyboardInterrupt, SystemExit):
         raise
-    except:
+    except Exception as e:
+        print(e)
         os.makedirs(os.path.join(output_FOLDER, 'exception'))
+        lease.failed(str(e))
+        sys.stdout.write(timings.endSubject())
         continue
 
+##### CHECK: DO WE STILL HOLD THE LEASE?  #####
+# If the subject was reclaimed by another worker (e.g. this one stalled past --lease-timeout), its results are left to that worker
+    if lease.lost or not lease.owned():
+        print R+'[*] Lease lost - not saving subject: {}'.format(subject_NAME)+W
+        lease.release()
+        sys.stdout.write(timings.endSubject())
+        continue
+
+# The .mat is assembled from the journal: Data holds every reference of the journal, in reference order
 # To recalculate GT metrics after RCA ###
     # print datafile
     # Data_ = scipy.io.loadmat(datafile)
@@ -200,57 +457,54 @@ for subject, output_FOLDER in zip(subjectList, outputList):
     #     continue
 
 ##### DISPLAY: OUTPUT SOME VISUALS AND STATISTICS FOR RCA   #####
-    DSCs = np.array([data[1] for data in Data])
-    MSDs = np.array([data[2] for data in Data])
-    RMSs = np.array([data[3] for data in Data])
-    HDs = np.array([data[4] for data in Data])
-
-    factor = 1 #to change the length of the distribution graph
-
-    if len(DSCs[:,-1])>=50:
-        factor = 2
-
-    sys.stdout.write('RCA DSC Distribution:\n')
-    sys.stdout.write('0.0 - 0.1:\t {:3d} {}\n'.format(len(DSCs[np.where( DSCs[:,-1]<0.1)]),'>'*(len(DSCs[np.where( DSCs[:,-1]<0.1)])/factor)))
-    sys.stdout.write('0.1 - 0.2:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.1) & (DSCs[:,-1]<0.2) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.1) & (DSCs[:,-1]<0.2) )])/factor)))
-    sys.stdout.write('0.2 - 0.3:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.2) & (DSCs[:,-1]<0.3) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.2) & (DSCs[:,-1]<0.3) )])/factor)))
-    sys.stdout.write('0.3 - 0.4:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.3) & (DSCs[:,-1]<0.4) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.3) & (DSCs[:,-1]<0.4) )])/factor)))
-    sys.stdout.write('0.4 - 0.5:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.4) & (DSCs[:,-1]<0.5) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.4) & (DSCs[:,-1]<0.5) )])/factor)))
-    sys.stdout.write('0.5 - 0.6:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.5) & (DSCs[:,-1]<0.6) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.5) & (DSCs[:,-1]<0.6) )])/factor)))
-    sys.stdout.write('0.6 - 0.7:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.6) & (DSCs[:,-1]<0.7) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.6) & (DSCs[:,-1]<0.7) )])/factor)))
-    sys.stdout.write('0.7 - 0.8:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.7) & (DSCs[:,-1]<0.8) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.7) & (DSCs[:,-1]<0.8) )])/factor)))
-    sys.stdout.write('0.8 - 0.9:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.8) & (DSCs[:,-1]<0.9) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.8) & (DSCs[:,-1]<0.9) )])/factor)))
-    sys.stdout.write('0.9 - 1.0:\t {:3d} {}\n\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.9) & (DSCs[:,-1]<=1.0))]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.9) & (DSCs[:,-1]<1.0) )])/factor)))
-    sys.stdout.flush()
-
-    sys.stdout.write('Predicted DSC:\t{}\tAtlas: {}\n'.format(np.max(DSCs[:,-1]), np.argmax(DSCs[:,-1])))
-    sys.stdout.write('Minimum MSD:\t{}\tAtlas: {}\n'.format(np.min(MSDs[:,-1]), np.argmin(MSDs[:,-1])))
-    sys.stdout.write('Minimum RMS:\t{}\tAtlas: {}\n'.format(np.min(RMSs[:,-1]), np.argmin(RMSs[:,-1])))
-    sys.stdout.write('Minimum HD:\t{}\tAtlas: {}\n\n'.format(np.min(HDs[:,-1]), np.argmin(HDs[:,-1])))
+# Every candidate segmentation has its own results (a single --seg is one candidate, named after the subject)
+    candidate_DATA = Data if seg_CANDIDATES else [Data]
+    for index, ((candidate_NAME, candidate_FILE), (result_NAME, journal, datafile)) in enumerate(zip(candidates, results)):
+        Data = candidate_DATA[index]
+        if candidate_NAME:
+            sys.stdout.write('Candidate segmentation: {}\n'.format(candidate_FILE))
+        DSCs = np.array([data[1] for data in Data])
+        MSDs = np.array([data[2] for data in Data])
+        RMSs = np.array([data[3] for data in Data])
+        HDs = np.array([data[4] for data in Data])
+
+        factor = 1 #to change the length of the distribution graph
+
+        if len(DSCs[:,-1])>=50:
+            factor = 2
+
+        sys.stdout.write('RCA DSC Distribution:\n')
+        sys.stdout.write('0.0 - 0.1:\t {:3d} {}\n'.format(len(DSCs[np.where( DSCs[:,-1]<0.1)]),'>'*(len(DSCs[np.where( DSCs[:,-1]<0.1)])/factor)))
+        sys.stdout.write('0.1 - 0.2:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.1) & (DSCs[:,-1]<0.2) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.1) & (DSCs[:,-1]<0.2) )])/factor)))
+        sys.stdout.write('0.2 - 0.3:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.2) & (DSCs[:,-1]<0.3) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.2) & (DSCs[:,-1]<0.3) )])/factor)))
+        sys.stdout.write('0.3 - 0.4:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.3) & (DSCs[:,-1]<0.4) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.3) & (DSCs[:,-1]<0.4) )])/factor)))
+        sys.stdout.write('0.4 - 0.5:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.4) & (DSCs[:,-1]<0.5) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.4) & (DSCs[:,-1]<0.5) )])/factor)))
+        sys.stdout.write('0.5 - 0.6:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.5) & (DSCs[:,-1]<0.6) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.5) & (DSCs[:,-1]<0.6) )])/factor)))
+        sys.stdout.write('0.6 - 0.7:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.6) & (DSCs[:,-1]<0.7) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.6) & (DSCs[:,-1]<0.7) )])/factor)))
+        sys.stdout.write('0.7 - 0.8:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.7) & (DSCs[:,-1]<0.8) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.7) & (DSCs[:,-1]<0.8) )])/factor)))
+        sys.stdout.write('0.8 - 0.9:\t {:3d} {}\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.8) & (DSCs[:,-1]<0.9) )]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.8) & (DSCs[:,-1]<0.9) )])/factor)))
+        sys.stdout.write('0.9 - 1.0:\t {:3d} {}\n\n'.format(len(DSCs[np.where( (DSCs[:,-1]>=0.9) & (DSCs[:,-1]<=1.0))]), '>'*(len(DSCs[np.where( (DSCs[:,-1]>=0.9) & (DSCs[:,-1]<1.0) )])/factor)))
+        sys.stdout.flush()
+
+        sys.stdout.write('Predicted DSC:\t{}\tAtlas: {}\n'.format(np.max(DSCs[:,-1]), np.argmax(DSCs[:,-1])))
+        sys.stdout.write('Minimum MSD:\t{}\tAtlas: {}\n'.format(np.min(MSDs[:,-1]), np.argmin(MSDs[:,-1])))
+        sys.stdout.write('Minimum RMS:\t{}\tAtlas: {}\n'.format(np.min(RMSs[:,-1]), np.argmin(RMSs[:,-1])))
+        sys.stdout.write('Minimum HD:\t{}\tAtlas: {}\n\n'.format(np.min(HDs[:,-1]), np.argmin(HDs[:,-1])))
 
 
 ##### OUTPUT: PREPARE THE DATA FOR OUTPUT AND CALCULATE THE GT REAL METRICS IF POSSIBLE    #####
-    Datadict = {}
-    Datadict['ImageID'] = subject_NAME
-    Datadict['Classes'] = class_list
-
-    if args.GT:
-        realMetrics = getMetrics(sitk.GetArrayFromImage(sitk.ReadImage(subject_GT_FILE)), sitk.GetArrayFromImage(sitk.ReadImage(subject_seg_FILE)), ref_classes=[0,1,2,4])
-        sys.stdout.write('Real DSC: \t{}\n\n'.format(realMetrics[0][-1]))
-        sys.stdout.flush()    
-
-    for ref in Data:
-        Datadict['Ref{}'.format(ref[0])] = ref[1:]
-
-    RefData = np.array([Datadict[ref] for ref in Datadict.keys() if 'Ref' in ref])
-    maxs = [np.max(RefData, axis=0), np.argmax(RefData, axis=0)+1]
-    mins = [np.min(RefData, axis=0), np.argmin(RefData, axis=0)+1]
-    Datadict['MaxMetrics'] = np.concatenate([np.reshape(np.array(maxs)[:,0,:], [2,1,5]), np.array(mins)[:,1:,:]], axis=1).transpose(1,2,0)
-
-    if args.GT:
-        Datadict['GTMetrics'] = realMetrics
-    
-    scipy.io.savemat(datafile, Datadict)
+        realMetrics = None
+        if args.GT:
+            with timings.stage('gt_metrics'):
+                subject_GT = sitk.ReadImage(subject_GT_FILE)
+                realMetrics = getMetrics(sitk.GetArrayFromImage(subject_GT), sitk.GetArrayFromImage(sitk.ReadImage(candidate_FILE)), ref_classes=[0,1,2,4], sampling=subject_GT.GetSpacing()[::-1])
+            sys.stdout.write('Real DSC: \t{}\n\n'.format(realMetrics[0][-1]))
+            sys.stdout.flush()    
+
+        with timings.stage('save'):
+            copier.flush()
+            saveResults(result_NAME, datafile, Data, realMetrics, stopping.record() if stopping else None, cascade.record(index if seg_CANDIDATES else None) if cascade else None)
+    lease.done(sorted(set(saved_RESULTS or []) | set(result_NAME for result_NAME, journal, datafile in results)))
  
  ##### TIME: CALCULATE AND DISPLAY TIME FOR ANALYSIS    #####
     t1      = time.time()
@@ -259,7 +513,12 @@ for subject, output_FOLDER in zip(subjectList, outputList):
     mins = (elapsed-(3600*hours))//60 
     secs = (elapsed-(3600*hours)-(mins*60))
     sys.stdout.write('Elapsed Time: {:02d}h {:02d}m {:02d}s\n\n'.format(int(hours), int(mins), int(secs)))
+    sys.stdout.write(timings.endSubject() + '\n')
     sys.stdout.flush()
     #time.sleep(5)
 
+if worker_POOL:
+    worker_POOL.close()
+if timings.subjects > 1:
+    sys.stdout.write(timings.summary())
 sys.exit(0)
\ No newline at end of file
@@ -0,0 +1,207 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import SimpleITK as sitk
+
+### A reference bank is a one-off, uncompressed copy of the reference folder:
+###	<bank>/<reference>/lvsa_ED.npy			- the reference image as a raw numpy array
+###	<bank>/<reference>/segmentation_ED.npy		- the reference segmentation as a raw numpy array
+###	<bank>/manifest.json				- spacing, origin, direction and checksums of every array
+### Arrays are memory-mapped when read, so no gzip decoding is done per subject and the pages are shared
+### between all the processes on a node. SimpleITK cannot wrap a NumPy buffer, so read() copies the pixels it returns:
+### NumPy consumers use array() (no copy), and read() can copy only a region of the array (e.g. the ROI of --roi).
+
+REFERENCE_FILES = [('image', 'lvsa_ED.nii.gz'), ('seg', 'segmentation_ED.nii.gz')]
+
+def sha1(filename, blocksize=1<<20):
+	### Function to compute the SHA1 checksum of a file without reading it all into memory ###
+	digest = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for block in iter(lambda: f.read(blocksize), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def _writeJSON(filename, content):
+	tmp = filename + '.tmp'
+	with open(tmp, 'w') as f:
+		json.dump(content, f, indent=1, sort_keys=True)
+	os.rename(tmp, filename)
+
+def _sourceStat(filename):
+	st = os.stat(filename)
+	return st.st_size, st.st_mtime
+
+
+class ReferenceBank(object):
+	### Read access to a compiled reference bank ###
+	### Inputs:
+	### bank_folder		= the folder written by compileBank()
+
+	def __init__(self, bank_folder):
+		self.bank_folder = os.path.abspath(bank_folder)
+		with open(os.path.join(self.bank_folder, 'manifest.json'), 'r') as f:
+			self.manifest = json.load(f)
+
+	def names(self):
+		### Returns - the reference names in the same order as sorted(os.listdir(refdir)) ###
+		return sorted(self.manifest['references'].keys())
+
+	def source(self, name, kind):
+		### Returns - the original .nii.gz file of a reference image ('image') or segmentation ('seg') ###
+		return self.manifest['references'][name][kind]['source']
+
+	def stale(self):
+		### Function to find the entries whose source files changed (or disappeared) since the bank was compiled ###
+		### Returns - list of reference names
+		stale = []
+		for name in self.names():
+			for kind, _ in REFERENCE_FILES:
+				entry = self.manifest['references'][name][kind]
+				try:
+					size, mtime = _sourceStat(entry['source'])
+				except OSError:
+					stale.append(name)
+					break
+				if size != entry['size'] or mtime != entry['mtime']:
+					stale.append(name)
+					break
+		return stale
+
+	def verify(self):
+		### Function to check every array against the checksum in the manifest (reads the whole bank) ###
+		### Returns - list of reference names whose arrays are missing or corrupted
+		corrupted = []
+		for name in self.names():
+			for kind, _ in REFERENCE_FILES:
+				entry = self.manifest['references'][name][kind]
+				filename = os.path.join(self.bank_folder, entry['file'])
+				if not os.path.isfile(filename) or sha1(filename) != entry['sha1']:
+					corrupted.append(name)
+					break
+		return corrupted
+
+	def array(self, name, kind):
+		### Returns - a read-only, memory-mapped view of the array (no copy, no decompression) ###
+		entry = self.manifest['references'][name][kind]
+		return np.load(os.path.join(self.bank_folder, entry['file']), mmap_mode='r')
+
+	def spacing(self, name, kind):
+		### Returns - the voxel spacing of a reference image or segmentation, in image (x, y, z) order ###
+		return self.manifest['references'][name][kind]['spacing']
+
+	def read(self, name, kind, box=None):
+		### Function to build a SimpleITK image from the bank - the replacement for sitk.ReadImage(source) ###
+		### Inputs:
+		### box 		= the (lower, upper) array indices of the region to read, in array (z, y, x) order (None = all):
+		###			  only the pages of that region are read and copied
+		entry 	= self.manifest['references'][name][kind]
+		array 	= self.array(name, kind)
+		origin 	= np.array(entry['origin'], dtype=np.float64)
+		if box is not None:
+			lower, upper = box
+			array 	= array[tuple(slice(l, u) for l, u in zip(lower, upper))]
+			# The origin of the region: the physical point of its first voxel (as sitk.RegionOfInterest)
+			direction 	= np.reshape(entry['direction'], (len(origin), len(origin)))
+			origin 		= origin + np.dot(direction, np.array(lower[::-1]) * np.array(entry['spacing']))
+		image = sitk.GetImageFromArray(array)
+		image.SetSpacing(entry['spacing'])
+		image.SetOrigin([float(o) for o in origin])
+		image.SetDirection(entry['direction'])
+		return image
+
+
+def compileBank(refdir, bank_folder, maxreferences=None):
+	### Function to compile (or update) a reference bank from a reference folder ###
+	### Inputs:
+	### refdir		= the directory containing all reference subjects (each in their own directories)
+	### bank_folder		= the directory to store the bank
+	### maxreferences 	= the number of reference images to compile (default all)
+	### Only references that are new or whose source files changed are decoded again
+	### Returns - the list of reference names that were (re)compiled
+	refdir 		= os.path.abspath(refdir)
+	bank_folder = os.path.abspath(bank_folder)
+	manifest_file = os.path.join(bank_folder, 'manifest.json')
+	if os.path.isfile(manifest_file):
+		with open(manifest_file, 'r') as f:
+			manifest = json.load(f)
+	else:
+		manifest = {'references': {}}
+
+	folders 	= sorted(os.listdir(refdir))[:maxreferences]
+	compiled 	= []
+
+	# Forget the references that are no longer in refdir, and remove their arrays
+	for name in list(manifest['references'].keys()):
+		if name not in folders:
+			del manifest['references'][name]
+			shutil.rmtree(os.path.join(bank_folder, name), ignore_errors=True)
+
+	for name in folders:
+		entries = manifest['references'].get(name, {})
+		if all(kind in entries and _sourceStat(os.path.join(refdir, name, filename)) == (entries[kind]['size'], entries[kind]['mtime'])
+			and os.path.isfile(os.path.join(bank_folder, entries[kind]['file'])) for kind, filename in REFERENCE_FILES):
+			continue
+
+		if not os.path.exists(os.path.join(bank_folder, name)):
+			os.makedirs(os.path.join(bank_folder, name))
+		entries = {}
+		for kind, filename in REFERENCE_FILES:
+			source 	= os.path.join(refdir, name, filename)
+			image 	= sitk.ReadImage(source)
+			arrayfile = os.path.join(name, filename.split('.')[0] + '.npy')
+			tmp 	= os.path.join(bank_folder, arrayfile + '.tmp')
+			with open(tmp, 'wb') as f:
+				np.save(f, sitk.GetArrayFromImage(image))
+			os.rename(tmp, os.path.join(bank_folder, arrayfile))
+			size, mtime = _sourceStat(source)
+			entries[kind] = {
+				'file'		: arrayfile,
+				'source'	: source,
+				'size'		: size,
+				'mtime'		: mtime,
+				'sha1'		: sha1(os.path.join(bank_folder, arrayfile)),
+				'spacing'	: list(image.GetSpacing()),
+				'origin'	: list(image.GetOrigin()),
+				'direction'	: list(image.GetDirection()),
+				}
+		manifest['references'][name] = entries
+		compiled.append(name)
+		sys.stdout.write('[*] Compiled reference: {}\n'.format(name))
+		sys.stdout.flush()
+
+	_writeJSON(manifest_file, manifest)
+	return compiled
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compile a folder of [reference images] into a memory-mappable reference bank')
+	parser.add_argument('--refs', type=str, required=True)
+	parser.add_argument('--bank', type=str, required=True)
+	parser.add_argument('--maxreferences', type=int, default=None)
+	parser.add_argument('--verify', action='store_true')
+	args = parser.parse_args()
+
+	if args.verify:
+		bank = ReferenceBank(args.bank)
+		stale, corrupted = bank.stale(), bank.verify()
+		sys.stdout.write('Stale references:\t{}\nCorrupted references:\t{}\n'.format(stale, corrupted))
+		sys.exit(1 if stale or corrupted else 0)
+
+	compiled = compileBank(args.refs, args.bank, maxreferences=args.maxreferences)
+	sys.stdout.write('{} references compiled into {}\n'.format(len(compiled), os.path.abspath(args.bank)))
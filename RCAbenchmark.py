@@ -0,0 +1,345 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import resource
+import tempfile
+import argparse
+import traceback
+import multiprocessing
+import numpy as np
+import SimpleITK as sitk
+try:
+	from Queue import Empty
+except ImportError:
+	from queue import Empty
+from scipy.ndimage import gaussian_filter, map_coordinates
+
+from RCAfunctions import dice, surfd, getMetrics, SubjectMetrics, registration, labelImage, _arrayView
+
+### Benchmark of the registration and metric stages on synthetic data - no patient data, no network, CPU only.
+### A cardiac-like phantom (LV cavity 1, LV myocardium 2, RV cavity 4) is generated along with smoothly deformed
+### copies used as references. Every stage runs in its own process so that its peak memory can be measured.
+###
+### python RCAbenchmark.py --shape 12 128 128 --references 20 --save baseline.json
+### python RCAbenchmark.py --shape 12 128 128 --references 20 --compare baseline.json
+
+CLASSES = [0, 1, 2, 4]
+
+def phantom(shape=(12, 128, 128), spacing=(1.8, 1.8, 8.0), seed=0):
+	### Function to generate a synthetic short-axis cardiac image and segmentation ###
+	### Inputs:
+	### shape 		= the array shape (z, y, x)
+	### spacing 		= the voxel spacing (x, y, z) in mm
+	### seed 		= seed of the random position, size and noise
+	### Returns - (image, segmentation) as SimpleITK images
+	rng 	= np.random.RandomState(seed)
+	grid 	= np.indices(shape).astype(np.float32)
+	mm 		= [g * s for g, s in zip(grid, spacing[::-1])]
+	centre 	= [n * s / 2.0 + rng.uniform(-5, 5) for n, s in zip(shape, spacing[::-1])]
+	radius 	= rng.uniform(18, 24)
+
+	# LV: ellipsoid cavity inside a myocardial shell, elongated along the long (z) axis
+	lv 		= np.sqrt(((mm[0] - centre[0]) / 2.5)**2 + (mm[1] - centre[1])**2 + (mm[2] - centre[2])**2)
+	# RV: crescent next to the LV
+	rv 		= np.sqrt(((mm[0] - centre[0]) / 2.5)**2 + (mm[1] - centre[1])**2 + (mm[2] - centre[2] - 1.6 * radius)**2)
+
+	seg 	= np.zeros(shape, np.uint8)
+	seg[(rv < 1.3 * radius) & (lv >= 1.4 * radius)] = 4
+	seg[lv < 1.4 * radius] = 2
+	seg[lv < radius] = 1
+
+	image 	= np.choose(np.searchsorted([1, 2, 4], seg), [20.0, 200.0, 80.0, 180.0]).astype(np.float32)
+	image 	= gaussian_filter(image, 1.0) + rng.normal(0, 10, shape)
+	image 	*= 1 + 0.2 * gaussian_filter(rng.normal(0, 1, shape), 8)	# smooth intensity bias
+
+	return _toImage(image.astype(np.float32), spacing), _toImage(seg, spacing)
+
+def deform(image, seg, magnitude=4.0, seed=0):
+	### Function to make a "reference" from a phantom with a smooth random deformation and a small translation ###
+	### Returns - (image, segmentation) as SimpleITK images
+	rng 	= np.random.RandomState(seed)
+	array 	= sitk.GetArrayFromImage(image)
+	labels 	= sitk.GetArrayFromImage(seg)
+	grid 	= np.indices(array.shape).astype(np.float32)
+	for axis, g in enumerate(grid):
+		field = gaussian_filter(rng.normal(0, 1, array.shape), [1, 8, 8])
+		scale = magnitude / (np.abs(field).max() or 1.0) / (4 if axis == 0 else 1)
+		g += field * scale + rng.uniform(-2, 2) * (axis > 0)
+	warped_image 	= map_coordinates(array, grid, order=1, mode='nearest').astype(np.float32)
+	warped_seg 		= map_coordinates(labels, grid, order=0, mode='nearest').astype(np.uint8)
+	return _toImage(warped_image, image.GetSpacing()), _toImage(warped_seg, seg.GetSpacing())
+
+def _toImage(array, spacing):
+	image = sitk.GetImageFromArray(array)
+	image.SetSpacing(tuple(float(s) for s in spacing))
+	return image
+
+def _dataset(options):
+	### Returns - the subject (image, seg) and the list of reference (image, seg) for the options
+	subject 	= phantom(options['shape'], options['spacing'], seed=options['seed'])
+	references 	= []
+	for i in range(options['references']):
+		base = phantom(options['shape'], options['spacing'], seed=options['seed'] + 1 + i)
+		references.append(deform(base[0], base[1], seed=options['seed'] + 1000 + i))
+	return subject, references
+
+
+### Stages - each gets the dataset and returns the number of references it processed
+
+def _stageDice(subject, references, options):
+	subject_seg = sitk.GetArrayFromImage(subject[1])
+	for image, seg in references:
+		ref_seg = sitk.GetArrayFromImage(seg)
+		for label in CLASSES:
+			dice(subject_seg==label, ref_seg==label)
+		dice(subject_seg>0, ref_seg>0)
+	return len(references)
+
+def _stageSurfd(subject, references, options):
+	subject_seg = sitk.GetArrayFromImage(subject[1])
+	sampling 	= subject[1].GetSpacing()[::-1]
+	for image, seg in references:
+		ref_seg = sitk.GetArrayFromImage(seg)
+		for label in CLASSES:
+			surfd(subject_seg==label, ref_seg==label, sampling=sampling)
+		surfd(subject_seg, ref_seg, sampling=sampling)
+	return len(references)
+
+def _stageGetMetrics(subject, references, options):
+	subject_seg = sitk.GetArrayFromImage(subject[1])
+	sampling 	= subject[1].GetSpacing()[::-1]
+	for image, seg in references:
+		getMetrics(subject_seg, sitk.GetArrayFromImage(seg), subject_classes=CLASSES, ref_classes=CLASSES, sampling=sampling)
+	return len(references)
+
+def _stageSubjectMetrics(subject, references, options):
+	### The label arrays are uint8 views of the images, as in registration() - the images are kept while their views are used
+	subject_seg = labelImage(subject[1])
+	metrics 	= SubjectMetrics(_arrayView(subject_seg), subject_classes=CLASSES, sampling=subject[1].GetSpacing()[::-1])
+	for image, seg in references:
+		ref_seg = labelImage(seg)
+		metrics(_arrayView(ref_seg), CLASSES)
+	return len(references)
+
+def _stageRegistration(subject, references, options):
+	### Runs registration() on the phantoms written to a temporary subject folder and reference folder
+	if not hasattr(sitk, 'ElastixImageFilter'):
+		return None
+	root = tempfile.mkdtemp(prefix='RCAbenchmark')
+	try:
+		os.makedirs(os.path.join(root, 'subject'))
+		sitk.WriteImage(subject[0], os.path.join(root, 'subject', 'image.nii.gz'))
+		sitk.WriteImage(subject[1], os.path.join(root, 'subject', 'segmentation.nii.gz'))
+		for i, (image, seg) in enumerate(references):
+			folder = os.path.join(root, 'refs', 'ref{:04d}'.format(i))
+			os.makedirs(folder)
+			sitk.WriteImage(image, os.path.join(folder, 'lvsa_ED.nii.gz'))
+			sitk.WriteImage(seg, os.path.join(folder, 'segmentation_ED.nii.gz'))
+		start = time.time()
+		registration(os.path.join(root, 'subject'), os.path.join(root, 'output'), 'image.nii.gz', 'segmentation.nii.gz',
+			maxreferences=len(references), refdir=os.path.join(root, 'refs'), classes=CLASSES, doBoth=options['doBoth'], workers=options['workers'], roi=options['roi'])
+		return len(references), time.time() - start
+	finally:
+		shutil.rmtree(root, ignore_errors=True)
+
+STAGES = [
+	('dice', 			_stageDice),
+	('surfd', 			_stageSurfd),
+	('getMetrics', 		_stageGetMetrics),
+	('SubjectMetrics', 	_stageSubjectMetrics),
+	('registration', 	_stageRegistration),
+	]
+
+# Memory budget of the metric stages: the growth of the peak memory while the stage runs, in float32 volumes of the
+# phantom, plus MEMORY_SLACK MB. A stage over its budget is reported on every run, with or without a baseline.
+MEMORY_BUDGET 	= {'dice': 2, 'surfd': 12, 'getMetrics': 16, 'SubjectMetrics': 16}
+MEMORY_SLACK 	= 16.0
+
+def _peakRSS():
+	### Returns - the peak resident set size of this process in MB (ru_maxrss is in kB on Linux)
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _runStage(name, options, results):
+	### Runs one stage in this (child) process and puts its measurements (or {'error': message}) in the results queue
+	try:
+		_measureStage(name, options, results)
+	except Exception as e:
+		traceback.print_exc()
+		results.put({'error': '{}: {}'.format(type(e).__name__, e)})
+
+def _measureStage(name, options, results):
+	subject, references = _dataset(options)
+	baseline_rss 		= _peakRSS()
+	best 				= None
+	for repeat in range(options['repeat']):
+		start 	= time.time()
+		count 	= dict(STAGES)[name](subject, references, options)
+		elapsed = time.time() - start
+		if count is None:
+			results.put(None)
+			return
+		if isinstance(count, tuple):	# the stage timed itself (excluding its set-up)
+			count, elapsed = count
+		best = elapsed if best is None else min(best, elapsed)
+	voxels = int(np.prod(options['shape'])) * count
+	results.put({
+		'seconds' 			: best,
+		'references' 		: count,
+		'references_per_s' 	: count / best if best else float('inf'),
+		'voxels_per_s' 		: voxels / best if best else float('inf'),
+		'peak_rss_mb' 		: _peakRSS(),
+		'dataset_rss_mb' 	: baseline_rss,
+		'stage_rss_mb' 		: max(_peakRSS() - baseline_rss, 0.0),
+		})
+
+def _stageResult(process, results, poll=1.0):
+	### Returns - what the stage process put in the results queue, or an error record if it exited without a result (e.g. killed)
+	while True:
+		try:
+			return results.get(timeout=poll)
+		except Empty:
+			if process.exitcode is not None:
+				try:
+					return results.get(timeout=poll)	# put just before it exited
+				except Empty:
+					return {'error': 'the stage process exited with code {}'.format(process.exitcode)}
+
+def runBenchmark(options, stages=None, failures=None):
+	### Function to run the benchmark stages ###
+	### Inputs:
+	### options 		= dictionary with shape, spacing, references, repeat, seed, doBoth, workers and roi
+	### stages 		= names of the stages to run (default all)
+	### failures 		= list the (stage name, error message) of the stages that failed are appended to, or None
+	### Returns - dictionary of stage name -> measurements (stages that cannot run here or failed are left out)
+	report = {}
+	for name, _ in STAGES:
+		if stages and name not in stages:
+			continue
+		results = multiprocessing.Queue()
+		process = multiprocessing.Process(target=_runStage, args=(name, options, results))
+		process.start()
+		result = _stageResult(process, results)
+		process.join()
+		if result is None:
+			sys.stdout.write('{:<16}skipped (SimpleITK was built without SimpleElastix)\n'.format(name))
+			continue
+		if 'error' in result:
+			sys.stdout.write('{:<16}FAILED - {}\n'.format(name, result['error']))
+			if failures is not None:
+				failures.append((name, result['error']))
+			continue
+		report[name] = result
+		sys.stdout.write('{:<16}{:9.3f} s\t{:9.2f} refs/s\t{:12.3e} voxels/s\t{:8.1f} MB peak\n'.format(
+			name, result['seconds'], result['references_per_s'], result['voxels_per_s'], result['peak_rss_mb']))
+		sys.stdout.flush()
+	return report
+
+def compareBaseline(report, baseline, tolerance=0.2):
+	### Function to compare a benchmark report with a saved baseline ###
+	### Inputs:
+	### report, baseline	= the 'stages' of two benchmark results
+	### tolerance 		= the relative slow-down (or growth of the memory used by the stage) accepted before a stage is a regression
+	### Returns - list of regression messages (empty if none)
+	regressions = []
+	for name in sorted(report):
+		if name not in baseline:
+			continue
+		speed 	= baseline[name]['seconds'] / report[name]['seconds'] if report[name]['seconds'] else float('inf')
+		memory 	= report[name]['peak_rss_mb'] / baseline[name]['peak_rss_mb']
+		if 'stage_rss_mb' in baseline[name]:
+			# the memory used by the stage itself, on top of the phantoms - less noisy than the peak of the process
+			memory = (report[name]['stage_rss_mb'] + 1.0) / (baseline[name]['stage_rss_mb'] + 1.0)
+		sys.stdout.write('{:<16}{:6.2f}x speed\t{:6.2f}x stage memory\n'.format(name, speed, memory))
+		if speed < 1.0 / (1.0 + tolerance):
+			regressions.append('{}: {:.2f}x slower than the baseline'.format(name, 1.0 / speed))
+		if memory > 1.0 + tolerance:
+			regressions.append('{}: {:.2f}x more memory than the baseline'.format(name, memory))
+	return regressions
+
+def checkMemory(report, options):
+	### Function to check the memory used by the stages against MEMORY_BUDGET ###
+	### Inputs:
+	### report 		= the 'stages' of a benchmark result
+	### options 		= the options it was run with (for the phantom shape)
+	### Returns - list of messages for the stages over their budget (empty if none)
+	volume_mb 	= np.prod(options['shape']) * 4 / 2.0**20
+	over 		= []
+	for name in sorted(report):
+		if name not in MEMORY_BUDGET:
+			continue
+		budget = MEMORY_BUDGET[name] * volume_mb + MEMORY_SLACK
+		if report[name]['stage_rss_mb'] > budget:
+			over.append('{}: {:.1f} MB, over its budget of {:.1f} MB ({} volumes of {:.1f} MB + {:.0f} MB)'.format(
+				name, report[name]['stage_rss_mb'], budget, MEMORY_BUDGET[name], volume_mb, MEMORY_SLACK))
+	return over
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the RCA registration and metric stages on synthetic phantoms')
+	parser.add_argument('--shape', type=int, nargs=3, default=[12, 128, 128], help='array shape (z y x)')
+	parser.add_argument('--spacing', type=float, nargs=3, default=[1.8, 1.8, 8.0], help='voxel spacing (x y z) in mm')
+	parser.add_argument('--references', type=int, default=20)
+	parser.add_argument('--repeat', type=int, default=3, help='the best of this many runs is reported')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--stages', type=str, nargs='+', default=None, choices=[name for name, _ in STAGES])
+	parser.add_argument('--doBoth', type=int, default=1)
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--roi', type=float, default=None, help='ROI margin (mm) of the registration stage')
+	parser.add_argument('--save', type=str, default=None, help='write the results as a JSON baseline')
+	parser.add_argument('--compare', type=str, default=None, help='compare the results with a JSON baseline')
+	parser.add_argument('--tolerance', type=float, default=0.2)
+	args = parser.parse_args()
+
+	options = {
+		'shape'		: tuple(args.shape),
+		'spacing'	: tuple(args.spacing),
+		'references': args.references,
+		'repeat'	: args.repeat,
+		'seed'		: args.seed,
+		'doBoth'	: args.doBoth,
+		'workers'	: args.workers,
+		'roi'		: args.roi,
+		}
+	sys.stdout.write('RCA benchmark: {} phantom, {} references, best of {}\n'.format('x'.join(str(n) for n in args.shape), args.references, args.repeat))
+	failures = []
+	report = runBenchmark(options, args.stages, failures)
+	over = checkMemory(report, options)
+	for message in over:
+		sys.stdout.write('OVER BUDGET - {}\n'.format(message))
+
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump({
+				'machine' 	: {'host': socket.gethostname(), 'platform': platform.platform(), 'python': platform.python_version(), 'cpus': multiprocessing.cpu_count()},
+				'time' 		: time.time(),
+				'options' 	: options,
+				'stages' 	: report,
+				}, f, indent=1, sort_keys=True)
+		sys.stdout.write('Baseline saved to {}\n'.format(args.save))
+
+	if args.compare:
+		with open(args.compare, 'r') as f:
+			baseline = json.load(f)
+		if baseline['options'] != json.loads(json.dumps(options)):
+			sys.stdout.write('Warning: the baseline was run with other options: {}\n'.format(baseline['options']))
+		regressions = compareBaseline(report, baseline['stages'], args.tolerance)
+		for regression in regressions:
+			sys.stdout.write('REGRESSION - {}\n'.format(regression))
+		sys.exit(1 if regressions or failures or over else 0)
+	sys.exit(1 if failures or over else 0)
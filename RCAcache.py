@@ -0,0 +1,174 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import SimpleITK as sitk
+
+from RCAbank import sha1
+
+### Content-addressed cache of registration results.
+### A subject-to-reference registration only depends on the two images and the Elastix parameter maps, so its
+### transform parameter maps can be reused by any later run on the same image (e.g. to test a new segmentation):
+###	<cache>/<parameter maps hash>/<sha1(subject image hash + reference image hash)>/TransformParameters.<i>.txt
+### Entries are used in least-recently-used order; entries made with other parameter maps are evicted first (the rigid
+### and the rigid + B-spline maps of a cascade can both be current, see live).
+### <cache>/hashes holds the checksums of already hashed files, keyed by path, size and modification time.
+
+def parameterMapsHash(parameterMaps):
+	### Returns - a checksum of the content of an Elastix parameter map (or vector of maps)
+	if not hasattr(parameterMaps, '__len__') or hasattr(parameterMaps, 'keys'):
+		parameterMaps = [parameterMaps]
+	digest = hashlib.sha1()
+	for i in range(len(parameterMaps)):
+		parameterMap = parameterMaps[i]
+		for key in sorted(parameterMap.keys()):
+			digest.update('{} {}\n'.format(key, ' '.join(parameterMap[key])).encode('utf-8'))
+		digest.update(b'\n')
+	return digest.hexdigest()
+
+
+class RegistrationCache(object):
+	### Inputs:
+	### cache_folder	= the folder holding the cache (can be shared between workers)
+	### parameterMaps	= the Elastix parameter map(s) used for the registrations
+	### maxbytes		= the size above which evict() removes the least recently used entries (None = unbounded)
+	### live 		= other parameter map(s) whose entries are current too and are neither evicted first nor
+	###			  invalidated (e.g. the other tier of a cascade)
+
+	def __init__(self, cache_folder, parameterMaps, maxbytes=None, live=()):
+		self.cache_folder 	= os.path.abspath(cache_folder)
+		self.parameters 	= parameterMapsHash(parameterMaps)
+		self.live 			= set([self.parameters] + [parameterMapsHash(maps) for maps in live])
+		self.folder 		= os.path.join(self.cache_folder, self.parameters)
+		self.maxbytes 		= maxbytes
+		for folder in [self.folder, os.path.join(self.cache_folder, 'hashes')]:
+			if not os.path.exists(folder):
+				try:
+					os.makedirs(folder)
+				except OSError:
+					pass	# created by another worker in the meantime
+
+	def fileHash(self, filename):
+		### Returns - the SHA1 of a file, only read again if its size or modification time changed
+		filename 	= os.path.abspath(filename)
+		st 			= os.stat(filename)
+		memo 		= os.path.join(self.cache_folder, 'hashes', hashlib.sha1(filename.encode('utf-8')).hexdigest())
+		try:
+			with open(memo, 'r') as f:
+				entry = json.load(f)
+			if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+				return entry['sha1']
+		except (IOError, OSError, ValueError, KeyError):
+			pass
+		entry = {'file': filename, 'size': st.st_size, 'mtime': st.st_mtime, 'sha1': sha1(filename)}
+		tmp = '{}.{}.tmp'.format(memo, os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump(entry, f)
+		os.rename(tmp, memo)
+		return entry['sha1']
+
+	def key(self, fixed_hash, moving_hash):
+		### Returns - the cache key of the registration of a moving image onto a fixed image (given their hashes)
+		return hashlib.sha1('{}:{}'.format(fixed_hash, moving_hash).encode('utf-8')).hexdigest()
+
+	def get(self, key):
+		### Returns - the transform parameter maps stored under key (as a VectorOfParameterMap), or None
+		entry = os.path.join(self.folder, key)
+		try:
+			files = sorted(f for f in os.listdir(entry) if f.startswith('TransformParameters.'))
+			transformParameterMaps = sitk.VectorOfParameterMap()
+			for filename in files:
+				transformParameterMaps.append(sitk.ReadParameterFile(os.path.join(entry, filename)))
+			os.utime(entry, None)	# most recently used
+		except (IOError, OSError, RuntimeError):
+			return None
+		return transformParameterMaps if files else None
+
+	def put(self, key, transformParameterMaps):
+		### Function to store the transform parameter maps of a registration under key ###
+		entry 	= os.path.join(self.folder, key)
+		tmp 	= '{}.{}.tmp'.format(entry, os.getpid())
+		if not os.path.exists(tmp):
+			os.makedirs(tmp)
+		for i in range(len(transformParameterMaps)):
+			sitk.WriteParameterFile(transformParameterMaps[i], os.path.join(tmp, 'TransformParameters.{}.txt'.format(i)))
+		try:
+			os.rename(tmp, entry)
+		except OSError:
+			shutil.rmtree(tmp, ignore_errors=True)	# another worker stored the same registration first
+
+	def _entries(self):
+		### Returns - list of (stale, last use, size, folder) of every entry in the cache
+		entries = []
+		for parameters in os.listdir(self.cache_folder):
+			folder = os.path.join(self.cache_folder, parameters)
+			if parameters == 'hashes' or not os.path.isdir(folder):
+				continue
+			for key in os.listdir(folder):
+				if key.endswith('.tmp'):
+					continue	# being written
+				entry = os.path.join(folder, key)
+				try:
+					size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+					entries.append((parameters not in self.live, os.path.getmtime(entry), size, entry))
+				except OSError:
+					continue
+		return entries
+
+	def size(self):
+		### Returns - the total size of the entries in bytes
+		return sum(entry[2] for entry in self._entries())
+
+	def evict(self):
+		### Function to remove entries until the cache is below maxbytes - stale entries first, then least recently used ###
+		### Returns - the number of entries removed
+		if self.maxbytes is None:
+			return 0
+		entries = self._entries()
+		total 	= sum(entry[2] for entry in entries)
+		removed = 0
+		for stale, used, size, entry in sorted(entries, key=lambda entry: (not entry[0], entry[1])):
+			if total <= self.maxbytes:
+				break
+			shutil.rmtree(entry, ignore_errors=True)
+			total 	-= size
+			removed += 1
+		return removed
+
+	def invalidate(self):
+		### Function to remove every entry made with other parameter maps than this cache's (and the live ones) ###
+		for parameters in os.listdir(self.cache_folder):
+			if parameters != 'hashes' and parameters not in self.live and os.path.isdir(os.path.join(self.cache_folder, parameters)):
+				shutil.rmtree(os.path.join(self.cache_folder, parameters), ignore_errors=True)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Inspect or clear a registration cache')
+	parser.add_argument('--cache', type=str, required=True)
+	parser.add_argument('--clear', action='store_true')
+	args = parser.parse_args()
+
+	if args.clear:
+		shutil.rmtree(args.cache, ignore_errors=True)
+		sys.stdout.write('Cleared {}\n'.format(os.path.abspath(args.cache)))
+	else:
+		for parameters in sorted(os.listdir(args.cache)):
+			folder = os.path.join(args.cache, parameters)
+			if parameters != 'hashes' and os.path.isdir(folder):
+				keys = os.listdir(folder)
+				size = sum(os.path.getsize(os.path.join(folder, key, f)) for key in keys for f in os.listdir(os.path.join(folder, key)))
+				sys.stdout.write('{}\t{} entries\t{:.1f} MB\n'.format(parameters, len(keys), size / 2.0**20))
@@ -16,71 +16,156 @@ import time
 import os
 import numpy as np
 import subprocess
+import multiprocessing
+import json
+import shutil
+import tempfile
+import cProfile
+import multiprocessing.util
+from collections import OrderedDict
 
 from scipy.ndimage import morphology
 
+from RCAbank import ReferenceBank
+from RCAcache import RegistrationCache
+from RCAtiming import StageTimer
+from RCAio import Prefetcher, AsyncWriter, warmFile, imageExtension, CODECS, TEMPORARY
+
 def dice(A, B):
 	### Function to compute the Dice Similarity Coefficient (DSC) between two images ###
 	### Inputs:
 	### A, B 	= n-Dimensional numpy array
-	### Returns - DSC beween A and B (float)
-    intersection = np.logical_and(A, B)
-    return 2.0 * intersection.sum() / (A.sum() + B.sum())  
+	### Returns - DSC beween A and B (float) - 1.0 if both are empty
+	total = A.sum() + B.sum()
+	if not total:
+		return 1.0
+	intersection = np.logical_and(A, B)
+	return 2.0 * intersection.sum() / total
+
+def _border(input_, connnect):
+	### Returns - the voxels of the binary image input_ that are removed by one erosion with connnect (bool array)
+	return np.greater(input_, morphology.binary_erosion(input_, connnect))
+
+def _borderDistance(border, sampling):
+	### Returns - the distance from every voxel to the nearest voxel of border
+	return morphology.distance_transform_edt(border==0, sampling)
+
+def _labelArray(array):
+	### Returns - the array if it holds unsigned integers, a non-negative integer copy of it if its values are integers, or None
+	if array.dtype.kind == 'u':
+		return array
+	labels = array.astype(np.intp)
+	if not labels.size or labels.min() < 0 or not np.array_equal(labels, array):
+		return None
+	return labels
+
+def _bbox(input_):
+	### Returns - the bounding box of the non-zero voxels of input_ as a list of (start, stop) per axis, or None if empty
+	box = []
+	for axis in range(input_.ndim):
+		profile = np.any(input_, axis=tuple(a for a in range(input_.ndim) if a != axis))
+		if not profile.any():
+			return None
+		box.append((int(np.argmax(profile)), int(len(profile) - np.argmax(profile[::-1]))))
+	return box
+
+def _roi(box1, box2, shape, margin=1):
+	### Returns - the slices of the union of two bounding boxes plus a margin, clipped to shape
+	### A margin of 1 voxel keeps binary_erosion identical to the full grid, so the borders do not change
+	return tuple(slice(max(0, min(a[0], b[0]) - margin), min(n, max(a[1], b[1]) + margin)) for a, b, n in zip(box1, box2, shape))
 
-def surfd(input1, input2, sampling=1, connectivity=1):
+def _emptySurface(box1, box2):
+	### Returns - the surface distances when at least one of the masks is empty: 0 if both are, infinite otherwise
+	return np.zeros(1) if box1 is None and box2 is None else np.array([np.inf])
+
+def surfd(input1, input2, sampling=1, connectivity=1, crop=True):
 	### Function to compute the surface distance between two binary images ###
 	### Inputs:
 	### input1, input 2	= n-Dimensional numpy array
-	### sampling		= pixel-distance between samples. Variable for morphology.distance_transform_edt
+	### sampling		= pixel-distance between samples (the voxel spacing, in array axis order, for distances in mm).
+	###			  Variable for morphology.distance_transform_edt
 	### connectivity 	= number of neighbours for the morphology.binary_struction and binary_erosion functions
+	### crop 		= only compute the distance transforms inside the bounding box of both masks (same result, less work)
 	### Returns - n-Dimensional array showing the surface distance from B to A    
+	### If one mask is empty the distance is infinite, if both are empty it is 0
 
 	input_1 	= np.atleast_1d(input1.astype(np.bool))
 	input_2 	= np.atleast_1d(input2.astype(np.bool))
 
+	box1, box2 	= _bbox(input_1), _bbox(input_2)
+	if box1 is None or box2 is None:
+		return _emptySurface(box1, box2)
+	if crop:
+		roi 	= _roi(box1, box2, input_1.shape)
+		input_1 = input_1[roi]
+		input_2 = input_2[roi]
+
 	connnect 	= morphology.generate_binary_structure(input_1.ndim, connectivity)
 
-	input1_border 	= np.subtract(input_1.astype(np.int32), morphology.binary_erosion(input_1, connnect).astype(np.int32))
-	input2_border 	= np.subtract(input_2.astype(np.int32), morphology.binary_erosion(input_2, connnect).astype(np.int32))
+	input1_border 	= _border(input_1, connnect)
+	input2_border 	= _border(input_2, connnect)
 
-	dta 	  	= morphology.distance_transform_edt(~input1_border,sampling)
-	dtb 	  	= morphology.distance_transform_edt(~input2_border,sampling)
+	dta 	  	= _borderDistance(input1_border, sampling)
+	dtb 	  	= _borderDistance(input2_border, sampling)
 
 	sds 	  	= np.concatenate([np.ravel(dta[input2_border!=0]), np.ravel(dtb[input1_border!=0])])
 	return sds
 
+def _surfdBruteForce(input1, input2, sampling=1, connectivity=1):
+	### Function to compute surfd() without distance transforms - every border voxel against every other (small images only) ###
+	input_1 	= np.atleast_1d(input1.astype(np.bool))
+	input_2 	= np.atleast_1d(input2.astype(np.bool))
+	box1, box2 	= _bbox(input_1), _bbox(input_2)
+	if box1 is None or box2 is None:
+		return _emptySurface(box1, box2)
 
-def registration(subject_folder, output_folder, imgFilename, segFilename, maxreferences=100, refdir='/vol/biomedic/users/rdr16/RCA2017/registeredTrainingImgs', classes=[0,1,2,4], doBoth=1):
-	### Function to perform registration between N-reference images (+ segmentations) and a single fixed image ###
-	### Inputs:
-	### subject_folder	= the directory containing the fixed image
-	### output_folder	= the directory to store the output
-	### imgfilename 	= the filename of the fixed image
-	### segFilename 	= the filename of the fixed segmentation
-	### maxreferences 	= the number of reference images to register
-	### refdir		= the directory containing all reference subjects (each in their own directories)
-	### classes 		= the class numbers for the reference images (for the analysis)
-	### Returns - a dictionary of data with fields: Image_ID, classes + one field per reference image
-	newoutput_folder = os.path.join(output_folder, 'RCA', 'test', 'warped_imgs')
-	if not os.path.exists(newoutput_folder):
-		os.makedirs(newoutput_folder)
-	output_folder = os.path.join(output_folder, 'RCA')
+	connnect 	= morphology.generate_binary_structure(input_1.ndim, connectivity)
+	spacing 	= np.ones(input_1.ndim) * sampling
+	points_1 	= np.argwhere(_border(input_1, connnect)) * spacing
+	points_2 	= np.argwhere(_border(input_2, connnect)) * spacing
 
-	folders = sorted(os.listdir(refdir))[:maxreferences]
+	def nearest(points, targets):
+		return np.array([np.sqrt(((targets - point)**2).sum(axis=1).min()) for point in points])
+	return np.concatenate([nearest(points_2, points_1), nearest(points_1, points_2)])
 
-	refs 	= [os.path.join(refdir, f, 'lvsa_ED.nii.gz') for f in folders]
-	segs 	= [os.path.join(refdir, f, 'segmentation_ED.nii.gz') for f in folders]
+def validateSurfd(trials=20, shape=(10, 40, 40), seed=0):
+	### Function to check the cropped surfd() against the full-grid and the brute-force (pure NumPy) versions ###
+	### Inputs:
+	### trials 		= number of random pairs of masks to compare
+	### shape 		= the shape of the (isotropic) images
+	### seed 		= seed for the random masks
+	### Returns - True if MSD, RMS and HD agree for every pair (raises AssertionError otherwise)
+	rng = np.random.RandomState(seed)
+	for trial in range(trials):
+		inputs = []
+		for _ in range(2):
+			centre 	= rng.uniform(0.3, 0.7, len(shape)) * shape
+			radius 	= rng.uniform(0.1, 0.3) * min(shape)
+			grid 	= np.indices(shape).astype(np.float64)
+			inputs.append(np.sqrt(sum((g - c)**2 for g, c in zip(grid, centre))) < radius)
+		if trial % 5 == 4:
+			inputs[1][:] = False
+		distances = [surfd(inputs[0], inputs[1]), surfd(inputs[0], inputs[1], crop=False), _surfdBruteForce(inputs[0], inputs[1])]
+		metrics = [(sd.mean(), np.sqrt((sd**2).mean()), sd.max()) for sd in distances]
+		assert metrics[0] == metrics[1], 'Cropped surfd differs from full-grid surfd: {} {}'.format(metrics[0], metrics[1])
+		assert np.allclose(metrics[0], metrics[2], rtol=1e-12), 'surfd differs from the brute-force distances: {} {}'.format(metrics[0], metrics[2])
+	return True
 
-	subject_name 		= os.path.basename(subject_folder)
-	subject_image 		= os.path.join(subject_folder, imgFilename)
-	subject_seg 		= os.path.join(subject_folder, segFilename)
-	fixed_image_img		= sitk.ReadImage(subject_image, sitk.sitkFloat32)
-	fixed_image_seg		= sitk.ReadImage(subject_seg, sitk.sitkFloat32)
 
-	elastixImagefilter = sitk.ElastixImageFilter()
-	elastixImagefilter.SetOutputDirectory(output_folder)
-	elastixImagefilter.LogToConsoleOff()
+def readConfig(cfgfile):
+	### Function to read the variables of a config file (image_FILE, seg_FILE, class_list, ...) ###
+	### Returns - a dictionary of the variables defined in the file
+	config = {}
+	with open(cfgfile, 'r') as f:
+		exec(compile(f.read(), cfgfile, 'exec'), config)
+	config.pop('__builtins__', None)
+	return config
 
+def parameterMaps(elastixImagefilter):
+	### Function to build the Elastix parameter maps used for every reference ###
+	### Inputs:
+	### elastixImagefilter	= an ElastixImageFilter (used for the default parameter maps)
+	### Returns - the rigid parameter map and the rigid + B-spline parameter map vector
 	parameterMap_1 = elastixImagefilter.GetDefaultParameterMap('rigid')
 	parameterMap_1['Transform']									= ['EulerTransform']
 	parameterMap_1['AutomaticTransformInitialization'] 			= ["true"]
@@ -134,128 +219,1075 @@ def registration(subject_folder, output_folder, imgFilename, segFilename, maxref
 	parameterMapVector.append(parameterMap_1)
 	parameterMapVector.append(parameterMap)
 
-	progress_width=50
-	sys.stdout.write("RCA on {} with {} References\t\t\t{}\t{}\t{}\t{}\n".format(subject_name, len(refs), 'DSC', 'MSD', 'RMS', 'HD'))
-	sys.stdout.flush()
+	return parameterMap_1, parameterMapVector
 
-	Data = []
 
-	for idx, img in enumerate(refs):
+def _parameter(parameterMap, key, default=None):
+	### Returns - the values of an Elastix parameter as floats (or default if the parameter is not in the map)
+	if key not in parameterMap:
+		return default
+	return [float(value) for value in parameterMap[key]]
 
-		progress_done = int(progress_width*float(idx+1)/len(refs))
-		progress_todo = int(progress_width-progress_done)
-		if idx >0:
-			sys.stdout.write('\r')
-			sys.stdout.write('[' + '>'*(progress_done) + 'R' + '-'*(progress_todo) + ']\t'  \
-				'{:3.3f}\t{:3.3f}\t{:3.3f}\t{:3.3f}'.format(Data[-1][1][-1], Data[-1][2][-1], Data[-1][3][-1], Data[-1][4][-1]))
-			sys.stdout.flush()
+def elastixTransform(transformParameterMaps):
+	### Function to convert Elastix transform parameter maps into a single SimpleITK transform ###
+	### Inputs:
+	### transformParameterMaps	= the maps from ElastixImageFilter.GetTransformParameterMap(), in the order they were estimated
+	### Returns - a SimpleITK transform from fixed to moving image points, or None if a transform type is not supported
+	### Elastix composes its transforms as T(x) = T_n(...T_1(T_0(x))). A SimpleITK composite transform applies the
+	### last transform it was given first, so the maps are added in reverse order.
+	maps 		= [transformParameterMaps[i] for i in range(len(transformParameterMaps))]
+	dimension 	= int(maps[0]['FixedImageDimension'][0])
+	composite 	= sitk.Transform(dimension, sitk.sitkComposite)
+	for parameterMap in reversed(maps):
+		name 		= parameterMap['Transform'][0]
+		parameters 	= _parameter(parameterMap, 'TransformParameters')
+		if name == 'EulerTransform':
+			transform = sitk.Euler3DTransform() if dimension == 3 else sitk.Euler2DTransform()
+			transform.SetCenter(_parameter(parameterMap, 'CenterOfRotationPoint'))
+			if dimension == 3 and 'ComputeZYX' in parameterMap and parameterMap['ComputeZYX'][0] == 'true':
+				transform.SetComputeZYX(True)
+			transform.SetParameters(parameters)
+		elif name == 'AffineTransform':
+			transform = sitk.AffineTransform(dimension)
+			transform.SetCenter(_parameter(parameterMap, 'CenterOfRotationPoint'))
+			transform.SetParameters(parameters)
+		elif name == 'TranslationTransform':
+			transform = sitk.TranslationTransform(dimension, parameters)
+		elif name in ['BSplineTransform', 'RecursiveBSplineTransform']:
+			order 		= int(_parameter(parameterMap, 'BSplineTransformSplineOrder', [3])[0])
+			transform 	= sitk.BSplineTransform(dimension, order)
+			transform.SetFixedParameters(_parameter(parameterMap, 'GridSize') + _parameter(parameterMap, 'GridOrigin')
+				+ _parameter(parameterMap, 'GridSpacing') + _parameter(parameterMap, 'GridDirection'))
+			transform.SetParameters(parameters)
 		else:
-			sys.stdout.write('[' + '>'*(progress_done) + 'R' + '-'*(progress_todo) + ']')
-			sys.stdout.flush()
+			return None
+		composite.AddTransform(transform)
+	return composite
+
+def warpImage(image, fixed_image, transformParameterMaps, interpolator=sitk.sitkLinear):
+	### Function to warp an image with the result of a registration, in memory ###
+	### Inputs:
+	### image 			= the moving image as a SimpleITK image
+	### fixed_image		= the fixed image defining the output grid
+	### transformParameterMaps	= the maps from ElastixImageFilter.GetTransformParameterMap()
+	### interpolator 		= sitk.sitkLinear (float32 output, like the Elastix result image) or sitk.sitkNearestNeighbor (labels)
+	### Returns - the image resampled onto fixed_image (multithreaded)
+	labels 		= interpolator == sitk.sitkNearestNeighbor
+	transform 	= elastixTransform(transformParameterMaps)
+	if transform is not None:
+		return sitk.Resample(image, fixed_image, transform, interpolator, 0.0, image.GetPixelID() if labels else sitk.sitkFloat32)
+
+	# Transform types without a SimpleITK equivalent still go through Transformix, but without any files
+	# The output grid is that of fixed_image, which is not the grid the maps were estimated on after an ROI crop
+	transformixImageFilter = sitk.TransformixImageFilter()
+	for i in range(len(transformParameterMaps)):
+		transformixPMap = transformParameterMaps[i]
+		transformixPMap['ResampleInterpolator']	=	["FinalNearestNeighborInterpolator" if labels else "FinalLinearInterpolator"]
+		transformixPMap['Size']					=	[str(n) for n in fixed_image.GetSize()]
+		transformixPMap['Index']				=	['0'] * fixed_image.GetDimension()
+		transformixPMap['Origin']				=	[repr(x) for x in fixed_image.GetOrigin()]
+		transformixPMap['Spacing']				=	[repr(x) for x in fixed_image.GetSpacing()]
+		transformixPMap['Direction']			=	[repr(x) for x in fixed_image.GetDirection()]
+		transformixImageFilter.AddTransformParameterMap(transformixPMap)
+	transformixImageFilter.SetMovingImage(image)
+	transformixImageFilter.LogToConsoleOff()
+	return transformixImageFilter.Execute()
+
+# Views share the memory of the image (SimpleITK >= 1.1) - the image must outlive the view
+_arrayView = getattr(sitk, 'GetArrayViewFromImage', sitk.GetArrayFromImage)
+
+def labelImage(image):
+	### Function to store a segmentation as uint8 labels when its labels fit - a quarter of the memory of float32 ###
+	### Returns - the segmentation as a uint8 image, or unchanged if it is already uint8 or has labels outside 0..255
+	if image.GetPixelID() == sitk.sitkUInt8:
+		return image
+	minmax = sitk.MinimumMaximumImageFilter()
+	minmax.Execute(image)
+	if minmax.GetMinimum() < 0 or minmax.GetMaximum() > 255:
+		return image
+	return sitk.Cast(image, sitk.sitkUInt8)
+
+def cropToLabels(image, seg, margin):
+	### Function to crop an image to the bounding box of the labels of its segmentation plus a margin ###
+	### Inputs:
+	### image, seg 		= SimpleITK images on the same grid
+	### margin 		= the margin around the labels, in mm
+	### Returns - the cropped image (same physical space, smaller grid), or the image itself if the segmentation is empty
+	### or not on the grid of the image
+	if image.GetSize() != seg.GetSize():
+		return image
+	box = _labelBox(_arrayView(seg), image.GetSpacing(), margin)
+	if box is None:
+		return image
+	lower, upper = box
+	return sitk.RegionOfInterest(image, [u - l for l, u in zip(lower, upper)][::-1], lower[::-1])
+
+def _labelBox(labels, spacing, margin):
+	### Returns - the (lower, upper) array indices, in array (z, y, x) order, of the bounding box of the labels plus a margin
+	###	in mm (spacing in image (x, y, z) order), clipped to the array - or None if there are no labels
+	box = _bbox(labels > 0)
+	if box is None:
+		return None
+	pad 	= [int(np.ceil(margin / s)) for s in spacing[::-1]]
+	lower 	= [max(0, start - p) for (start, stop), p in zip(box, pad)]
+	upper 	= [min(n, stop + p) for (start, stop), p, n in zip(box, pad, labels.shape)]
+	return lower, upper
+
+def _labelUnion(segs, image):
+	### Returns - a uint8 image on the grid of image, 1 where any of the segmentations is labelled (the ROI of several
+	###	candidates). A segmentation on another grid is resampled onto it; the pixel types of the segmentations may differ.
+	union = np.zeros(image.GetSize()[::-1], dtype=np.uint8)
+	for seg in segs:
+		if seg.GetSize() != image.GetSize():
+			seg = sitk.Resample(seg, image, sitk.Transform(), sitk.sitkNearestNeighbor, 0, seg.GetPixelID())
+		union |= _arrayView(seg) > 0
+	union = sitk.GetImageFromArray(union)
+	union.CopyInformation(image)
+	return union
+
+def warpLabels(seg, fixed_image, transformParameterMaps):
+	### Function to warp a label map with the result of a registration, in memory ###
+	### Returns - the segmentation resampled onto fixed_image with (multithreaded) nearest-neighbour interpolation
+	return warpImage(seg, fixed_image, transformParameterMaps, sitk.sitkNearestNeighbor)
+
+
+# State of the current registration worker - filled by _initWorker once per process
+_worker = {}
+# The settings of registration() that describe the subject (see _setSubject)
+SUBJECT_KEYS = ['output_folder', 'subject_name', 'subject_image', 'subject_seg', 'writeTransforms', 'fixed_hash']
+
+def _initWorker(settings):
+	### Function to prepare a worker process for registering references to a single subject ###
+	### Inputs:
+	### settings		= dictionary of picklable settings built by registration()
+	_initProcess(settings)
+	# Only the subject keys: _initProcess() has turned the bank and cache folders of the settings into objects
+	_setSubject(dict((key, settings[key]) for key in SUBJECT_KEYS))
+
+def _initProcess(settings):
+	### Function to prepare the parts of a worker process that do not depend on the subject ###
+	### Inputs:
+	### settings		= dictionary of picklable settings (output_folder, doBoth, bank, cache, threads, profile, roi and,
+	###			  optionally, preload: a list of (reference name, image file, segmentation file) to keep in memory,
+	###			  writeQueue and writeBytes: the depth and memory cap of the background writes, 0 = synchronous,
+	###			  outputs and codec: the warped images written and how, see registration(), and elastix_folder:
+	###			  the folder the Elastix output directories are made in, removed by the caller - default output_folder)
+	### Each worker gets its own Elastix output directory so that TransformParameters files do not collide
+	if _worker.get('writer'):
+		_worker['writer'].close()
+	finalizer = _worker.get('finalizer')
+	_worker.clear()
+	_worker.update(settings)
+	# The queued writes are finished when the worker exits (pool.close(), or the end of the main process)
+	_worker['writer'] 	= AsyncWriter(settings.get('writeQueue', 0), settings.get('writeBytes'), settings.get('codec', 'gzip'))
+	_worker['outputs'] 	= settings.get('outputs', 'all')
+	_worker['finalizer']= finalizer
+	if finalizer != os.getpid():
+		multiprocessing.util.Finalize(None, _closeWriter, exitpriority=10)
+		_worker['finalizer'] = os.getpid()
+
+	worker_folder = os.path.join(settings.get('elastix_folder') or settings['output_folder'], 'worker{}'.format(os.getpid()))
+	if not os.path.exists(worker_folder):
+		os.makedirs(worker_folder)
+
+	if settings['threads']:
+		sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(settings['threads'])
+
+	elastixImagefilter = sitk.ElastixImageFilter()
+	elastixImagefilter.SetOutputDirectory(worker_folder)
+	elastixImagefilter.LogToConsoleOff()
+	if settings['threads'] and hasattr(elastixImagefilter, 'SetNumberOfThreads'):
+		elastixImagefilter.SetNumberOfThreads(settings['threads'])
+
+	parameterMap_1, parameterMapVector = parameterMaps(elastixImagefilter)
+	_worker['cache'] = RegistrationCache(settings['cache'], parameterMapVector if settings['doBoth'] else parameterMap_1, live=[parameterMap_1, parameterMapVector]) if settings['cache'] else None
+	if _worker['outputs'] != 'all':
+		# The warped intensity image is not written, so Elastix need not resample it (the transforms and cache keys are unchanged)
+		parameterMap_1, parameterMapVector = _withoutResultImage(parameterMap_1, parameterMapVector)
+
+	_worker['worker_folder']		= worker_folder
+	_worker['elastixImagefilter']	= elastixImagefilter
+	_worker['parameterMap_1']		= parameterMap_1
+	_worker['parameterMapVector']	= parameterMapVector
+	# The rigid stage of a rigid + B-spline registration, run on its own (see _register): its result image is never used
+	_worker['parameterMap_rigid']	= parameterMaps(elastixImagefilter)[0]
+	_worker['parameterMap_rigid']['WriteResultImage'] = ['false']
+	_worker['bank']					= ReferenceBank(settings['bank']) if settings['bank'] else None
+	_worker['profiler']				= cProfile.Profile() if settings['profile'] else None
+	_worker['preloaded']			= {}
+	for folder, img, seg in settings.get('preload', []):
+		_worker['preloaded'][(folder, 'image')] = _readReference(folder, img, 'image')
+		_worker['preloaded'][(folder, 'seg')] 	= _readReference(folder, seg, 'seg')
+
+def _withoutResultImage(parameterMap_1, parameterMapVector):
+	### Returns - copies of the parameter maps of parameterMaps() with WriteResultImage switched off
+	parameterMap_1['WriteResultImage'] = ['false']
+	maps = sitk.VectorOfParameterMap()
+	for i in range(len(parameterMapVector)):
+		parameterMap = parameterMapVector[i]
+		parameterMap['WriteResultImage'] = ['false']
+		maps.append(parameterMap)
+	return parameterMap_1, maps
+
+def _closeWriter():
+	if _worker.get('writer'):
+		_worker['writer'].close()
+
+def _setSubject(settings):
+	### Function to point a prepared worker process at a subject ###
+	### Inputs:
+	### settings		= dictionary with output_folder, subject_name, subject_image, subject_seg, writeTransforms and fixed_hash
+	###			  (subject_seg is a list of files for several candidate segmentations of the image)
+	_worker.update(settings)
+	_worker['subject']				= settings
+	_worker['fixed_image_img']		= sitk.ReadImage(settings['subject_image'], sitk.sitkFloat32)
+	# The subject side of the metrics is the same for every reference - prepare it once per worker
+	# Surface distances are measured in mm: the spacing is reversed into the (z, y, x) order of the arrays
+	# The segmentations are read once, as uint8, and the metrics use views of them rather than copies
+	seg_files 						= settings['subject_seg'] if isinstance(settings['subject_seg'], list) else [settings['subject_seg']]
+	fixed_image_segs 				= [labelImage(sitk.ReadImage(f)) for f in seg_files]
+	_worker['fixed_image_segs']		= fixed_image_segs	# the metrics hold views of these images
+	# With an ROI, Elastix only sees the region around the labels (of any candidate); the labels are still warped onto the full grid
+	_worker['fixed_image_reg']		= _worker['fixed_image_img']
+	if _worker.get('roi') is not None:
+		roi_seg = fixed_image_segs[0] if len(fixed_image_segs) == 1 else _labelUnion(fixed_image_segs, _worker['fixed_image_img'])
+		_worker['fixed_image_reg'] 	= cropToLabels(_worker['fixed_image_img'], roi_seg, _worker['roi'])
+	# The candidates share the scratch buffers of the first one - the metrics of one reference are computed one candidate at a time
+	_worker['metrics']				= []
+	for seg in fixed_image_segs:
+		_worker['metrics'].append(SubjectMetrics(_arrayView(seg), subject_classes=[0,1,2,4], sampling=seg.GetSpacing()[::-1],
+			scratch=_worker['metrics'][0] if _worker['metrics'] else None))
+
+def _readReference(folder, filename, kind):
+	### Function to read a reference image ('image') or segmentation ('seg') from memory (preloaded or prefetched), its file or, if filename is None, from the reference bank ###
+	if (folder, kind) in _worker.get('preloaded', {}):
+		return _worker['preloaded'][(folder, kind)]
+	if (folder, kind) in _worker.get('prefetched', {}):
+		return _worker['prefetched'].pop((folder, kind))
+	if filename is None:
+		bank 	= _worker['bank']
+		box 	= None
+		if kind == 'image' and _worker.get('roi') is not None and bank.array(folder, 'seg').shape == bank.array(folder, 'image').shape:
+			# Only the region Elastix sees is copied out of the memory-mapped bank (the same crop as cropToLabels,
+			# which then leaves the image as it is)
+			box = _labelBox(bank.array(folder, 'seg'), bank.spacing(folder, 'image'), _worker['roi'])
+		image = bank.read(folder, kind, box)
+	else:
+		image = sitk.ReadImage(filename)
+	return labelImage(image) if kind == 'seg' else image
+
+def _loadReference(job):
+	### Function to read the image and segmentation of a reference ahead of its registration (in a Prefetcher thread) ###
+	### Returns - dictionary of (reference name, 'image' or 'seg') -> image, as checked by _readReference()
+	folder, img, seg = job
+	loaded = {}
+	for kind, filename in [('image', img), ('seg', seg)]:
+		if (folder, kind) not in _worker.get('preloaded', {}):
+			loaded[(folder, kind)] = _readReference(folder, filename, kind)
+	return loaded
+
+def _warmReference(job):
+	### Function to read the files of a reference into the page cache ahead of its registration by a worker process ###
+	folder, img, seg = job
+	for filename in [img, seg]:
+		warmFile(filename)
+
+def subjectHash(registrationCache, image_file, seg_file, roi=None):
+	### Returns - the checksum identifying a subject in the registration cache - with an ROI, the crop depends on the segmentation
+	###	(or on every candidate segmentation, if seg_file is a list) too
+	if roi is None:
+		return registrationCache.fileHash(image_file)
+	seg_files = seg_file if isinstance(seg_file, list) else [seg_file]
+	return '{}:roi{}:{}'.format(registrationCache.fileHash(image_file), roi, ':'.join(registrationCache.fileHash(f) for f in seg_files))
+
+def _referenceHash(folder, filename):
+	### Returns - the checksum identifying a reference image in the registration cache
+	if filename is None:
+		return 'bank:' + _worker['bank'].manifest['references'][folder]['image']['sha1']
+	return _worker['cache'].fileHash(filename)
+
+def _registerReference(job, prefetched=None):
+	### Function to register one reference image (+ segmentation) to the fixed image of this worker ###
+	### Inputs:
+	### job 		= tuple of (reference name, reference image file, reference segmentation file) - files are None for bank references
+	### prefetched 		= the images of the reference already read by _loadReference(), or None
+	### Returns - a tuple of ([name, DSC, MSD, RMS, HD] or None on failure, error message or None, StageTimer record)
+	###	(with several candidate segmentations, a list of one [name, DSC, MSD, RMS, HD] per candidate)
+	profiler = _worker['profiler']
+	if profiler:
+		profiler.enable()
+	timer = StageTimer()
+	_worker['prefetched'] = prefetched or {}
+	try:
+		row, error = _register(job, timer)
+	finally:
+		if profiler:
+			# Cumulative profile of this worker, rewritten after every reference so it survives the pool being terminated
+			profiler.disable()
+			profiler.dump_stats('{}.{}.prof'.format(_worker['profile'], os.getpid()))
+	return row, error, timer.record()
+
+def _serviceReference(job):
+	### Function to register one reference to a subject in a long-running worker (see RCAservice.py) ###
+	### Inputs:
+	### job 		= tuple of (subject settings for _setSubject(), (reference name, image file, segmentation file))
+	### Returns - as _registerReference()
+	settings, reference = job
+	if _worker.get('subject') != settings:
+		_setSubject(settings)
+	return _registerReference(reference)
+
+# The state a worker of a WorkerPool shares with the main process (see WorkerPool)
+_shared = {}
+
+def _initShared(halt, arrived):
+	_shared['halt'] 	= halt
+	_shared['arrived'] 	= arrived
+
+def _registerShared(job):
+	### Function to register one reference in a worker of a WorkerPool ###
+	### Inputs:
+	### job 		= tuple of (settings of registration(), (reference name, image file, segmentation file))
+	### Returns - as _registerReference(), or (None, None, None) for a job skipped by WorkerPool.stop()
+	settings, reference = job
+	if _shared['halt'].is_set():
+		return None, None, None
+	# _initProcess() clears _worker, so the settings the worker was prepared with are kept here
+	if _shared.get('settings') != settings:
+		_initWorker(settings)
+		_shared['settings'] = settings
+	return _registerReference(reference)
+
+def _flushShared(workers):
+	### Function to finish the queued writes of a worker of a WorkerPool ###
+	### Every worker takes exactly one of these jobs: none of them returns before all the workers have taken one
+	if _worker.get('writer'):
+		_worker['writer'].flush()
+	arrived = _shared['arrived']
+	with arrived.get_lock():
+		arrived.value += 1
+	while arrived.value < workers:
+		time.sleep(0.01)
+
+def _transformFile(folder, i):
+	### Returns - the file the i-th transform parameter map of the registration of a reference is written to
+	return '{}/TransformParameters.{}_to_{}.{}.txt'.format(_worker['output_folder'], folder, _worker['subject_name'], i)
+
+def _register(job, timer):
+	folder, img, seg	= job
+	output_folder		= _worker['output_folder']
+	subject_name		= _worker['subject_name']
+	elastixImagefilter	= _worker['elastixImagefilter']
+
+	with timer.stage('read_image'):
+		moving_image 		= _readReference(folder, img, 'image')
+	moving_seg 				= None
+	if _worker.get('roi') is not None:
+		try:
+			with timer.stage('read_seg'):
+				moving_seg = _readReference(folder, seg, 'seg')
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except:
+			return None, 'Resampling error'
+		with timer.stage('crop'):
+			moving_image = cropToLabels(moving_image, moving_seg, _worker['roi'])
+	cache 					= _worker['cache']
+	transformParameterMaps 	= None
+	if cache:
+		with timer.stage('cache'):
+			key 					= cache.key(_worker['fixed_hash'], _referenceHash(folder, img))
+			transformParameterMaps 	= cache.get(key)
 
-		elastixImagefilter.SetFixedImage(fixed_image_img)
-		elastixImagefilter.SetMovingImage(sitk.ReadImage(img))
+	if transformParameterMaps is None:
+		elastixImagefilter.SetFixedImage(_worker['fixed_image_reg'])
+		elastixImagefilter.SetMovingImage(moving_image)
 
-		if doBoth:
-			elastixImagefilter.SetParameterMap(parameterMapVector)
+		fromRigid = _worker.get('refine') or _worker['doBoth']	# a B-spline stage starting from a rigid transform
+		if _worker.get('refine'):
+			# Second tier of a cascade: only the B-spline stage, starting from the rigid transform of the first tier
+			rigid_file = _transformFile(folder, 0)
+		elif _worker['doBoth']:
+			# The rigid stage on its own, then the B-spline stage starting from its transform (as in the second tier of a
+			# cascade), so that the two stages are timed separately
+			elastixImagefilter.SetInitialTransformParameterFileName('')
+			elastixImagefilter.SetParameterMap(_worker['parameterMap_rigid'])
+			try:
+				with timer.stage('elastix_rigid'):
+					elastixImagefilter.Execute()
+			except (KeyboardInterrupt, SystemExit):
+				raise
+			except:
+				return None, 'SimpleElastix error'
+			rigid_file = os.path.join(_worker['worker_folder'], 'TransformParameters.rigid.txt')
+			sitk.WriteParameterFile(elastixImagefilter.GetTransformParameterMap()[0], rigid_file)
 		else:
-			elastixImagefilter.SetParameterMap(parameterMap_1)
+			elastixImagefilter.SetInitialTransformParameterFileName('')
+			elastixImagefilter.SetParameterMap(_worker['parameterMap_1'])
+		if fromRigid:
+			elastixImagefilter.SetInitialTransformParameterFileName(rigid_file)
+			elastixImagefilter.SetParameterMap(_worker['parameterMapVector'][1])
 
+		# Without intensity outputs, WriteResultImage is off and the result image is not used
 		try:
-			result = elastixImagefilter.Execute()
-    		except (KeyboardInterrupt, SystemExit):
-        		raise
-    		except:
-    			sys.stdout.write('\nSimpleElastix error\n')
+			with timer.stage('elastix_bspline' if fromRigid else 'elastix_rigid'):
+				result = elastixImagefilter.Execute()
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except:
+			return None, 'SimpleElastix error'
 
-		sitk.WriteImage(result, '{}/test/warped_imgs/{}_to_{}.nii.gz'.format(output_folder, folders[idx], subject_name))
-		
-		# old=u'(ResampleInterpolator "FinalLinearInterpolator")'
-		# new=u'(ResampleInterpolator "FinalNearestNeighborInterpolator")'
+		# The transforms are taken from the filter in memory - they are only written out for auditing
+		transformParameterMaps = elastixImagefilter.GetTransformParameterMap()
+		if fromRigid:
+			# The [rigid, B-spline] maps of one rigid + B-spline registration, as they are cached and used to warp
+			bspline = transformParameterMaps[0]
+			bspline['InitialTransformParametersFileName'] = ['NoInitialTransform']
+			transformParameterMaps = sitk.VectorOfParameterMap()
+			transformParameterMaps.append(sitk.ReadParameterFile(rigid_file))
+			transformParameterMaps.append(bspline)
+		if cache:
+			with timer.stage('cache'):
+				cache.put(key, transformParameterMaps)
+	elif _worker['outputs'] == 'all':
+		# Registered before (e.g. for another segmentation of this image): only the warping is left to do
+		with timer.stage('warp_image'):
+			result = warpImage(moving_image, _worker['fixed_image_reg'], transformParameterMaps)
 
-		# mod=[]
+	with timer.stage('write'):
+		# The previous reference's images were written while this one was read and registered - only the time left waiting counts
+		_worker['writer'].flush()
+		if _worker['outputs'] == 'all':
+			_worker['writer'].write(result, '{}/test/warped_imgs/{}_to_{}'.format(output_folder, folder, subject_name))
 
-		# with open(output_folder+'/TransformParameters.0.txt', "r") as f:
-		# 	for line in f:
-		# 		if old in line:
-		# 			mod.append(new)
-		# 		else:
-		# 			mod.append(line)
-		
-		# with open(output_folder+'/TransformParameters.0.txt', "w") as f:
-		# 	for m in mod:
-		# 		f.write(str(m))
+		if _worker['writeTransforms']:
+			for i in range(len(transformParameterMaps)):
+				sitk.WriteParameterFile(transformParameterMaps[i], _transformFile(folder, i))
 
+	try:
+		if moving_seg is None:
+			with timer.stage('read_seg'):
+				moving_seg = _readReference(folder, seg, 'seg')
+		with timer.stage('warp_labels'):
+			result = warpLabels(moving_seg, _worker['fixed_image_img'], transformParameterMaps)
+	except (KeyboardInterrupt, SystemExit):
+		raise
+	except:
+		return None, 'Resampling error'
 
-		transformixImageFilter = sitk.TransformixImageFilter()
+	if _worker['outputs'] != 'none':
+		with timer.stage('write'):
+			_worker['writer'].write(result, '{}/test/{}_to_{}seg'.format(output_folder, folder, subject_name))
 
-		transformixPMap_rigid = sitk.ReadParameterFile(output_folder+'/TransformParameters.0.txt')
-		transformixPMap_rigid['ResampleInterpolator']	=	["FinalNearestNeighborInterpolator"]
-		transformixImageFilter.AddTransformParameterMap(transformixPMap_rigid)
+	ref_map = _arrayView(result)	# the warped labels keep the uint8 type of the reference segmentation
 
-		if doBoth:
-			transformixPMap_nonrigid = sitk.ReadParameterFile(output_folder+'/TransformParameters.1.txt')
-			transformixPMap_nonrigid['ResampleInterpolator']	=	["FinalNearestNeighborInterpolator"]		
-			transformixImageFilter.AddTransformParameterMap(transformixPMap_nonrigid)
+	try:
+		with timer.stage('metrics'):
+			# Every candidate segmentation is scored against the same warped labels
+			rows = [[folder] + metrics(ref_map) for metrics in _worker['metrics']]
+			return (rows if isinstance(_worker['subject_seg'], list) else rows[0]), None
+	except (KeyboardInterrupt, SystemExit):
+		raise
+	except:
+		return None, 'Metric error'
 
-		transformixImageFilter.SetMovingImage(sitk.ReadImage(segs[idx]))
 
-		transformixImageFilter.LogToConsoleOff()
-		try:
-			result = transformixImageFilter.Execute()
-     		except (KeyboardInterrupt, SystemExit):
-        		raise
- 		except:
-    			sys.stdout.write('\nTransformix error\n')
+def referenceFiles(refdir, maxreferences=100, bank=None, references=None):
+	### Function to list the references to register ###
+	### Inputs:
+	### refdir, maxreferences, bank, references 	= as for registration()
+	### Returns - three lists: the reference names, their image files and their segmentation files (None for bank references)
+	if bank:
+		# References compiled into the bank are memory-mapped; stale ones are read from their source files
+		referenceBank 	= ReferenceBank(bank)
+		folders 		= references if references is not None else referenceBank.names()[:maxreferences]
+		stale 			= set(referenceBank.stale())
+		if stale:
+			sys.stdout.write('[*] {} stale references in the bank - reading them from their source files\n'.format(len(stale)))
+		refs 	= [referenceBank.source(f, 'image') if f in stale else None for f in folders]
+		segs 	= [referenceBank.source(f, 'seg') if f in stale else None for f in folders]
+	else:
+		folders = references if references is not None else sorted(os.listdir(refdir))[:maxreferences]
+
+		refs 	= [os.path.join(refdir, f, 'lvsa_ED.nii.gz') for f in folders]
+		segs 	= [os.path.join(refdir, f, 'segmentation_ED.nii.gz') for f in folders]
+	return folders, refs, segs
+
+class WorkerPool(object):
+	### Worker processes shared by the registration() calls of a run (see RCA.py) ###
+	### The workers are forked when it is made, so make it before starting any thread: a thread holding a lock when the
+	### process forks (e.g. while writing to stdout) leaves that lock held for good in the workers.
+	### Every registration() prepares the workers with its own settings; the jobs skipped by stop() return at once.
+	def __init__(self, workers):
+		### Inputs:
+		### workers 		= the number of worker processes
+		self.workers 	= workers
+		self.halt 		= multiprocessing.Event()
+		self.arrived 	= multiprocessing.Value('i', 0)
+		self.pool 		= multiprocessing.Pool(workers, _initShared, (self.halt, self.arrived))
+
+	def imap(self, settings, jobs):
+		### Returns - an iterator over the results of _registerReference() on the jobs, in order, in workers prepared with settings
+		return self.pool.imap(_registerShared, [(settings, job) for job in jobs])
+
+	def stop(self):
+		### Function to skip the jobs of the last imap() that have not started ###
+		self.halt.set()
+
+	def drain(self, results):
+		### Function to wait for the jobs of the last imap() and for every worker to finish writing its warped images ###
+		while True:
+			try:
+				next(results)
+			except StopIteration:
+				break
+			except Exception:
+				pass	# the error of a job has been raised by the imap() already, or is not wanted
+		self.arrived.value = 0
+		self.pool.map(_flushShared, [self.workers] * self.workers, chunksize=1)
+		self.halt.clear()
+
+	def terminate(self):
+		self.pool.terminate()
+		self.pool.join()
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+class Cascade(object):
+	### Two-tier registration: every reference is registered with the rigid stage only, then the top references by rigid
+	### DSC are refined with the B-spline stage, starting from their rigid transform ###
+	### Inputs:
+	### top 		= the number of references refined with the B-spline stage
+
+	def __init__(self, top):
+		self.top 		= top
+		self.rigid 		= []	# the [name, DSC, MSD, RMS, HD] of every reference after the rigid stage (a list per candidate with several candidate segmentations)
+		self.refined 	= []	# the names of the references refined with the B-spline stage
+
+	def select(self, rows):
+		### Returns - the names of the top references by whole-segmentation DSC, best first
+		order = sorted(rows, key=lambda row: -np.asarray(row[1])[-1])
+		return [row[0] for row in order[:self.top]]
+
+	def record(self, candidate=None):
+		### Returns - the rigid metrics of every reference and the names of the refined references
+		###	(with several candidate segmentations, the rigid metrics of the candidate with this index)
+		return {'rigid': self.rigid if candidate is None else self.rigid[candidate], 'refined': self.refined}
+
+def registration(subject_folder, output_folder, imgFilename, segFilename, maxreferences=100, refdir='/vol/biomedic/users/rdr16/RCA2017/registeredTrainingImgs', classes=[0,1,2,4], doBoth=1, workers=1, bank=None, references=None, writeTransforms=False, journal=None, cache=None, cacheBytes=None, timings=None, profile=None, roi=None, stopping=None, prefetch=2, prefetchBytes=2**30, writeQueue=4, outputs='all', codec='gzip', cascade=None, refine=False, pool=None):
+	### Function to perform registration between N-reference images (+ segmentations) and a single fixed image ###
+	### Inputs:
+	### subject_folder	= the directory containing the fixed image
+	### output_folder	= the directory to store the output
+	### imgfilename 	= the filename of the fixed image
+	### segFilename 	= the filename of the fixed segmentation, or a list of filenames of candidate segmentations of the
+	###			  image: every reference is registered and warped once and scored against each candidate
+	### maxreferences 	= the number of reference images to register
+	### refdir		= the directory containing all reference subjects (each in their own directories)
+	### classes 		= the class numbers for the reference images (for the analysis)
+	### workers 		= the number of processes registering references in parallel (1 = serial)
+	### bank 		= a reference bank folder (see RCAbank.py) to read the references from instead of refdir
+	### references 	= the names of the references to register, in order (default: the first maxreferences)
+	### writeTransforms	= also write the Elastix transform parameters of every reference to output_folder/RCA (for auditing)
+	### journal 		= file where every reference's metrics are saved as soon as they are computed. References already
+	###			  in the journal (from an interrupted run) are not registered again. With several candidate
+	###			  segmentations, a list of one journal per candidate.
+	### cache 		= registration cache folder (see RCAcache.py): transforms of an image/reference pair registered
+	###			  before with the same parameter maps are reused instead of running Elastix again
+	### cacheBytes 		= the size (bytes) the cache is trimmed to after the subject, least recently used first
+	### timings 		= a TimingLog (see RCAtiming.py) the stage timings of every reference are added to
+	### profile 		= prefix of the cProfile files written by every process registering references (<profile>.<pid>.prof)
+	### roi 			= margin (mm) around the labels the subject and reference images are cropped to for the registration
+	###			  (None = register the whole images). The warped labels are always on the full subject grid.
+	### stopping 		= an EarlyStopping (see RCAstopping.py): the references are registered in its order until its rule
+	###			  is met, and it records how many were used (None = register all references)
+	### prefetch 		= the number of references read ahead in the background: with one worker the images are read and
+	###			  decoded while the previous reference registers, with more workers their files are read into the
+	###			  page cache ahead of the workers (0 = read each reference when it is registered)
+	### prefetchBytes 	= the memory the prefetched images may hold (bytes)
+	### writeQueue 		= the number of warped images of a worker that can wait to be written while it registers the next
+	###			  reference (0 = write them straight away)
+	### outputs 		= the warped images written to output_folder/RCA/test: 'all' (segmentations and intensity images),
+	###			  'labels' (segmentations only, needed by recomputeMetrics()) or 'none'
+	### codec 		= the codec of the warped images: 'gzip', 'fast' (gzip level 1) or 'none' (uncompressed .nii)
+	### cascade 		= a Cascade: every reference is registered with the rigid stage only, then the best of them are
+	###			  refined with the B-spline stage (the rigid metrics are kept in the Cascade, the journal of the rigid
+	###			  tier is <journal>_rigid.jsonl). stopping only applies to the refined references.
+	### refine 		= only run the B-spline stage, starting from the rigid transforms written by an earlier rigid-only
+	###			  registration() of the same references (the second tier of a cascade)
+	### pool 		= a WorkerPool to register the references in, rather than starting workers processes for this call
+	###			  (workers is the number of its workers)
+	### Returns - a list with one [name, DSC, MSD, RMS, HD] entry per reference, in the order of the references
+	###	(with a cascade, the B-spline metrics of the refined references and the rigid metrics of the others).
+	###	With several candidate segmentations, a list of these lists, one per candidate.
+	candidates 	= isinstance(segFilename, list)
+	segFilenames 	= segFilename if candidates else [segFilename]
+	journals 	= (journal if candidates else [journal]) if journal else None
+	if cascade is not None:
+		options = dict(maxreferences=maxreferences, refdir=refdir, classes=classes, workers=workers, bank=bank, cache=cache,
+			cacheBytes=cacheBytes, timings=timings, profile=profile, roi=roi, prefetch=prefetch, prefetchBytes=prefetchBytes,
+			writeQueue=writeQueue, outputs=outputs, codec=codec, pool=pool)
+		# First tier: the rigid stage on every reference, writing the rigid transforms the second tier starts from
+		rigidJournals = ['{0[0]}_rigid{0[1]}'.format(os.path.splitext(j)) for j in journals] if journals else None
+		rigid = registration(subject_folder, output_folder, imgFilename, segFilename, doBoth=0, references=references, writeTransforms=True,
+			journal=(rigidJournals if candidates else rigidJournals[0]) if journals else None, **options)
+		rigidSets 		= rigid if candidates else [rigid]
+		cascade.rigid 	= rigid
+		cascade.refined = cascade.select(rigidSets[0])	# the references are chosen by the first candidate
+		sys.stdout.write('[*] Refining the top {} of {} references by rigid DSC\n\n'.format(len(cascade.refined), len(rigidSets[0])))
+		sys.stdout.flush()
+		# Second tier: the B-spline stage on the best references by rigid DSC, best first
+		refined = registration(subject_folder, output_folder, imgFilename, segFilename, doBoth=1, references=cascade.refined, writeTransforms=True,
+			journal=journal, stopping=stopping, refine=True, **options) if cascade.refined else None
+		refinedSets 	= (refined if candidates else [refined]) if refined is not None else [[] for _ in segFilenames]
+		cascade.refined = [row[0] for row in refinedSets[0]]
+		merged = []
+		for rigidRows, refinedRows in zip(rigidSets, refinedSets):
+			rows = dict((row[0], row) for row in rigidRows)
+			rows.update((row[0], row) for row in refinedRows)
+			merged.append([rows[row[0]] for row in rigidRows])
+		return merged if candidates else merged[0]
+
+	newoutput_folder = os.path.join(output_folder, 'RCA', 'test', 'warped_imgs')
+	if not os.path.exists(newoutput_folder):
+		os.makedirs(newoutput_folder)
+	output_folder = os.path.join(output_folder, 'RCA')
+
+	folders, refs, segs = referenceFiles(refdir, maxreferences, bank, references)
+
+	subject_name 		= os.path.basename(subject_folder)
+
+	registrationCache = None
+	if cache:
+		parameterMap_1, parameterMapVector = parameterMaps(sitk.ElastixImageFilter())
+		# The rigid-only entries (first tier of a cascade) and the rigid + B-spline entries are both current
+		registrationCache = RegistrationCache(cache, parameterMapVector if doBoth else parameterMap_1, maxbytes=cacheBytes, live=[parameterMap_1, parameterMapVector])
+
+	settings = {
+		'output_folder'	: output_folder,
+		'subject_name'	: subject_name,
+		'subject_image'	: os.path.join(subject_folder, imgFilename),
+		'subject_seg'	: [os.path.join(subject_folder, f) for f in segFilenames] if candidates else os.path.join(subject_folder, segFilename),
+		'doBoth'		: doBoth,
+		'bank'			: bank,
+		'writeTransforms'	: writeTransforms,
+		'cache'			: cache,
+		'fixed_hash'	: subjectHash(registrationCache, os.path.join(subject_folder, imgFilename), [os.path.join(subject_folder, f) for f in segFilenames], roi) if cache else None,
+		'roi'			: roi,
+		# Share the cores between the workers rather than letting every worker use all of them
+		'threads'		: max(1, multiprocessing.cpu_count() // workers) if workers > 1 else 0,
+		'profile'		: os.path.abspath(profile) if profile else None,
+		'writeQueue'	: writeQueue,
+		'writeBytes'	: prefetchBytes,
+		'outputs'		: outputs,
+		'codec'			: codec,
+		'refine'		: refine,
+		}
+
+	progress_width=50
+	sys.stdout.write("RCA on {} with {} References\t\t\t{}\t{}\t{}\t{}\n".format(subject_name, len(refs), 'DSC', 'MSD', 'RMS', 'HD'))
+	sys.stdout.write('[' + 'R' + '-'*(progress_width) + ']')
+	sys.stdout.flush()
+
+	Data = []
+	jobs = list(zip(folders, refs, segs))
+	if stopping:
+		stopping.begin(subject_name, len(jobs))
+		jobs = stopping.sort(jobs, key=lambda job: job[0])
+
+	# rows holds the [name, DSC, MSD, RMS, HD] of every candidate of a reference, keyed by reference name
+	rows = {}
+	stopped = False
+	if journals:
+		# A reference is only resumed if it is in the journal of every candidate
+		journaled 	= [readJournal(j) for j in journals]
+		rows 		= OrderedDict((name, [entries[name] for entries in journaled]) for name in journaled[0]
+			if name in folders and all(name in entries for entries in journaled))
+		jobs = [job for job in jobs if job[0] not in rows]
+		if rows:
+			sys.stdout.write('\r[*] Resuming: {} references already in the journal\n'.format(len(rows)))
+			sys.stdout.write('[' + 'R' + '-'*(progress_width) + ']')
+			sys.stdout.flush()
+		journal_files = [_openJournal(j) for j in journals]
+		if stopping:
+			# the references of the journal count towards the stopping rule, in the order they were registered
+			for candidateRows in rows.values():
+				stopped = stopping.add(candidateRows[0]) or stopped
+			if stopped:
+				jobs = []
 
+	# The Elastix output directories of the workers (logs and transform files) are only scratch space: they are made in a
+	# temporary folder that is removed once the workers are gone, whether they finished or were terminated
+	settings['elastix_folder'] = tempfile.mkdtemp(prefix='rca-elastix-')
 
-	    	sitk.WriteImage(result, '{}/test/{}_to_{}seg.nii.gz'.format(output_folder, folders[idx], subject_name))
-	    	os.rename(output_folder+'/TransformParameters.0.txt', '{}/TransformParameters.{}_to_{}.txt'.format(output_folder, folders[idx], subject_name))
+	# imap hands the results back in the order of the references, whatever order the workers finish in
+	shared 	= pool
+	pool 	= None
+	loader 	= None
+	warmed 	= iter([])
+	if not jobs:
+		results = iter([])
+		shared 	= None
+	elif workers > 1:
+		if shared:
+			results = shared.imap(settings, jobs)
+		else:
+			pool 	= multiprocessing.Pool(workers, _initWorker, (settings,))
+			results = pool.imap(_registerReference, jobs)
+		if prefetch:
+			# Every result frees a worker, which takes the next job: keep the files of the next few jobs warm
+			loader = Prefetcher(jobs, _warmReference, depth=prefetch + workers)
+			warmed = iter(loader)
+	else:
+		_initWorker(settings)
+		if prefetch:
+			loader 	= Prefetcher(jobs, _loadReference, depth=prefetch, maxbytes=prefetchBytes)
+			results = (_registerReference(job, prefetched) for job, prefetched, error in loader)
+		else:
+			results = (_registerReference(job) for job in jobs)
 
-	    	ref_map = sitk.GetArrayFromImage(result)
-	    	subject_map = sitk.GetArrayFromImage(fixed_image_seg)
+	resumed 	= len(rows)
+	finished 	= False
+	try:
+		for idx, (row, error, record) in enumerate(results, resumed):
+			next(warmed, None)
+			if timings:
+				timings.add(jobs[idx - resumed][0], record)
+			if error:
+				sys.stdout.write('\n{}\n'.format(error))
+			if row is not None:
+				candidateRows = row if candidates else [row]
+				Data.append(candidateRows[0])
+				rows[candidateRows[0][0]] = candidateRows
+				if journals:
+					for journal_file, candidateRow in zip(journal_files, candidateRows):
+						_appendJournal(journal_file, candidateRow)
+				if stopping and stopping.add(candidateRows[0]):
+					stopped = True
 
-	 # 	thisimg 	= '{}/test/{}_to_{}seg.nii.gz'.format(output_folder, folders[idx], subject_name)
-		# ref_map 	= sitk.GetArrayFromImage(sitk.ReadImage(thisimg))
-	 # 	subject_map 	= sitk.GetArrayFromImage(fixed_image_seg)
+			progress_done = int(progress_width*float(idx+1)/len(refs))
+			progress_todo = int(progress_width-progress_done)
+			sys.stdout.write('\r')
+			sys.stdout.write('[' + '>'*(progress_done) + 'R' + '-'*(progress_todo) + ']')
+			if Data:
+				sys.stdout.write('\t{:3.3f}\t{:3.3f}\t{:3.3f}\t{:3.3f}'.format(Data[-1][1][-1], Data[-1][2][-1], Data[-1][3][-1], Data[-1][4][-1]))
+			sys.stdout.flush()
+			if stopped:
+				break	# the workers still registering references are terminated (or, in a shared pool, waited for) below
+		else:
+			finished = True
+			# Every reference is done: let the workers finish writing their warped images before they exit
+			if pool:
+				pool.close()
+				pool.join()
+				pool = None
+		if workers <= 1 and jobs:
+			_worker['writer'].flush()
+	except (KeyboardInterrupt, SystemExit):
+		# The shared workers are not waited for on the way out of the run
+		if shared:
+			shared.terminate()
+			shared = None
+		raise
+	finally:
+		if loader:
+			loader.close()
+		if shared:
+			shared.stop()
+			shared.drain(results)
+		if pool:
+			pool.terminate()
+			pool.join()
+		if workers > 1 and jobs and not finished:
+			# The second tier of a cascade writes over the warped images of the first, which are kept
+			_removeUnreported(output_folder, subject_name, [job[0] for job in jobs if job[0] not in rows] if not refine else [])
+		shutil.rmtree(settings['elastix_folder'], ignore_errors=True)
+		if journals:
+			for journal_file in journal_files:
+				journal_file.close()
 
-	    	try:
-	    		Data.append([folders[idx]] + getMetrics(subject_map, ref_map, subject_classes=[0,1,2,4]))
-    		except (KeyboardInterrupt, SystemExit):
-        		raise
-    		except:
-    			sys.stdout.write('\nMetric error\n')
-		#time.sleep(0.1)
+	if registrationCache:
+		registrationCache.evict()
 
 	sys.stdout.write('\r')
 	sys.stdout.write('[' + '='*(progress_width+1) + ']\n\n')
+	if stopped:
+		sys.stdout.write('[*] Stopped by the {} rule after {} of {} references\n\n'.format(stopping.stoppedBy, len(rows), len(refs)))
 	sys.stdout.flush()
 
-	return Data
+	results = [[rows[folder][k] for folder in folders if folder in rows] for k in range(len(segFilenames))]
+	return results if candidates else results[0]
+
+def _removeUnreported(output_folder, subject_name, references):
+	### Function to remove what terminated workers may have left in output_folder/test: the temporary files of unfinished
+	### writes and the warped images of the references whose results were not collected (so they are not recomputed) ###
+	for folder, suffix in [(os.path.join(output_folder, 'test'), 'seg'), (os.path.join(output_folder, 'test', 'warped_imgs'), '')]:
+		if not os.path.isdir(folder):
+			continue
+		unreported = set('{}_to_{}{}{}'.format(name, subject_name, suffix, imageExtension(codec)) for name in references for codec in CODECS)
+		for f in os.listdir(folder):
+			if TEMPORARY.search(f) or f in unreported:
+				try:
+					os.remove(os.path.join(folder, f))
+				except OSError:
+					pass
+
+def readJournal(journal):
+	### Function to read the per-reference results saved by registration() ###
+	### Inputs:
+	### journal 		= the journal file (one JSON object per line)
+	### Returns - an ordered dictionary of reference name -> [name, DSC, MSD, RMS, HD]
+	rows = OrderedDict()
+	if not os.path.isfile(journal):
+		return rows
+	with open(journal, 'r') as f:
+		for line in f:
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				continue	# a line cut short by a crash
+			rows[entry['ref']] = [entry['ref']] + entry['metrics']
+	return rows
+
+def _openJournal(journal):
+	### Returns - the journal opened for appending, after terminating a line cut short by a crash
+	journal_file = open(journal, 'a+')
+	journal_file.seek(0, os.SEEK_END)
+	if journal_file.tell():
+		journal_file.seek(journal_file.tell() - 1)
+		if journal_file.read(1) != '\n':
+			journal_file.write('\n')
+	return journal_file
+
+def _appendJournal(journal_file, row):
+	### Append one reference's metrics to the journal and make sure it reaches the disk before moving on
+	journal_file.write(json.dumps({'ref': row[0], 'metrics': row[1:]}) + '\n')
+	journal_file.flush()
+	os.fsync(journal_file.fileno())
 
-def getMetrics(subject_seg, ref_seg, subject_classes=[0,1,2,3], ref_classes=[0,1,2,4]):
+def writeJournal(journal, rows):
+	### Function to replace a journal with the given [name, DSC, MSD, RMS, HD] entries (atomically) ###
+	tmp = journal + '.tmp'
+	with open(tmp, 'w') as journal_file:
+		for row in rows:
+			_appendJournal(journal_file, row)
+	os.rename(tmp, journal)
+
+def warpedSegmentations(output_folder, subject_name):
+	### Function to list the warped reference segmentations saved by registration() for a subject ###
+	### Inputs:
+	### output_folder	= the output directory of the subject (the one holding RCA/)
+	### subject_name 	= the subject name
+	### Returns - a list of (reference name, warped segmentation file), in the order of the journal if there is one
+	test_folder = os.path.join(output_folder, 'RCA', 'test')
+	suffixes 	= set('_to_{}seg{}'.format(subject_name, imageExtension(codec)) for codec in CODECS)
+	files 		= {}
+	if os.path.isdir(test_folder):
+		for f in os.listdir(test_folder):
+			for suffix in suffixes:
+				if f.endswith(suffix):
+					files[f[:-len(suffix)]] = os.path.join(test_folder, f)
+	order 		= [name for name in readJournal(os.path.join(output_folder, 'RCA', 'journal.jsonl')) if name in files]
+	order 		+= sorted(name for name in files if name not in order)
+	return [(name, files[name]) for name in order]
+
+def _recomputeReference(job):
+	### Function to compute the metrics of one warped reference segmentation against its subject segmentation ###
+	### Inputs:
+	### job 		= tuple of (subject segmentation file, subject classes, reference classes, reference name, warped segmentation file)
+	### Returns - a tuple of ([name, DSC, MSD, RMS, HD] or None on failure, error message or None)
+	subject_seg_file, subject_classes, ref_classes, name, warped_file = job
+	# The jobs of a subject are consecutive - the subject side is only prepared again when the subject changes
+	if _worker.get('recompute') != (subject_seg_file, subject_classes):
+		fixed_image_seg = labelImage(sitk.ReadImage(subject_seg_file))
+		_worker['recompute'] 			= (subject_seg_file, subject_classes)
+		_worker['recompute_seg'] 		= fixed_image_seg
+		_worker['recompute_metrics'] 	= SubjectMetrics(_arrayView(fixed_image_seg), subject_classes=subject_classes, sampling=fixed_image_seg.GetSpacing()[::-1])
+	try:
+		warped = labelImage(sitk.ReadImage(warped_file))
+		return [name] + _worker['recompute_metrics'](_arrayView(warped), ref_classes), None
+	except (KeyboardInterrupt, SystemExit):
+		raise
+	except:
+		return None, 'Metric error: {}'.format(warped_file)
+
+def recomputeMetrics(subjects, subject_classes=[0,1,2,4], ref_classes=[0,1,2,4], workers=1):
+	### Function to recompute the metrics from the warped reference segmentations already on disk (no registration) ###
+	### Inputs:
+	### subjects 		= list of (subject name, subject segmentation file, output directory of the subject)
+	### subject_classes 	= the class numbers for the subject segmentations
+	### ref_classes 		= the class numbers for the reference segmentations
+	### workers 		= the number of processes computing metrics in parallel - the references of all subjects are shared between them
+	### Returns - a generator of (subject name, list of [name, DSC, MSD, RMS, HD]) in the order of the subjects, each as soon as it is complete
+	counts 	= []
+	jobs 	= []
+	for subject_name, subject_seg_file, output_folder in subjects:
+		warped = warpedSegmentations(output_folder, subject_name)
+		counts.append((subject_name, len(warped)))
+		jobs += [(subject_seg_file, tuple(subject_classes), tuple(ref_classes), name, warped_file) for name, warped_file in warped]
+
+	pool = None
+	_worker.clear()
+	if workers > 1:
+		pool 	= multiprocessing.Pool(workers, _worker.clear)
+		results = pool.imap(_recomputeReference, jobs, chunksize=4)
+	else:
+		results = (_recomputeReference(job) for job in jobs)
+
+	try:
+		for subject_name, count in counts:
+			rows = []
+			for i in range(count):
+				row, error = next(results)
+				if error:
+					sys.stdout.write('{}\n'.format(error))
+				if row is not None:
+					rows.append(row)
+			yield subject_name, rows
+	finally:
+		if pool:
+			pool.terminate()
+			pool.join()
+
+def getMetrics(subject_seg, ref_seg, subject_classes=[0,1,2,3], ref_classes=[0,1,2,4], sampling=1):
 	### Function to assemble the metrics between a reference segmentation and fixed segmentation ###
 	### Inputs:
 	### subject_seg, ref_seg = n-Dimensional numpy array
 	### subject_classes      = the class numbers for the fixed iamge
 	### ref_classes 	 = the class numbers for the reference iamge
+	### sampling		 = the voxel spacing in array axis order (distances in mm) or 1 (distances in voxels)
 	### Returns - an array of metrics [Dice, MSD, RMS and HD]
 	### MSD = mean surface distance, RMD = root mean-square surface distance and HD = Hausdorff distance 
-	    	thisDSC = []
-	    	thisMSD = []
-	    	thisRMS = []
-	    	thisHD  = []
-	    	for subject_label, ref_label in zip(subject_classes, ref_classes):
-			surface_distance = surfd(subject_seg==subject_label, ref_seg==ref_label)
-			thisDSC.append(	dice(    subject_seg==subject_label, ref_seg==ref_label))
+	### To compare many references with the same subject, build a SubjectMetrics once and call it per reference
+	return SubjectMetrics(subject_seg, subject_classes, sampling=sampling)(ref_seg, ref_classes)
+
+
+class SubjectMetrics(object):
+	### Metrics of any number of reference segmentations against one fixed (subject) segmentation ###
+	### Inputs:
+	### subject_seg 	= n-Dimensional numpy array (uint8 labels use the least memory)
+	### subject_classes	= the class numbers for the fixed image
+	### sampling		= pixel-distance between samples (the voxel spacing, in array axis order, for distances in mm).
+	###			  Variable for morphology.distance_transform_edt
+	### connectivity 	= number of neighbours for the morphology.binary_struction and binary_erosion functions
+	### scratch 		= another SubjectMetrics of the same shape whose scratch buffers are shared (e.g. for several candidate
+	###			  segmentations of one image), or None
+	### The subject's borders and distance transforms (per class and for the whole mask) are computed here, once,
+	### so each reference only pays for its own side of surfd(), cropped to the region around both masks.
+	### The DSCs of all classes come from one confusion matrix of the subject and reference labels instead of
+	### one pass over the volume per class.
+	### The masks, erosions, borders and distance transforms of the references are computed in scratch buffers
+	### allocated once, so a reference does not allocate any full-size array beyond what scipy needs internally.
+
+	def __init__(self, subject_seg, subject_classes=[0,1,2,3], sampling=1, connectivity=1, scratch=None):
+		self.subject_seg 		= np.atleast_1d(subject_seg)
+		self.subject_classes 	= list(subject_classes)
+		self.sampling 			= sampling
+		self.connnect 			= morphology.generate_binary_structure(self.subject_seg.ndim, connectivity)
+
+		size 			= self.subject_seg.size
+		if scratch is not None and scratch._mask.size >= size:
+			self._mask, self._eroded, self._border, self._edt = scratch._mask, scratch._eroded, scratch._border, scratch._edt
+		else:
+			self._mask 		= np.empty(size, np.bool_)
+			self._eroded 	= np.empty(size, np.bool_)
+			self._border 	= np.empty(size, np.bool_)
+			self._edt 		= np.empty(size, np.float64)
+
+		# Borders are kept as bool and distance transforms as float32 (distances in mm do not need more precision)
+		self.boxes 		= []
+		self.borders 	= []
+		self.distances 	= []
+		for label in self.subject_classes + [None]:
+			mask = self._labelMask(self.subject_seg, label)
+			self.boxes.append(_bbox(mask))
+			self.borders.append(self._borderOf(mask).copy())
+			self.distances.append(self._distance(self.borders[-1]).astype(np.float32))
+
+		# The confusion matrix needs non-negative integer labels - anything else falls back to one dice() per class
+		self.labels = _labelArray(self.subject_seg)
+		if self.labels is not None:
+			self.nlabels = max([int(self.labels.max())] + [int(label) for label in self.subject_classes]) + 1
+
+	def _scratch(self, buffer, shape):
+		### Returns - a view of the first voxels of a scratch buffer with the given shape
+		return buffer[:int(np.prod(shape))].reshape(shape)
+
+	def _labelMask(self, seg, label):
+		### Returns - the mask of a label (or of all labels if label is None), in the mask scratch buffer
+		mask = self._scratch(self._mask, seg.shape)
+		if label is None:
+			return np.not_equal(seg, 0, out=mask)
+		return np.equal(seg, label, out=mask)
+
+	def _borderOf(self, mask):
+		### Returns - the border of a mask (see _border), in the border scratch buffer
+		eroded = morphology.binary_erosion(mask, self.connnect, output=self._scratch(self._eroded, mask.shape))
+		if eroded is None:
+			eroded = self._scratch(self._eroded, mask.shape)	# older scipy returns None when given an output array
+		return np.greater(mask, eroded, out=self._scratch(self._border, mask.shape))
+
+	def _distance(self, border):
+		### Returns - the distance from every voxel to the nearest voxel of border (see _borderDistance), in the EDT scratch buffer
+		background 	= np.logical_not(border, out=self._scratch(self._eroded, border.shape))
+		distances 	= self._scratch(self._edt, border.shape)
+		morphology.distance_transform_edt(background, self.sampling, distances=distances)
+		return distances
+
+	def dice(self, ref_seg, ref_classes):
+		### Returns - the DSC of every (subject_class, ref_class) pair followed by the DSC of the whole mask
+		ref_labels = _labelArray(ref_seg)
+		if self.labels is None or ref_labels is None:
+			return [dice(self.subject_seg==subject_label, ref_seg==ref_label) for subject_label, ref_label in zip(self.subject_classes, ref_classes)] \
+				+ [dice(self.subject_seg>0, ref_seg>0)]
+
+		nref 		= max([int(ref_labels.max())] + [int(label) for label in ref_classes]) + 1
+		# Index of every voxel in the confusion matrix, in the smallest integer type that holds it
+		index 		= self.labels.astype(np.promote_types(np.min_scalar_type(self.nlabels * nref), ref_labels.dtype))
+		index 		*= nref
+		index 		+= ref_labels
+		confusion 	= np.bincount(index.ravel(), minlength=self.nlabels*nref).reshape(self.nlabels, nref)
+		subject_sum = confusion.sum(axis=1)
+		ref_sum 	= confusion.sum(axis=0)
+
+		def ratio(intersection, total):
+			return 2.0 * intersection / total if total else 1.0
+		thisDSC = [ratio(confusion[int(subject_label), int(ref_label)], subject_sum[int(subject_label)] + ref_sum[int(ref_label)])
+			for subject_label, ref_label in zip(self.subject_classes, ref_classes)]
+		thisDSC.append(ratio(confusion[1:, 1:].sum(), subject_sum[1:].sum() + ref_sum[1:].sum()))
+		return thisDSC
+
+	def __call__(self, ref_seg, ref_classes=[0,1,2,4]):
+		### Function to compute the metrics between a reference segmentation and the subject segmentation ###
+		### Inputs:
+		### ref_seg 		= n-Dimensional numpy array (same shape as the subject segmentation)
+		### ref_classes 	= the class numbers for the reference image
+		### Returns - an array of metrics [Dice, MSD, RMS and HD]
+		ref_seg 	= np.atleast_1d(ref_seg)
+		thisDSC 	= self.dice(ref_seg, ref_classes)
+
+		thisMSD = []
+		thisRMS = []
+		thisHD  = []
+		for label, subject_box, subject_border, subject_distance in zip(list(ref_classes) + [None], self.boxes, self.borders, self.distances):
+			mask 	= self._labelMask(ref_seg, label)
+			ref_box = _bbox(mask)
+			if subject_box is None or ref_box is None:
+				surface_distance = _emptySurface(subject_box, ref_box)
+			else:
+				roi 				= _roi(subject_box, ref_box, mask.shape)
+				ref_border 			= self._borderOf(mask[roi])
+				ref_distance 		= self._distance(ref_border)
+				surface_distance 	= np.concatenate([np.ravel(subject_distance[roi][ref_border]), np.ravel(ref_distance[subject_border[roi]])])
 			thisMSD.append(	surface_distance.mean())
 			thisRMS.append(	np.sqrt((surface_distance**2).mean()))
 			thisHD.append(	surface_distance.max())
-    		surface_distance = surfd(subject_seg, ref_seg)
-		thisMSD.append(	surface_distance.mean())
-		thisRMS.append(	np.sqrt((surface_distance**2).mean()))
-		thisHD.append(	surface_distance.max())
-		thisDSC.append(dice(subject_seg>0, ref_seg>0))
-		#thisDSC.append(np.mean(thisDSC))
-
-	    	return [thisDSC, thisMSD, thisRMS, thisHD]
+
+		return [thisDSC, thisMSD, thisRMS, thisHD]
+
+
+if __name__ == '__main__':
+	validateSurfd()
+	sys.stdout.write('surfd: cropped, full-grid and brute-force surface distances agree\n')
@@ -0,0 +1,167 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import socket
+import sys
+import argparse
+import numpy as np
+import SimpleITK as sitk
+from scipy.ndimage import zoom
+
+### An index of cheap descriptors of every reference, used to register a subject to its K most similar references only:
+###	thumbnails	- the image resampled to a small fixed grid and normalised (intensity pattern)
+###	volumes		- the volume (mm^3) of every label of the segmentation
+###	fov, spacing	- the physical field of view and the voxel spacing (mm)
+### The index is stored as a single .npz and is updated incrementally: only new or modified references are read.
+### The descriptors are defined for 3D images: references of any other dimension are left out of the index.
+
+THUMBNAIL_SHAPE = (8, 16, 16)
+
+def _thumbnail(array):
+	### Returns - the array resampled to THUMBNAIL_SHAPE and normalised to zero mean and unit variance
+	shape 		= THUMBNAIL_SHAPE[-array.ndim:]
+	thumbnail 	= zoom(array.astype(np.float32), [n / m for n, m in zip(shape, array.shape)], order=1)
+	thumbnail 	= thumbnail[tuple(slice(0, n) for n in shape)]
+	return (thumbnail - thumbnail.mean()) / (thumbnail.std() or 1.0)
+
+def _volumes(array, spacing):
+	### Returns - the volume (mm^3) of every label 0..max(label) of the segmentation
+	return np.bincount(np.round(array).astype(np.intp).ravel()) * np.prod(spacing)
+
+def describe(image, seg):
+	### Function to compute the descriptors of an image and its segmentation ###
+	### Inputs:
+	### image, seg 		= SimpleITK images
+	### Returns - (thumbnail, volumes, fov, spacing) - a ValueError is raised if the image or segmentation is not 3D
+	### (a 4D image, or an image with several components per voxel, is not 3D)
+	array 	= sitk.GetArrayFromImage(image)
+	labels 	= sitk.GetArrayFromImage(seg)
+	if array.ndim != len(THUMBNAIL_SHAPE) or labels.ndim != len(THUMBNAIL_SHAPE):
+		raise ValueError('Only 3D images can be described: the image is {}D and the segmentation {}D'.format(array.ndim, labels.ndim))
+	spacing = np.array(image.GetSpacing())
+	return _thumbnail(array), _volumes(labels, seg.GetSpacing()), spacing * image.GetSize(), spacing
+
+def _sourceStats(refdir, name):
+	stats = []
+	for filename in ['lvsa_ED.nii.gz', 'segmentation_ED.nii.gz']:
+		st = os.stat(os.path.join(refdir, name, filename))
+		stats += [st.st_size, st.st_mtime]
+	return stats
+
+
+class ReferenceIndex(object):
+	### The descriptors of all references in an index file ###
+	### Inputs:
+	### index_file		= the .npz written by updateIndex()
+
+	def __init__(self, index_file):
+		with np.load(index_file) as index:
+			self.names 		= [str(name) for name in index['names']]
+			self.stats 		= index['stats']
+			self.thumbnails = index['thumbnails']
+			self.volumes 	= index['volumes']
+			self.fov 		= index['fov']
+			self.spacing 	= index['spacing']
+
+	def distances(self, image, seg, classes=[0,1,2,4]):
+		### Function to compute how far every reference is from a subject ###
+		### Inputs:
+		### image, seg 		= SimpleITK images of the subject and the segmentation under test
+		### classes 		= the class numbers whose volumes are compared (background excluded)
+		### Returns - one distance per reference (smaller is more similar)
+		thumbnail, volumes, fov, spacing = describe(image, seg)
+
+		# Intensity pattern: 1 - correlation of the normalised thumbnails
+		flat 	= self.thumbnails.reshape(len(self.names), -1)
+		d_image = 1.0 - flat.dot(thumbnail.ravel()) / flat.shape[1]
+
+		# Label volumes (log scale), field of view and spacing: differences in units of the spread over the references
+		labels 	= [label for label in classes if label]
+		def column(values, label):
+			return values[..., label] if label < values.shape[-1] else np.zeros(values.shape[:-1])
+		ref_volumes = np.log1p(np.stack([column(self.volumes, label) for label in labels], axis=-1))
+		sub_volumes = np.log1p(np.array([column(volumes, label) for label in labels]))
+
+		def standardised(refs, subject):
+			spread = refs.std(axis=0)
+			spread[spread == 0] = 1.0
+			return (((refs - subject) / spread)**2).mean(axis=1)
+
+		return d_image + standardised(ref_volumes, sub_volumes) + standardised(self.fov, fov) + standardised(self.spacing, spacing)
+
+	def select(self, image, seg, k, classes=[0,1,2,4]):
+		### Returns - the names of the k references most similar to the subject, most similar first
+		order = np.argsort(self.distances(image, seg, classes), kind='mergesort')
+		return [self.names[i] for i in order[:k]]
+
+
+def updateIndex(refdir, index_file):
+	### Function to build or update the index of a reference folder ###
+	### Inputs:
+	### refdir		= the directory containing all reference subjects (each in their own directories)
+	### index_file		= the .npz file to write
+	### Only references that are new or whose files changed are read - removed references are dropped, and references that
+	### are not 3D are left out with a warning (they are never selected)
+	### Returns - the list of reference names that were (re)described
+	folders = sorted(os.listdir(refdir))
+	old 	= ReferenceIndex(index_file) if os.path.isfile(index_file) else None
+	known 	= dict((name, i) for i, name in enumerate(old.names)) if old else {}
+
+	names 		= []
+	entries 	= []
+	described 	= []
+	for name in folders:
+		stats = _sourceStats(refdir, name)
+		if name in known and list(old.stats[known[name]]) == stats:
+			i = known[name]
+			names.append(name)
+			entries.append((old.thumbnails[i], old.volumes[i], old.fov[i], old.spacing[i], stats))
+			continue
+		image 	= sitk.ReadImage(os.path.join(refdir, name, 'lvsa_ED.nii.gz'))
+		seg 	= sitk.ReadImage(os.path.join(refdir, name, 'segmentation_ED.nii.gz'))
+		try:
+			entry = describe(image, seg) + (stats,)
+		except ValueError as e:
+			sys.stdout.write('[*] Reference left out of the index: {} ({})\n'.format(name, e))
+			continue
+		names.append(name)
+		entries.append(entry)
+		described.append(name)
+
+	# Label volumes have one column per label value - pad them to the largest label of any reference
+	nlabels = max([len(entry[1]) for entry in entries] or [0])
+	volumes = np.zeros((len(entries), nlabels))
+	for i, entry in enumerate(entries):
+		volumes[i, :len(entry[1])] = entry[1]
+
+	# Every RCA.py process updates the index on startup - each writes its own temporary file and the last rename wins
+	tmp = '{}.{}.{}.tmp.npz'.format(index_file, socket.gethostname(), os.getpid())
+	np.savez(tmp,
+		names 		= np.array(names),
+		thumbnails 	= np.array([entry[0] for entry in entries]).reshape((len(entries),) + THUMBNAIL_SHAPE),
+		volumes 	= volumes,
+		fov 		= np.array([entry[2] for entry in entries]).reshape(len(entries), 3),
+		spacing 	= np.array([entry[3] for entry in entries]).reshape(len(entries), 3),
+		stats 		= np.array([entry[4] for entry in entries]).reshape(len(entries), 4))
+	os.rename(tmp, index_file)
+	return described
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Build or update the pre-selection index of a folder of [reference images]')
+	parser.add_argument('--refs', type=str, required=True)
+	parser.add_argument('--index', type=str, required=True)
+	args = parser.parse_args()
+
+	described = updateIndex(args.refs, args.index)
+	sys.stdout.write('{} references (re)described in {}\n'.format(len(described), os.path.abspath(args.index)))
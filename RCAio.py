@@ -0,0 +1,262 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import re
+import gzip
+import shutil
+import threading
+import SimpleITK as sitk
+
+### Background I/O of RCA, so that reading and writing images overlaps with the registrations.
+### SimpleITK releases the GIL while it reads, decodes and writes images, so plain threads are enough:
+###	Prefetcher	- loads the next items (e.g. references) in background threads into a bounded, memory-capped buffer
+###	AsyncWriter	- writes images (or runs any output function) in a background thread from a bounded queue
+### Errors of a load are handed back with the item, errors of a write are raised by the next flush().
+### Images are written with one of the CODECS:
+###	gzip		- .nii.gz compressed by SimpleITK (the default)
+###	fast		- .nii.gz compressed at gzip level 1: much faster to write, slightly larger files
+###	none		- uncompressed .nii
+### The warped images written for every reference are one of the OUTPUTS:
+###	all		- the warped segmentation and the warped intensity image
+###	labels		- the warped segmentation only (enough to recompute the metrics later)
+###	none		- nothing
+
+CODECS 	= ['gzip', 'fast', 'none']
+OUTPUTS = ['all', 'labels', 'none']
+# The temporary files of writeImage() - left behind only by a process killed while writing
+TEMPORARY = re.compile(r'\.\d+\.tmp\.nii(\.gz)?$')
+
+def imageBytes(image):
+	### Returns - the memory held by a SimpleITK image, or by a list, tuple or dictionary of them, in bytes
+	if image is None:
+		return 0
+	if isinstance(image, dict):
+		return sum(imageBytes(value) for value in image.values())
+	if isinstance(image, (list, tuple)):
+		return sum(imageBytes(value) for value in image)
+	if not isinstance(image, sitk.Image):
+		return 0
+	bits = re.search(r'(\d+)-bit', image.GetPixelIDTypeAsString())
+	return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * (int(bits.group(1)) // 8 if bits else 8)
+
+def imageExtension(codec):
+	### Returns - the file extension of the images written with a codec
+	return '.nii' if codec == 'none' else '.nii.gz'
+
+def writeImage(image, filename, codec='gzip'):
+	### Function to write an image with a codec ###
+	### Inputs:
+	### image 		= the SimpleITK image
+	### filename 		= the file name without its extension (imageExtension(codec) is added)
+	### codec 		= one of CODECS
+	### Returns - the file written
+	target 	= filename + imageExtension(codec)
+	# Written under a temporary name (see TEMPORARY) and renamed into place, so that a process killed while writing
+	# (e.g. a worker terminated on an early stop) never leaves a truncated image under the final name
+	tmp 	= '{}.{}.tmp'.format(filename, os.getpid())
+	written = tmp + imageExtension(codec)
+	try:
+		if codec == 'fast':
+			# SimpleITK has no compression level: write the .nii, then gzip it at level 1
+			sitk.WriteImage(image, tmp + '.nii')
+			with open(tmp + '.nii', 'rb') as source:
+				with gzip.open(written, 'wb', 1) as compressed:
+					shutil.copyfileobj(source, compressed, 2**20)
+		else:
+			sitk.WriteImage(image, written)
+		os.rename(written, target)
+	finally:
+		for f in [tmp + '.nii', written]:
+			if os.path.exists(f):
+				os.remove(f)
+	return target
+
+def warmFile(filename, blocksize=2**20):
+	### Function to read a file into the page cache of the operating system (e.g. from a network filesystem) ###
+	### Returns - None (nothing is kept in memory)
+	if filename and os.path.isfile(filename):
+		with open(filename, 'rb') as f:
+			while f.read(blocksize):
+				pass
+
+def warmFiles(filenames):
+	### Function to warm files (see warmFile) one after the other in a background daemon thread ###
+	### Returns - the thread (nothing waits for it: it ends once every file has been read)
+	thread = threading.Thread(target=lambda: [warmFile(filename) for filename in filenames])
+	thread.daemon = True
+	thread.start()
+	return thread
+
+
+class Prefetcher(object):
+	### Loads items in background threads ahead of their use, in order ###
+	### Inputs:
+	### items 		= the items, in the order they are used
+	### load 		= function loading an item (run in the background threads)
+	### depth 		= the number of items loaded ahead of the one in use
+	### maxbytes 		= no more items are loaded while those waiting hold more than this (None = no cap). The next item
+	###			  is always loaded, so an item larger than maxbytes does not stall the pipeline
+	### size 		= function returning the bytes held by a loaded item (default imageBytes)
+	### threads 		= the number of loading threads
+
+	def __init__(self, items, load, depth=2, maxbytes=None, size=imageBytes, threads=1):
+		self.items 		= list(items)
+		self.load 		= load
+		self.depth 		= max(1, depth)
+		self.maxbytes 	= maxbytes
+		self.size 		= size
+		self.condition 	= threading.Condition()
+		self.loaded 	= {}	# index -> (value, error, bytes)
+		self.scheduled 	= 0		# the next item to load
+		self.used 		= 0		# the next item to hand out
+		self.bytes 		= 0
+		self.closed 	= False
+		self.threads 	= [threading.Thread(target=self._run) for _ in range(max(1, threads))]
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+	def _full(self):
+		if self.scheduled - self.used >= self.depth:
+			return True
+		return self.maxbytes is not None and self.bytes > self.maxbytes and self.scheduled > self.used
+
+	def _run(self):
+		while True:
+			with self.condition:
+				while not self.closed and self.scheduled < len(self.items) and self._full():
+					self.condition.wait()
+				if self.closed or self.scheduled >= len(self.items):
+					return
+				index 			= self.scheduled
+				self.scheduled 	+= 1
+			value, error = None, None
+			try:
+				value = self.load(self.items[index])
+			except Exception as e:
+				error = e
+			nbytes = self.size(value) if value is not None else 0
+			with self.condition:
+				self.loaded[index] = (value, error, nbytes)
+				self.bytes += nbytes
+				self.condition.notify_all()
+
+	def get(self):
+		### Returns - a tuple of (item, loaded value or None, error or None) of the next item, waiting for it to be loaded
+		with self.condition:
+			if self.used >= len(self.items):
+				raise StopIteration
+			while self.used not in self.loaded:
+				self.condition.wait(0.5)
+			value, error, nbytes = self.loaded.pop(self.used)
+			item 		= self.items[self.used]
+			self.used 	+= 1
+			self.bytes 	-= nbytes
+			self.condition.notify_all()
+		return item, value, error
+
+	def __iter__(self):
+		while True:
+			try:
+				yield self.get()
+			except StopIteration:
+				return
+
+	def close(self):
+		### Function to stop loading (the loads in progress finish in the background) ###
+		with self.condition:
+			self.closed = True
+			self.loaded.clear()
+			self.condition.notify_all()
+
+
+class AsyncWriter(object):
+	### Runs output functions (images are written by writeImage) in a background thread ###
+	### Inputs:
+	### depth 		= the number of writes that can wait - write() blocks beyond (0 = write straight away)
+	### maxbytes 		= write() also blocks while the images waiting hold more than this (None = no cap)
+	### codec 		= the codec of the images (see CODECS)
+
+	def __init__(self, depth=4, maxbytes=None, codec='gzip'):
+		self.depth 		= depth
+		self.maxbytes 	= maxbytes
+		self.codec 		= codec
+		self.condition 	= threading.Condition()
+		self.pending 	= []	# (function, args, bytes)
+		self.bytes 		= 0
+		self.busy 		= False
+		self.error 		= None
+		self.closed 	= False
+		self.thread 	= None
+		if depth > 0:
+			self.thread = threading.Thread(target=self._run)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def _run(self):
+		while True:
+			with self.condition:
+				while not self.pending and not self.closed:
+					self.condition.wait()
+				if not self.pending:
+					return
+				function, args, nbytes = self.pending.pop(0)
+				self.busy = True
+			try:
+				function(*args)
+			except Exception as e:
+				with self.condition:
+					self.error = self.error or e
+			with self.condition:
+				self.bytes -= nbytes
+				self.busy 	= False
+				self.condition.notify_all()
+
+	def submit(self, function, *args):
+		### Function to queue function(*args) - the images among args count towards maxbytes ###
+		if self.thread is None:
+			return function(*args)
+		nbytes = imageBytes(list(args))
+		with self.condition:
+			while len(self.pending) >= self.depth or (self.maxbytes is not None and self.pending and self.bytes + nbytes > self.maxbytes):
+				self.condition.wait()
+			self.pending.append((function, args, nbytes))
+			self.bytes += nbytes
+			self.condition.notify_all()
+
+	def write(self, image, filename):
+		### Function to queue writeImage() of an image - filename is without its extension ###
+		self.submit(writeImage, image, filename, self.codec)
+
+	def copy(self, source, destination):
+		### Function to queue shutil.copy(source, destination) ###
+		self.submit(shutil.copy, source, destination)
+
+	def flush(self):
+		### Function to wait for every queued write - raises the first error of a write since the last flush() ###
+		with self.condition:
+			while self.pending or self.busy:
+				self.condition.wait()
+			error, self.error = self.error, None
+		if error is not None:
+			raise error
+
+	def close(self):
+		### Function to finish the queued writes and stop the thread ###
+		if self.thread is None:
+			return
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+		self.thread.join()
+		self.thread = None
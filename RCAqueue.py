@@ -0,0 +1,232 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import atexit
+import threading
+
+### Claim-based work queue shared by many RCA.py processes through a (network) filesystem.
+### The queue folder holds three sub-folders:
+###	leases/<subject>	- created with O_EXCL by the worker that claims the subject and touched by its heartbeat
+###	done/<subject>		- written when the subject has been saved, with the names of the results saved for it
+###	failed/<subject>	- written when RCA raised an exception for the subject
+### A lease whose modification time is older than the timeout belongs to a dead worker and can be reclaimed.
+
+def _writeMarker(path, content):
+	### Function to write a small JSON file atomically (write a temporary file, then rename it into place) ###
+	tmp = '{}.{}.{}.tmp'.format(path, socket.gethostname(), os.getpid())
+	with open(tmp, 'w') as f:
+		json.dump(content, f)
+	os.rename(tmp, path)
+
+
+class Lease(object):
+	### A claim on one subject, kept alive by a heartbeat thread until done(), failed() or release() ###
+
+	def __init__(self, queue, subject, path, token):
+		self.queue 		= queue
+		self.subject 	= subject
+		self.path 		= path
+		self.token 		= token
+		self.lost 		= False
+		self._stop 		= threading.Event()
+		self._thread 	= threading.Thread(target=self._heartbeat)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _heartbeat(self):
+		### Touch the lease file regularly so that other workers can see that this one is alive ###
+		while not self._stop.wait(self.queue.timeout / 4.0):
+			# No token can be read while another worker checks the lease (see claim()): only another token means it is lost
+			token = self.queue._token(self.path)
+			if token is not None and token != self.token:
+				self.lost = True
+				sys.stdout.write('\n[*] Lease lost for subject: {}\n'.format(self.subject))
+				return
+			try:
+				os.utime(self.path, None)
+			except OSError:
+				pass
+
+	def owned(self):
+		### Returns - True if the lease file still carries this worker's token ###
+		return self.queue._token(self.path) == self.token
+
+	def release(self):
+		### Stop the heartbeat and remove the lease so that the subject becomes pending again ###
+		self._stop.set()
+		self._thread.join()
+		if self.owned():
+			try:
+				os.remove(self.path)
+			except OSError:
+				pass
+		self.queue._active.discard(self)
+
+	def done(self, results=None):
+		### Mark the subject as finished and release the lease ###
+		### Inputs:
+		### results 		= the names of the results saved for the subject (default: the subject name)
+		content = self.queue._owner(self.token)
+		content['results'] = list(results) if results is not None else [self.subject]
+		_writeMarker(os.path.join(self.queue.done_folder, self.subject), content)
+		self.release()
+
+	def failed(self, message=''):
+		### Mark the subject as failed (it will not be claimed again) and release the lease ###
+		content = self.queue._owner(self.token)
+		content['error'] = message
+		_writeMarker(os.path.join(self.queue.failed_folder, self.subject), content)
+		self.release()
+
+
+class WorkQueue(object):
+	### A set of subjects shared by all workers pointed at the same queue folder ###
+	### Inputs:
+	### queue_folder	= folder on the shared filesystem that holds the leases and markers
+	### subjects		= the subject names (one per line of --subjects)
+	### timeout		= seconds without a heartbeat after which a lease is considered dead
+
+	def __init__(self, queue_folder, subjects, timeout=600):
+		self.queue_folder 	= os.path.abspath(queue_folder)
+		self.subjects 		= list(subjects)
+		self.timeout 		= timeout
+		self.lease_folder 	= os.path.join(self.queue_folder, 'leases')
+		self.done_folder 	= os.path.join(self.queue_folder, 'done')
+		self.failed_folder 	= os.path.join(self.queue_folder, 'failed')
+		for folder in [self.lease_folder, self.done_folder, self.failed_folder]:
+			try:
+				os.makedirs(folder)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+		self._active = set()
+		# Leases held when the process exits (e.g. sys.exit on a missing file) are handed back straight away
+		atexit.register(self.releaseAll)
+
+	def _owner(self, token):
+		return {'host': socket.gethostname(), 'pid': os.getpid(), 'token': token, 'time': time.time()}
+
+	def _now(self):
+		### Returns - the current time as seen by the shared filesystem (avoids clock skew between machines) ###
+		probe = os.path.join(self.lease_folder, '.clock.{}.{}'.format(socket.gethostname(), os.getpid()))
+		with open(probe, 'w'):
+			pass
+		now = os.path.getmtime(probe)
+		os.remove(probe)
+		return now
+
+	def _token(self, path):
+		### Returns - the token of a lease file, or None if it cannot be read (e.g. still being written)
+		try:
+			with open(path, 'r') as f:
+				return json.load(f).get('token')
+		except (IOError, OSError, ValueError):
+			return None
+
+	def _expired(self, path, now):
+		try:
+			return now - os.path.getmtime(path) > self.timeout
+		except OSError:
+			return False
+
+	def claim(self, subject):
+		### Function to atomically claim a subject ###
+		### Returns - a Lease, or None if the subject is done, failed or held by a live worker
+		if self.isFinished(subject):
+			return None
+		path 	= os.path.join(self.lease_folder, subject)
+		token 	= '{}-{}-{:.6f}'.format(socket.gethostname(), os.getpid(), time.time())
+
+		for attempt in range(2):
+			try:
+				fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+				if attempt:
+					return None
+				now 	= self._now()
+				dead 	= self._token(path)
+				if not self._expired(path, now):
+					return None
+				# Break the dead worker's lease by renaming it away. Between the check and the rename, another worker may have
+				# reclaimed it already: if the renamed file is not the expired lease seen above, it is that worker's live lease
+				# and it is put back - with a hard link, which fails rather than overwrite a lease created in the meantime by
+				# a third worker (that one then owns the subject, and the worker put back finds its lease lost).
+				stale = '{}.stale.{}'.format(path, token)
+				try:
+					os.rename(path, stale)
+				except OSError:
+					return None
+				if self._token(stale) != dead or not self._expired(stale, now):
+					try:
+						os.link(stale, path)
+					except OSError as e:
+						if e.errno != errno.EEXIST:
+							raise
+					os.remove(stale)
+					return None
+				os.remove(stale)
+				sys.stdout.write('[*] Reclaiming expired lease for subject: {}\n'.format(subject))
+				continue
+			with os.fdopen(fd, 'w') as f:
+				json.dump(self._owner(token), f)
+			lease = Lease(self, subject, path, token)
+			self._active.add(lease)
+			return lease
+		return None
+
+	def doneResults(self, subject):
+		### Returns - the names of the results saved for a finished subject, or None if it is not done
+		try:
+			with open(os.path.join(self.done_folder, subject), 'r') as f:
+				return json.load(f).get('results', [subject])
+		except (IOError, OSError, ValueError):
+			return None
+
+	def reopen(self, subject):
+		### Function to make a finished subject pending again (e.g. to save results it was not done for) ###
+		try:
+			os.remove(os.path.join(self.done_folder, subject))
+		except OSError:
+			pass
+
+	def isFinished(self, subject):
+		return os.path.exists(os.path.join(self.done_folder, subject)) or os.path.exists(os.path.join(self.failed_folder, subject))
+
+	def releaseAll(self):
+		for lease in list(self._active):
+			lease.release()
+
+	def status(self):
+		### Returns - a dictionary with the number of pending, running, done and failed subjects ###
+		now 	= self._now()
+		counts 	= {'pending': 0, 'running': 0, 'done': 0, 'failed': 0, 'expired': 0}
+		for subject in self.subjects:
+			lease = os.path.join(self.lease_folder, subject)
+			if os.path.exists(os.path.join(self.done_folder, subject)):
+				counts['done'] += 1
+			elif os.path.exists(os.path.join(self.failed_folder, subject)):
+				counts['failed'] += 1
+			elif os.path.exists(lease) and not self._expired(lease, now):
+				counts['running'] += 1
+			else:
+				counts['pending'] += 1
+				if os.path.exists(lease):
+					counts['expired'] += 1
+		return counts
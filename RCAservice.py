@@ -0,0 +1,432 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import socket
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+import scipy.io
+import SimpleITK as sitk
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+from RCAfunctions import readConfig, referenceFiles, parameterMaps, subjectHash, getMetrics, writeJournal, _initProcess, _serviceReference
+from RCAcache import RegistrationCache
+from RCAstore import ResultStore, resultsDict, maxMetrics
+from RCAstopping import EarlyStopping, ORDERS
+from RCAio import CODECS, OUTPUTS
+
+### Long-running RCA service: the config, Elastix parameter maps and reference images are loaded once, by a pool of
+### worker processes that stays up, and subjects are taken as jobs from a watched folder and/or a unix socket.
+### A job is a JSON object:
+###	{"subject": "/data/subject1", "seg": "segmentation.nii.gz", "image": "image.nii.gz", "GT": "GT.nii.gz", "output": "/out/subject1"}
+### where only "subject" is required (image and seg default to image_FILE and seg_FILE of the config, output to
+### <service>/output/<subject>). One subject is registered at a time, its references shared between the workers, so a
+### job's latency is that of one subject. At most queue_size jobs wait; beyond that, jobs are refused (socket) or left in
+### the inbox until there is room (watched folder).
+###	<service>/accepted/<job>.json	- jobs taken from the inbox and not finished yet (put back in the inbox on restart)
+###	<service>/results/<job>.json	- the result of every inbox job
+
+class Job(object):
+	### A subject waiting for (or done by) the service ###
+
+	def __init__(self, spec, name=None, callback=None):
+		self.spec 		= spec
+		self.name 		= name
+		self.callback 	= callback
+		self.submitted 	= time.time()
+		self.result 	= None
+		self.done 		= threading.Event()
+
+
+class RCAService(object):
+	### Inputs:
+	### service_folder	= the folder holding the accepted jobs, the results and the Elastix output of the workers
+	### config 		= the .cfg file with image_FILE, seg_FILE and class_list
+	### refdir 		= the directory containing all reference subjects (each in their own directories)
+	### maxreferences 	= the number of reference images to register
+	### bank 		= a reference bank folder (see RCAbank.py) to read the references from
+	### workers 		= the number of processes registering the references of a subject in parallel
+	### queue_size 		= the number of jobs that can wait - more are refused
+	### cache 		= a registration cache folder (see RCAcache.py)
+	### store 		= the results store folder (default <service>/store)
+	### preload 		= keep the reference images in the memory of every worker (default: unless they come from a bank)
+	### roi 			= margin (mm) around the labels the images are cropped to for the registration (None = whole images)
+	### earlyStopping 	= an EarlyStopping (see RCAstopping.py) applied to the references of every subject (None = all references)
+	### outputs, codec 	= the warped images written for every reference and their codec (see RCAio.py)
+
+	def __init__(self, service_folder, config, refdir, maxreferences=100, bank=None, workers=1, queue_size=4, cache=None, store=None, preload=None, roi=None, earlyStopping=None, outputs='all', codec='gzip'):
+		self.service_folder = os.path.abspath(service_folder)
+		self.accepted_folder= os.path.join(self.service_folder, 'accepted')
+		self.results_folder = os.path.join(self.service_folder, 'results')
+		for folder in [self.accepted_folder, self.results_folder]:
+			if not os.path.exists(folder):
+				os.makedirs(folder)
+
+		self.config 	= readConfig(config)
+		self.references = list(zip(*referenceFiles(refdir, maxreferences, bank)))
+		self.jobs 		= queue.Queue(queue_size)
+		self.store 		= ResultStore(store if store else os.path.join(self.service_folder, 'store'))
+		self.stopping 	= threading.Event()
+		self.running 	= None
+		self.cache 		= None
+		self.roi 		= roi
+		self.workers 	= workers
+		self.earlyStopping = earlyStopping
+		if cache:
+			parameterMap_1, parameterMapVector = parameterMaps(sitk.ElastixImageFilter())
+			self.cache = RegistrationCache(cache, parameterMapVector)
+
+		settings = {
+			'output_folder'	: os.path.join(self.service_folder, 'elastix'),
+			'doBoth'		: 1,
+			'bank'			: bank,
+			'cache'			: cache,
+			'threads'		: max(1, multiprocessing.cpu_count() // workers) if workers > 1 else 0,
+			'profile'		: None,
+			'roi'			: roi,
+			'writeQueue'	: 4,
+			'writeBytes'	: 2**30,
+			'outputs'		: outputs,
+			'codec'			: codec,
+			'preload'		: self.references if (preload if preload is not None else not bank) else [],
+			}
+		# The pool is started before any thread so that the workers are forked from a single-threaded process
+		sys.stdout.write('[*] Loading {} references in {} worker(s)\n'.format(len(self.references), workers))
+		sys.stdout.flush()
+		if workers > 1:
+			self.pool = multiprocessing.Pool(workers, _initProcess, (settings,))
+		else:
+			self.pool = None
+			_initProcess(settings)
+
+	def submit(self, spec, name=None, callback=None, block=False, timeout=None):
+		### Function to queue a job ###
+		### Returns - the Job (wait for job.done) - raises queue.Full if the queue is full (and block is False or the timeout expires)
+		job = Job(spec, name, callback)
+		self.jobs.put(job, block, timeout)
+		return job
+
+	def status(self):
+		return {'queued': self.jobs.qsize(), 'capacity': self.jobs.maxsize, 'running': self.running, 'references': len(self.references)}
+
+	def run(self):
+		### Function to run the queued jobs, one at a time, until stop() ###
+		while not self.stopping.is_set():
+			try:
+				job = self.jobs.get(timeout=0.5)
+			except queue.Empty:
+				continue
+			self.running = job.spec.get('subject')
+			try:
+				job.result = self.process(job)
+			except (KeyboardInterrupt, SystemExit):
+				raise
+			except Exception as e:
+				job.result = {'subject': job.spec.get('subject'), 'error': str(e)}
+			self.running = None
+			job.done.set()
+			if job.callback:
+				job.callback(job)
+			sys.stdout.write('[*] {}\n'.format(json.dumps(job.result, sort_keys=True)))
+			sys.stdout.flush()
+
+	def stop(self):
+		self.stopping.set()
+
+	def close(self):
+		# The workers finish their last references and the writes of their warped images before they exit
+		if self.pool:
+			self.pool.close()
+			self.pool.join()
+		# The Elastix output directories of the workers are only scratch space
+		shutil.rmtree(os.path.join(self.service_folder, 'elastix'), ignore_errors=True)
+
+	def process(self, job):
+		### Function to run RCA on the subject of a job ###
+		### Returns - the result: the predicted (whole segmentation) DSC, MSD, RMS and HD, the real ones if a GT was given, and timings
+		# JSON strings are unicode - SimpleITK (under python 2) only takes str paths
+		spec 			= dict((key, str(value) if key in ['subject', 'name', 'image', 'seg', 'GT', 'output'] else value) for key, value in job.spec.items())
+		started 		= time.time()
+		subject_folder 	= os.path.abspath(spec['subject'])
+		subject_name 	= spec.get('name', os.path.basename(subject_folder))
+		image_file 		= os.path.join(subject_folder, spec.get('image', self.config['image_FILE']))
+		seg_file 		= os.path.join(subject_folder, spec.get('seg', self.config['seg_FILE']))
+		output_folder 	= os.path.abspath(spec.get('output', os.path.join(self.service_folder, 'output', subject_name)))
+		for filename in [image_file, seg_file]:
+			if not os.path.isfile(filename):
+				return {'subject': subject_name, 'error': "File doesn't exist: {}".format(filename)}
+		for folder in [os.path.join(output_folder, 'RCA', 'test', 'warped_imgs'), os.path.join(output_folder, 'data')]:
+			if not os.path.exists(folder):
+				os.makedirs(folder)
+
+		settings = {
+			'output_folder'		: os.path.join(output_folder, 'RCA'),
+			'subject_name'		: subject_name,
+			'subject_image'		: image_file,
+			'subject_seg'		: seg_file,
+			'writeTransforms'	: False,
+			'fixed_hash'		: subjectHash(self.cache, image_file, seg_file, self.roi) if self.cache else None,
+			}
+		references = self.references
+		if self.earlyStopping:
+			self.earlyStopping.begin(subject_name, len(references))
+			references = self.earlyStopping.sort(references, key=lambda reference: reference[0])
+		jobs = [(settings, reference) for reference in references]
+
+		# The pool outlives the subject, so when stopping early only a few jobs may have been handed to it ahead of the results
+		halt 	= threading.Event()
+		slots 	= threading.Semaphore(2 * self.workers)
+		def feed():
+			for job in jobs:
+				slots.acquire()
+				if halt.is_set():
+					return
+				yield job
+		if self.pool:
+			results = self.pool.imap(_serviceReference, feed() if self.earlyStopping else jobs)
+		else:
+			results = (_serviceReference(job) for job in jobs)
+
+		rows 	= []
+		errors 	= []
+		try:
+			for i, (row, error, record) in enumerate(results):
+				slots.release()
+				if error:
+					errors.append('{}: {}'.format(references[i][0], error))
+				if row is not None:
+					rows.append(row)
+					if self.earlyStopping and self.earlyStopping.add(row):
+						break
+		finally:
+			halt.set()
+			slots.release()
+		# References are written to the journal, the store and the .mat in the order of the references
+		order = dict((reference[0], i) for i, reference in enumerate(self.references))
+		rows.sort(key=lambda row: order[row[0]])
+		if not rows:
+			return {'subject': subject_name, 'error': 'No reference could be registered', 'errors': errors}
+		writeJournal(os.path.join(output_folder, 'RCA', 'journal.jsonl'), rows)
+
+		realMetrics = None
+		if spec.get('GT'):
+			subject_GT 	= sitk.ReadImage(os.path.join(subject_folder, spec['GT']))
+			realMetrics = getMetrics(sitk.GetArrayFromImage(subject_GT), sitk.GetArrayFromImage(sitk.ReadImage(seg_file)), ref_classes=[0,1,2,4], sampling=subject_GT.GetSpacing()[::-1])
+
+		classes = self.config['class_list']
+		stopped = self.earlyStopping.record() if self.earlyStopping else None
+		self.store.append(subject_name, classes, rows, realMetrics, stopped)
+		scipy.io.savemat(os.path.join(output_folder, 'data', '{}.mat'.format(subject_name)), resultsDict(subject_name, classes, rows, realMetrics, stopped))
+
+		summary = maxMetrics(np.array([row[1:] for row in rows]))
+		result 	= {
+			'subject'		: subject_name,
+			'output'		: output_folder,
+			'references'	: len(rows),
+			'stopped_by'	: stopped['stopped_by'] if stopped else '',
+			'errors'		: errors,
+			'queued_s'		: started - job.submitted,
+			'seconds'		: time.time() - started,
+			}
+		for m, metric in enumerate(['DSC', 'MSD', 'RMS', 'HD']):
+			result[metric] = float(summary[m, -1, 0])
+			if realMetrics is not None:
+				result['GT_' + metric] = float(realMetrics[m][-1])
+		return result
+
+	def watch(self, inbox, poll=1.0):
+		### Function to take the *.json jobs written to a folder until stop() - files should be renamed into the inbox once complete ###
+		# Jobs accepted by an earlier run of the service that never finished go back to the inbox
+		for filename in os.listdir(self.accepted_folder):
+			os.rename(os.path.join(self.accepted_folder, filename), os.path.join(inbox, filename))
+		while not self.stopping.is_set():
+			for filename in sorted(os.listdir(inbox)):
+				if not filename.endswith('.json'):
+					continue
+				if self.jobs.full():
+					break	# backpressure: the jobs wait in the inbox
+				accepted = os.path.join(self.accepted_folder, filename)
+				try:
+					os.rename(os.path.join(inbox, filename), accepted)
+				except OSError:
+					continue
+				name = filename[:-len('.json')]
+				try:
+					with open(accepted, 'r') as f:
+						spec = json.load(f)
+				except ValueError as e:
+					self._writeResult(Job({}, name, None), {'error': 'Invalid job: {}'.format(e)})
+					continue
+				self.submit(spec, name, self._inboxDone, block=True)
+			self.stopping.wait(poll)
+
+	def _inboxDone(self, job):
+		self._writeResult(job, job.result)
+
+	def _writeResult(self, job, result):
+		filename 	= os.path.join(self.results_folder, job.name + '.json')
+		tmp 		= filename + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(result, f, indent=1, sort_keys=True)
+		os.rename(tmp, filename)
+		try:
+			os.remove(os.path.join(self.accepted_folder, job.name + '.json'))
+		except OSError:
+			pass
+
+	def serve(self, socket_path):
+		### Function to take jobs from a unix socket until stop(): one JSON job per connection, answered with the result ###
+		### {"status": true} is answered straight away with the state of the queue; a job is refused with {"error": "busy"}
+		### if the queue is full, unless it has "wait": true
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(socket_path)
+		server.listen(16)
+		server.settimeout(0.5)
+		try:
+			while not self.stopping.is_set():
+				try:
+					connection, _ = server.accept()
+				except socket.timeout:
+					continue
+				connection.settimeout(None)
+				thread = threading.Thread(target=self._answer, args=(connection,))
+				thread.daemon = True
+				thread.start()
+		finally:
+			server.close()
+			os.remove(socket_path)
+
+	def _answer(self, connection):
+		try:
+			try:
+				spec = json.loads(_readLine(connection))
+			except ValueError as e:
+				return _sendLine(connection, {'error': 'Invalid job: {}'.format(e)})
+			if spec.get('status'):
+				return _sendLine(connection, self.status())
+			try:
+				job = self.submit(spec, block=bool(spec.get('wait')))
+			except queue.Full:
+				return _sendLine(connection, dict(self.status(), error='busy'))
+			job.done.wait()
+			_sendLine(connection, job.result)
+		except socket.error:
+			pass	# the client went away
+		finally:
+			connection.close()
+
+
+def _readLine(connection):
+	data = b''
+	while not data.endswith(b'\n'):
+		chunk = connection.recv(4096)
+		if not chunk:
+			break
+		data += chunk
+	return data.decode('utf-8')
+
+def _sendLine(connection, content):
+	connection.sendall((json.dumps(content, sort_keys=True) + '\n').encode('utf-8'))
+
+def request(socket_path, spec):
+	### Function to send a job (or {"status": true}) to a running service and wait for its answer ###
+	### Returns - the answer as a dictionary
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.connect(socket_path)
+	try:
+		_sendLine(client, spec)
+		return json.loads(_readLine(client))
+	finally:
+		client.close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Run RCA as a service, or send a job to a running service')
+	parser.add_argument('--service', type=str, default=None, help='folder of the service (starts the service)')
+	parser.add_argument('--refs', type=str, default=None)
+	parser.add_argument('--config', type=str, default='config.cfg')
+	parser.add_argument('--maxreferences', type=int, default=100)
+	parser.add_argument('--bank', type=str, default=None)
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--queue-size', type=int, default=4)
+	parser.add_argument('--cache', type=str, default=None)
+	parser.add_argument('--store', type=str, default=None)
+	parser.add_argument('--roi', type=float, default=None, help='margin (mm) around the labels registered (default whole images)')
+	parser.add_argument('--stop-dsc', type=float, default=None, help='stop registering references once one reaches this DSC')
+	parser.add_argument('--stop-tolerance', type=float, default=None, help='stop once the max DSC is within this of its lower bootstrap bound')
+	parser.add_argument('--stop-confidence', type=float, default=0.95)
+	parser.add_argument('--stop-min', type=int, default=5, help='references registered before --stop-tolerance applies')
+	parser.add_argument('--order', type=str, default='given', choices=ORDERS, help='order the references are registered in')
+	parser.add_argument('--outputs', type=str, default='all', choices=OUTPUTS, help='warped images written per reference')
+	parser.add_argument('--codec', type=str, default='gzip', choices=CODECS, help='compression of the warped images')
+	parser.add_argument('--inbox', type=str, default=None, help='folder watched for *.json jobs')
+	parser.add_argument('--poll', type=float, default=1.0, help='seconds between two looks at the inbox')
+	parser.add_argument('--socket', type=str, default=None, help='unix socket taking jobs')
+	parser.add_argument('--submit', type=str, default=None, help='subject folder to send to the service at --socket')
+	parser.add_argument('--seg', type=str, default=None)
+	parser.add_argument('--GT', type=str, default=None)
+	parser.add_argument('--wait', action='store_true', help='wait for room in the queue instead of being refused')
+	parser.add_argument('--status', action='store_true')
+	args = parser.parse_args()
+
+	if not args.service:
+		if not args.socket or not (args.submit or args.status):
+			parser.error('--service to start a service, or --socket with --submit or --status to use one')
+		spec = {'status': True}
+		if args.submit:
+			spec = dict((key, value) for key, value in [('subject', os.path.abspath(args.submit)), ('seg', args.seg), ('GT', args.GT), ('wait', args.wait)] if value)
+		answer = request(args.socket, spec)
+		sys.stdout.write(json.dumps(answer, indent=1, sort_keys=True) + '\n')
+		sys.exit(1 if 'error' in answer else 0)
+
+	if not args.refs and not args.bank:
+		parser.error('--refs (or --bank) is needed to start a service')
+	if not args.inbox and not args.socket:
+		parser.error('--inbox and/or --socket is needed to start a service')
+	earlyStopping = None
+	if args.stop_dsc is not None or args.stop_tolerance is not None or args.order != 'given':
+		earlyStopping = EarlyStopping(ceiling=args.stop_dsc, tolerance=args.stop_tolerance, confidence=args.stop_confidence, minReferences=args.stop_min, order=args.order)
+	service = RCAService(args.service, args.config, args.refs, args.maxreferences, args.bank, args.workers, args.queue_size, args.cache, args.store, roi=args.roi, earlyStopping=earlyStopping, outputs=args.outputs, codec=args.codec)
+
+	signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+	threads = []
+	if args.inbox:
+		if not os.path.exists(args.inbox):
+			os.makedirs(args.inbox)
+		threads.append(threading.Thread(target=service.watch, args=(os.path.abspath(args.inbox), args.poll)))
+	if args.socket:
+		threads.append(threading.Thread(target=service.serve, args=(os.path.abspath(args.socket),)))
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	sys.stdout.write('[*] RCA service ready: inbox {} socket {}\n'.format(args.inbox, args.socket))
+	sys.stdout.flush()
+	try:
+		service.run()
+	except KeyboardInterrupt:
+		service.stop()
+	finally:
+		for thread in threads:
+			thread.join(5)
+		service.close()
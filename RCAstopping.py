@@ -0,0 +1,96 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import random
+import numpy as np
+
+### Sequential early stopping of the references of a subject.
+### The predicted DSC is the maximum whole-segmentation DSC over the references, so once a reference matches the
+### segmentation very well, or the maximum no longer depends on which references happened to be registered, the
+### remaining references barely change the prediction. References are registered in a chosen order and registration
+### stops at the first of:
+###	ceiling		- a reference reaches this DSC
+###	bootstrap	- the lower bootstrap confidence bound of the max DSC is within tolerance of the max DSC, i.e. the
+###			  max is reached by several references rather than by a single one
+### The orders are:
+###	given		- the order of the references (most similar first with --top-k, otherwise by folder name)
+###	random		- a shuffle seeded by the subject name, so the references seen are a random sample (and a resumed
+###			  subject registers them in the same order)
+
+ORDERS = ['given', 'random']
+
+class EarlyStopping(object):
+	### Inputs:
+	### ceiling 		= stop as soon as a reference reaches this whole-segmentation DSC (None = no ceiling)
+	### tolerance 		= stop once the max DSC is within tolerance of its lower bootstrap bound (None = no bootstrap rule)
+	### confidence 		= the confidence of the bootstrap bound
+	### minReferences 	= the number of references registered before the bootstrap rule applies
+	### order 		= 'given' or 'random'
+	### bootstraps 		= the number of bootstrap samples
+	### seed 		= the seed of the random order and of the bootstrap samples
+
+	def __init__(self, ceiling=None, tolerance=None, confidence=0.95, minReferences=5, order='given', bootstraps=1000, seed=0):
+		if order not in ORDERS:
+			raise ValueError('Unknown reference order: {} (one of {})'.format(order, ', '.join(ORDERS)))
+		self.ceiling 		= ceiling
+		self.tolerance 		= tolerance
+		self.confidence 	= confidence
+		self.minReferences 	= max(2, minReferences)
+		self.order 			= order
+		self.bootstraps 	= bootstraps
+		self.seed 			= seed
+		self.begin(None, 0)
+
+	def begin(self, subject, available):
+		### Function to start a subject with a number of available references ###
+		self.subject 	= subject
+		self.available 	= available
+		self.dscs 		= []
+		self.stoppedBy 	= ''
+		self.bound 		= None
+
+	def sort(self, items, key=lambda item: item):
+		### Returns - the items (references or jobs) in the order they are registered in
+		items = list(items)
+		if self.order == 'random':
+			# sorted first so that the shuffle does not depend on the order the references were listed in
+			items = sorted(items, key=key)
+			random.Random('{}:{}'.format(self.seed, self.subject)).shuffle(items)
+		return items
+
+	def add(self, row):
+		### Function to add the metrics of one reference ###
+		### Inputs:
+		### row 		= the [name, DSC, MSD, RMS, HD] entry of the reference, as returned by registration()
+		### Returns - True if the remaining references need not be registered
+		self.dscs.append(float(np.asarray(row[1])[-1]))
+		if len(self.dscs) >= self.available:
+			return False	# nothing left to save
+		best = max(self.dscs)
+		if self.ceiling is not None and best >= self.ceiling:
+			self.stoppedBy = 'ceiling'
+		elif self.tolerance is not None and len(self.dscs) >= self.minReferences:
+			self.bound = self.lowerBound()
+			if best - self.bound <= self.tolerance:
+				self.stoppedBy = 'bootstrap'
+		return bool(self.stoppedBy)
+
+	def lowerBound(self):
+		### Returns - the lower bound (at the confidence level) of the max DSC over bootstrap samples of the references so far
+		dscs 	= np.array(self.dscs)
+		rng 	= np.random.RandomState(self.seed)
+		maxima 	= dscs[rng.randint(0, len(dscs), (self.bootstraps, len(dscs)))].max(axis=1)
+		return float(np.percentile(maxima, 100.0 * (1.0 - self.confidence)))
+
+	def record(self):
+		### Returns - the number of references used and available, and the rule that stopped the registrations ('' = none)
+		return {'used': len(self.dscs), 'available': self.available, 'stopped_by': self.stoppedBy}
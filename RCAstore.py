@@ -0,0 +1,337 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import re
+import sys
+import time
+import socket
+import argparse
+import numpy as np
+import scipy.io
+
+### Append-only columnar store of the RCA results of a cohort.
+### Every subject is appended as its own partition, written to a temporary file and renamed into place, so any number
+### of workers can append at the same time without locks:
+###	<store>/parts/<host>-<pid>-<time>.npz	- the rows of one subject
+###	<store>/parts/compact-<time>.npz	- the rows of many partitions merged by compact()
+### Two tables are stored, as one numpy array per column:
+###	references	- one row per (subject, reference, class): DSC, MSD, RMS, HD
+###	summary		- one row per (subject, class): the predicted DSC (max) and MSD, RMS, HD (min), the reference each
+###			  comes from, the real (GT) metrics if known (NaN otherwise), the number of references used and
+###			  available and the early stopping rule that stopped the registrations (see RCAstopping.py, -1 and ''
+###			  without early stopping), and the number of references refined by a cascade (-1 without a cascade)
+###	rigid		- with a cascade, one row per (subject, reference, class) of the first, rigid-only tier, and whether the
+###			  reference was refined by the second tier
+### The class of the whole segmentation is -1. If a subject is appended again, only its newest partition is read.
+
+METRICS 	= ['DSC', 'MSD', 'RMS', 'HD']
+WHOLE 		= -1
+TABLES 		= {
+	'references': ['subject', 'reference', 'class'] + METRICS,
+	'summary'	: ['subject', 'class'] + METRICS + [m + '_ref' for m in METRICS] + ['GT_' + m for m in METRICS] + ['used', 'available', 'stopped_by', 'refined'],
+	'rigid'		: ['subject', 'reference', 'class'] + METRICS + ['refined'],
+	}
+# Value of the columns missing from partitions written before they were added
+MISSING 	= {'used': -1, 'available': -1, 'stopped_by': '', 'refined': -1}
+
+def maxMetrics(refData):
+	### Function to summarise the metrics of all references the way they are saved in the .mat ###
+	### Inputs:
+	### refData 		= array of shape (references, 4 metrics, classes + 1)
+	### Returns - array of shape (4 metrics, classes + 1, 2) of [value, 1-based reference index]: max DSC and min MSD, RMS, HD
+	maxs = [np.max(refData, axis=0), np.argmax(refData, axis=0)+1]
+	mins = [np.min(refData, axis=0), np.argmin(refData, axis=0)+1]
+	return np.concatenate([np.reshape(np.array(maxs)[:,0,:], [2,1,refData.shape[2]]), np.array(mins)[:,1:,:]], axis=1).transpose(1,2,0)
+
+def resultsDict(subject, classes, rows, gtMetrics=None, stopping=None, cascade=None):
+	### Function to build the content of the .mat saved for a subject ###
+	### Inputs:
+	### subject 		= the subject name
+	### classes 		= the class numbers
+	### rows 		= the [name, DSC, MSD, RMS, HD] entries of the references, as returned by registration()
+	### gtMetrics 		= the real [DSC, MSD, RMS, HD] against the ground truth, or None
+	### stopping 		= the record() of the EarlyStopping of the subject, or None
+	### cascade 		= the record() of the Cascade of the subject, or None
+	### Returns - dictionary for scipy.io.savemat with ImageID, Classes, Ref<name>, MaxMetrics, ReferencesUsed,
+	###	ReferencesAvailable and StoppedBy (with early stopping), Rigid<name>, RigidMaxMetrics and Refined (with a
+	###	cascade) and GTMetrics (if known)
+	Datadict = {}
+	Datadict['ImageID'] = subject
+	Datadict['Classes'] = list(classes)
+	Datadict['ReferencesUsed'] = len(rows)
+	if stopping is not None:
+		Datadict['ReferencesAvailable'] = stopping['available']
+		Datadict['StoppedBy'] = stopping['stopped_by']
+
+	for ref in rows:
+		Datadict['Ref{}'.format(ref[0])] = ref[1:]
+
+	if rows:
+		Datadict['MaxMetrics'] = maxMetrics(np.array([ref[1:] for ref in rows]))
+
+	if cascade is not None:
+		for ref in cascade['rigid']:
+			Datadict['Rigid{}'.format(ref[0])] = ref[1:]
+		if cascade['rigid']:
+			Datadict['RigidMaxMetrics'] = maxMetrics(np.array([ref[1:] for ref in cascade['rigid']]))
+		Datadict['Refined'] = list(cascade['refined'])
+
+	if gtMetrics is not None:
+		Datadict['GTMetrics'] = gtMetrics
+	return Datadict
+
+
+class ResultStore(object):
+	### Inputs:
+	### store_folder	= the folder holding the store (shared by all workers)
+
+	def __init__(self, store_folder):
+		self.store_folder 	= os.path.abspath(store_folder)
+		self.parts_folder 	= os.path.join(self.store_folder, 'parts')
+		if not os.path.exists(self.parts_folder):
+			try:
+				os.makedirs(self.parts_folder)
+			except OSError:
+				pass	# created by another worker in the meantime
+
+	def _write(self, name, columns):
+		### Function to write a partition atomically ###
+		filename 	= os.path.join(self.parts_folder, name + '.npz')
+		tmp 		= os.path.join(self.parts_folder, name + '.tmp')
+		with open(tmp, 'wb') as f:
+			np.savez(f, **columns)
+		os.rename(tmp, filename)
+		return filename
+
+	def append(self, subject, classes, rows, gtMetrics=None, stopping=None, cascade=None):
+		### Function to append the results of one subject ###
+		### Inputs:
+		### subject 		= the subject name
+		### classes 		= the class numbers of the metric columns (the last column, the whole segmentation, is added)
+		### rows 		= the [name, DSC, MSD, RMS, HD] entries of the references, as returned by registration()
+		### gtMetrics 		= the real [DSC, MSD, RMS, HD] from getMetrics() against the ground truth, or None
+		### stopping 		= the record() of the EarlyStopping of the subject, or None (all references available were used)
+		### cascade 		= the record() of the Cascade of the subject, or None
+		### Returns - the partition file
+		labels 	= np.array(list(classes) + [WHOLE])
+		refData, names, references = _referenceTable(subject, labels, rows)
+		written = time.time()
+		part 	= '{}-{}-{:.6f}'.format(socket.gethostname(), os.getpid(), written)
+
+		columns = {}
+		nrefs, nlabels = len(rows), len(labels)
+
+		summary = {'subject': np.array([subject] * nlabels), 'class': labels}
+		if nrefs:
+			summarised = maxMetrics(refData)
+		for m, metric in enumerate(METRICS):
+			summary[metric] 			= summarised[m, :, 0] if nrefs else np.full(nlabels, np.nan)
+			summary[metric + '_ref'] 	= names[summarised[m, :, 1].astype(int) - 1] if nrefs else np.array([''] * nlabels)
+			summary['GT_' + metric] 	= np.array(gtMetrics[m], dtype=np.float64) if gtMetrics is not None else np.full(nlabels, np.nan)
+		summary['used'] 		= np.full(nlabels, nrefs, dtype=int)
+		summary['available'] 	= np.full(nlabels, stopping['available'] if stopping is not None else MISSING['available'], dtype=int)
+		summary['stopped_by'] 	= np.array([stopping['stopped_by'] if stopping is not None else MISSING['stopped_by']] * nlabels)
+		summary['refined'] 		= np.full(nlabels, len(cascade['refined']) if cascade is not None else -1, dtype=int)
+
+		tables = [('references', references), ('summary', summary)]
+		if cascade is not None:
+			rigid 				= _referenceTable(subject, labels, cascade['rigid'])[2]
+			rigid['refined'] 	= np.isin(rigid['reference'], [str(name) for name in cascade['refined']])
+			tables.append(('rigid', rigid))
+		for table, content in tables:
+			for column, values in content.items():
+				columns['{}.{}'.format(table, column)] = values
+			rows_in_table = len(content['subject'])
+			columns['{}.partition'.format(table)] 	= np.array([part] * rows_in_table)
+			columns['{}.written'.format(table)] 	= np.full(rows_in_table, written)
+		return self._write(part, columns)
+
+	def _files(self):
+		return sorted(os.path.join(self.parts_folder, f) for f in os.listdir(self.parts_folder) if f.endswith('.npz'))
+
+	def _read(self, files, table, latest=True):
+		### Returns - dictionary of column -> array of a table over the files (only the newest partition of every subject if latest)
+		columns = TABLES[table] + ['partition', 'written']
+		chunks 	= dict((column, []) for column in columns)
+		seen 	= set()
+		for filename in files:
+			try:
+				with np.load(filename) as part:
+					rows_in_part = len(part['{}.subject'.format(table)])
+					content = dict((column, part['{}.{}'.format(table, column)] if '{}.{}'.format(table, column) in part.files
+						else np.array([MISSING[column]] * rows_in_part)) for column in columns)
+			except (IOError, OSError, KeyError, ValueError):
+				continue	# removed by compact() since it was listed
+			# A partition can be in its own file and in a compacted file for a moment - read it once
+			keep = ~np.isin(content['partition'], list(seen)) if seen else np.ones(len(content['partition']), bool)
+			seen.update(np.unique(content['partition']).tolist())
+			for column in columns:
+				chunks[column].append(content[column][keep])
+		result = dict((column, np.concatenate(chunks[column]) if chunks[column] else np.array([])) for column in columns)
+		if latest and len(result['subject']):
+			# The newest partition of every subject: sort by (subject, written) and keep the last partition of each subject
+			order 		= np.lexsort((result['written'], result['subject']))
+			subjects 	= result['subject'][order]
+			last 		= np.r_[subjects[1:] != subjects[:-1], True]
+			newest 		= set(result['partition'][order][last].tolist())
+			keep 		= np.isin(result['partition'], list(newest))
+			result 		= dict((column, values[keep]) for column, values in result.items())
+		return result
+
+	def load(self, table='summary', latest=True):
+		### Function to read a whole table ###
+		### Inputs:
+		### table 		= 'summary', 'references' or 'rigid'
+		### latest 		= only keep the newest results of every subject
+		### Returns - dictionary of column name -> numpy array
+		return self._read(self._files(), table, latest)
+
+	def query(self, where, table='summary', label=WHOLE):
+		### Function to select the rows of a table with a vectorised condition ###
+		### Inputs:
+		### where 		= function of the table (dictionary of columns) returning a boolean mask, e.g. lambda t: t['DSC'] < 0.7
+		### label 		= only rows of this class (None = all classes)
+		### Returns - dictionary of column name -> numpy array of the selected rows
+		columns = self.load(table)
+		mask 	= where(columns)
+		if label is not None and len(columns['class']):
+			mask = mask & (columns['class'] == label)
+		return dict((column, values[mask]) for column, values in columns.items())
+
+	def compact(self):
+		### Function to merge all partitions into one file (the newest results of every subject only) ###
+		### Partitions appended while compacting are left as they are
+		### Returns - the number of files merged
+		files = self._files()
+		if len(files) < 2:
+			return 0
+		columns = {}
+		for table in TABLES:
+			content = self._read(files, table)
+			if not len(content['subject']):
+				continue	# e.g. no cascade in any partition
+			for column, values in content.items():
+				columns['{}.{}'.format(table, column)] = values
+		self._write('compact-{:.6f}'.format(time.time()), columns)
+		for filename in files:
+			os.remove(filename)
+		return len(files)
+
+	def exportMat(self, subject, filename, classes):
+		### Function to write the results of a subject as the .mat saved by RCA.py ###
+		### Inputs:
+		### subject 		= the subject name
+		### filename 		= the .mat file
+		### classes 		= the class numbers saved as 'Classes'
+		references 	= self.load('references')
+		summary 	= self.load('summary')
+		rows 		= _referenceRows(references, references['subject'] == subject)
+		gt = np.array([summary['GT_' + metric][summary['subject'] == subject] for metric in METRICS])
+		stopping, cascade = _records(summary, self._rigid(summary), subject)
+		Datadict = resultsDict(subject, classes, rows, gt if gt.size and not np.isnan(gt).all() else None, stopping, cascade)
+		scipy.io.savemat(filename, Datadict)
+
+	def records(self, subjects):
+		### Function to read back the early stopping and cascade records of subjects from their newest results ###
+		### Inputs:
+		### subjects 		= the subject names
+		### Returns - dictionary of subject name -> (stopping, cascade) records as passed to append(), each None if the
+		###	subject had none or is not in the store
+		summary = self.load('summary')
+		rigid 	= self._rigid(summary)
+		return dict((subject, _records(summary, rigid, subject)) for subject in subjects)
+
+	def _rigid(self, summary):
+		### Returns - the rigid table if any subject of the summary was run with a cascade, else None
+		return self.load('rigid') if len(summary['refined']) and (summary['refined'] >= 0).any() else None
+
+
+def _referenceTable(subject, labels, rows):
+	### Returns - the metrics of the rows as an array (references, metrics, labels), the reference names, and the
+	###	dictionary of columns of one row per (reference, class)
+	if not rows:
+		refData = np.empty((0, len(METRICS), len(labels)))	# e.g. a subject stopped before any reference was registered
+	else:
+		refData = np.array([row[1:] for row in rows], dtype=np.float64).reshape(len(rows), len(METRICS), -1)
+	if refData.shape[2] != len(labels):
+		raise ValueError('{} metric columns for {} classes (+ whole segmentation)'.format(refData.shape[2], len(labels) - 1))
+	names 	= np.array([str(row[0]) for row in rows])
+	nrefs, nlabels = len(rows), len(labels)
+	table 	= {
+		'subject'	: np.array([subject] * (nrefs * nlabels)),
+		'reference'	: np.repeat(names, nlabels),
+		'class'		: np.tile(labels, nrefs),
+		}
+	for m, metric in enumerate(METRICS):
+		table[metric] = refData[:, m, :].ravel()
+	return refData, names, table
+
+def _records(summary, rigid, subject):
+	### Returns - the stopping and cascade records of a subject in the summary and rigid tables (None if it had none)
+	mask 		= np.asarray(summary['subject'] == subject, dtype=bool)	# a bare False on an empty store
+	stopping 	= None
+	if mask.any() and summary['available'][mask][0] >= 0:
+		stopping = {'used': int(summary['used'][mask][0]), 'available': int(summary['available'][mask][0]), 'stopped_by': str(summary['stopped_by'][mask][0])}
+	cascade 	= None
+	if mask.any() and summary['refined'][mask][0] >= 0 and rigid is not None:
+		mask 	= rigid['subject'] == subject
+		cascade = {'rigid': _referenceRows(rigid, mask), 'refined': _referenceRows(rigid, mask & rigid['refined'], False)}
+	return stopping, cascade
+
+def _referenceRows(table, mask, metrics=True):
+	### Returns - the [name, DSC, MSD, RMS, HD] entries (or the names only) of the references of the masked rows, in order
+	names = []
+	for name in table['reference'][mask]:
+		if name not in names:
+			names.append(name)
+	if not metrics:
+		return names
+	rows = []
+	for name in names:
+		selected = mask & (table['reference'] == name)
+		rows.append([name] + [table[metric][selected] for metric in METRICS])
+	return rows
+
+def _condition(text):
+	### Returns - a where-function for a condition like 'DSC < 0.7' or 'GT_DSC >= 0.8'
+	match = re.match(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*([-+.\deE]+)\s*$', text)
+	if not match or match.group(1) not in TABLES['summary']:
+		raise ValueError('Cannot parse the condition: {}'.format(text))
+	column, op, value = match.group(1), match.group(2), float(match.group(3))
+	ops = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal, '==': np.equal, '!=': np.not_equal}
+	return lambda t: ops[op](t[column], value)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Query, compact or export an RCA results store')
+	parser.add_argument('--store', type=str, required=True)
+	parser.add_argument('--query', type=str, default=None, help="condition on the summary, e.g. 'DSC < 0.7'")
+	parser.add_argument('--class', dest='label', type=int, default=WHOLE, help='class of the query (default -1: whole segmentation)')
+	parser.add_argument('--compact', action='store_true')
+	parser.add_argument('--export-mat', type=str, default=None, help='subject whose results are exported')
+	parser.add_argument('--mat', type=str, default=None, help='.mat file of --export-mat (default <subject>.mat)')
+	parser.add_argument('--classes', type=int, nargs='+', default=[0, 1, 2, 4])
+	args = parser.parse_args()
+
+	store = ResultStore(args.store)
+	if args.compact:
+		sys.stdout.write('{} partitions compacted\n'.format(store.compact()))
+	if args.query:
+		rows = store.query(_condition(args.query), label=args.label)
+		order = np.argsort(rows['subject'], kind='mergesort')
+		sys.stdout.write('subject\t' + '\t'.join(METRICS) + '\tGT_DSC\tused\n')
+		for i in order:
+			sys.stdout.write('{}\t{}\t{}\t{}\n'.format(rows['subject'][i], '\t'.join('{:.3f}'.format(rows[m][i]) for m in METRICS), '{:.3f}'.format(rows['GT_DSC'][i]), rows['used'][i]))
+		sys.stdout.write('{} subjects\n'.format(len(order)))
+	if args.export_mat:
+		store.exportMat(args.export_mat, args.mat or '{}.mat'.format(args.export_mat), args.classes)
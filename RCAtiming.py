@@ -0,0 +1,171 @@
+#############################################################################
+# REVERSE CLASSIFICATION ACCURACY IMPLEMENTATION - 2018                     #
+# Rob Robinson (r.robinson16@imperial.ac.uk)                                #
+# - Includes RCA.py and RCAfunctions.py                                     #
+#                                                                           #
+# Original RCA paper by V. Valindria https://arxiv.org/abs/1702.03407       #
+# This implementation written by R. Robinson https://goo.gl/NBmr9G          #
+#############################################################################
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+from collections import OrderedDict
+from contextlib import contextmanager
+
+### Per-stage timings of RCA.
+### Every reference is timed by a StageTimer in the process that registers it (read_image, cache, elastix_rigid,
+### elastix_bspline, warp_image, write, read_seg, warp_labels, metrics). The subject-level stages of RCA.py (copy, select,
+### gt_metrics, save) are timed by the TimingLog, which also collects the reference records and writes:
+###	<output>/<subject>/RCA/timings.jsonl	- one JSON line per reference and one for the subject
+###	a Prometheus textfile (optional)	- stage totals of the batch so far, for the node exporter textfile collector
+
+def peakRSS():
+	### Returns - the peak resident set size of this process in bytes (ru_maxrss is in kB on Linux)
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageTimer(object):
+	### Accumulates the wall-clock time spent in named stages ###
+
+	def __init__(self):
+		self.stages = OrderedDict()
+		self.start 	= time.time()
+
+	@contextmanager
+	def stage(self, name):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.stages[name] = self.stages.get(name, 0.0) + time.time() - start
+
+	def record(self):
+		### Returns - a JSON-serialisable dictionary of the stage times, total time and peak memory of this process
+		return {
+			'stages'	: dict(self.stages),
+			'total'		: time.time() - self.start,
+			'peak_rss'	: peakRSS(),
+			'pid'		: os.getpid(),
+			}
+
+
+class TimingLog(object):
+	### Collects the stage timings of the subjects of a batch ###
+	### Inputs:
+	### textfile		= Prometheus textfile rewritten after every subject (None = not written)
+
+	def __init__(self, textfile=None):
+		self.textfile 	= textfile
+		self.batch 		= OrderedDict()		# stage -> [calls, seconds, max seconds]
+		self.subjects 	= 0
+		self.references = 0
+		self.peak 		= peakRSS()
+		self.last 		= 0.0
+		self.subject 	= None
+
+	def beginSubject(self, subject, jsonl_file=None):
+		### Function to start timing a subject - its records are appended to jsonl_file ###
+		self.subject 	= subject
+		self.totals 	= OrderedDict()
+		self.timer 		= StageTimer()
+		self.jsonl 		= open(jsonl_file, 'a') if jsonl_file else None
+
+	def stage(self, name):
+		### Returns - a context manager timing a subject-level stage
+		return self.timer.stage(name)
+
+	def _write(self, reference, record):
+		if self.jsonl:
+			entry = dict(record, subject=self.subject, reference=reference, host=socket.gethostname(), time=time.time())
+			self.jsonl.write(json.dumps(entry, sort_keys=True) + '\n')
+			self.jsonl.flush()
+		self.peak = max(self.peak, record['peak_rss'])
+
+	def add(self, reference, record):
+		### Function to add the StageTimer record of one reference ###
+		self._write(reference, record)
+		for name, seconds in record['stages'].items():
+			_accumulate(self.totals, name, seconds)
+		self.references += 1
+
+	def endSubject(self):
+		### Function to finish the subject: writes its own record, updates the batch totals and the textfile ###
+		### Returns - the summary table of the subject
+		record = self.timer.record()
+		self._write(None, record)
+		for name, seconds in record['stages'].items():
+			_accumulate(self.totals, name, seconds)
+		for name, (calls, seconds, longest) in self.totals.items():
+			entry = self.batch.setdefault(name, [0, 0.0, 0.0])
+			entry[0] += calls
+			entry[1] += seconds
+			entry[2] = max(entry[2], longest)
+		self.subjects 	+= 1
+		self.last 		= record['total']
+		if self.jsonl:
+			self.jsonl.close()
+			self.jsonl = None
+		if self.textfile:
+			self.writeTextfile()
+		return table(self.totals, 'Timings of {} ({:.1f} s, peak memory {:.0f} MB)'.format(self.subject, record['total'], record['peak_rss'] / 2.0**20))
+
+	def summary(self):
+		### Returns - the summary table of the whole batch
+		return table(self.batch, 'Timings of {} subjects, {} references (peak memory {:.0f} MB)'.format(self.subjects, self.references, self.peak / 2.0**20))
+
+	def writeTextfile(self):
+		### Function to write the batch totals in the Prometheus text format (atomically, for the textfile collector) ###
+		lines = [
+			'# HELP rca_stage_seconds_total Wall-clock time spent in each RCA stage.',
+			'# TYPE rca_stage_seconds_total counter',
+			]
+		lines += ['rca_stage_seconds_total{{stage="{}"}} {}'.format(name, entry[1]) for name, entry in self.batch.items()]
+		lines += [
+			'# HELP rca_stage_calls_total Number of times each RCA stage ran.',
+			'# TYPE rca_stage_calls_total counter',
+			]
+		lines += ['rca_stage_calls_total{{stage="{}"}} {}'.format(name, entry[0]) for name, entry in self.batch.items()]
+		lines += [
+			'# HELP rca_subjects_total Subjects processed.',
+			'# TYPE rca_subjects_total counter',
+			'rca_subjects_total {}'.format(self.subjects),
+			'# HELP rca_references_total References registered.',
+			'# TYPE rca_references_total counter',
+			'rca_references_total {}'.format(self.references),
+			'# HELP rca_last_subject_seconds Wall-clock time of the last subject.',
+			'# TYPE rca_last_subject_seconds gauge',
+			'rca_last_subject_seconds {}'.format(self.last),
+			'# HELP rca_peak_rss_bytes Peak resident memory of the RCA processes.',
+			'# TYPE rca_peak_rss_bytes gauge',
+			'rca_peak_rss_bytes {}'.format(self.peak),
+			]
+		tmp = '{}.{}.tmp'.format(self.textfile, os.getpid())
+		with open(tmp, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		os.rename(tmp, self.textfile)
+
+
+def _accumulate(totals, name, seconds):
+	entry = totals.setdefault(name, [0, 0.0, 0.0])
+	entry[0] += 1
+	entry[1] += seconds
+	entry[2] = max(entry[2], seconds)
+
+def table(totals, title):
+	### Function to format stage totals as a table ###
+	### Inputs:
+	### totals 		= dictionary of stage -> [calls, seconds, max seconds]
+	### title 		= the first line of the table
+	### Returns - the table as a string
+	overall = sum(entry[1] for entry in totals.values()) or 1.0
+	lines 	= [title, '{:<16}{:>7}{:>12}{:>10}{:>10}{:>8}'.format('Stage', 'Calls', 'Total (s)', 'Mean (s)', 'Max (s)', 'Share')]
+	for name, (calls, seconds, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+		lines.append('{:<16}{:>7d}{:>12.2f}{:>10.3f}{:>10.3f}{:>7.1f}%'.format(name, calls, seconds, seconds / calls, longest, 100.0 * seconds / overall))
+	return '\n'.join(lines) + '\n'